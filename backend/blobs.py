@@ -0,0 +1,205 @@
+"""
+Content-addressed storage for note canvases.
+
+Canvas images live in a blob store keyed by the SHA-256 of their bytes, so identical
+images are stored once and note documents only carry a reference:
+
+    content_hash, content_type, content_size
+
+content_type is None when the client sent bare base64 rather than a data URL, so the
+note reads back exactly as it was written.
+
+Two backends implement the BlobStore interface: GridFS (the default, keeps
+everything in Mongo) and the local filesystem. Pick one with BLOB_STORE.
+"""
+
+import abc
+import base64
+import binascii
+import hashlib
+import os
+import tempfile
+from typing import AsyncIterator, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from pymongo.errors import DuplicateKeyError
+from starlette.concurrency import run_in_threadpool
+
+DEFAULT_CONTENT_TYPE = "image/png"
+CHUNK_SIZE = 256 * 1024
+
+
+class BlobStore(abc.ABC):
+    @abc.abstractmethod
+    async def exists(self, blob_hash: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    async def _write(self, blob_hash: str, data: bytes, content_type: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def stream(self, blob_hash: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Yield the bytes of blob[start:end] in chunks."""
+
+    async def put(self, data: bytes, content_type: str = DEFAULT_CONTENT_TYPE) -> str:
+        """Store ``data`` unless an identical blob already exists, and return its hash."""
+        blob_hash = hashlib.sha256(data).hexdigest()
+        if not await self.exists(blob_hash):
+            await self._write(blob_hash, data, content_type)
+        return blob_hash
+
+    async def read(self, blob_hash: str) -> bytes:
+        return b"".join([chunk async for chunk in self.stream(blob_hash)])
+
+
+class GridFSBlobStore(BlobStore):
+    def __init__(self, db: AsyncIOMotorDatabase, bucket_name: str = "note_blobs"):
+        self.files = db[f"{bucket_name}.files"]
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket_name)
+
+    async def exists(self, blob_hash: str) -> bool:
+        return await self.files.find_one({"_id": blob_hash}, {"_id": 1}) is not None
+
+    async def _write(self, blob_hash: str, data: bytes, content_type: str) -> None:
+        try:
+            await self.bucket.upload_from_stream_with_id(
+                blob_hash, blob_hash, data, metadata={"content_type": content_type}
+            )
+        except DuplicateKeyError:
+            # Someone else stored the same content in the meantime
+            pass
+
+    async def stream(self, blob_hash: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        grid_out = await self.bucket.open_download_stream(blob_hash)
+        end = grid_out.length if end is None else min(end, grid_out.length)
+        grid_out.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = await grid_out.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+class FileSystemBlobStore(BlobStore):
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, blob_hash: str) -> str:
+        return os.path.join(self.root, blob_hash[:2], blob_hash)
+
+    async def exists(self, blob_hash: str) -> bool:
+        return await run_in_threadpool(os.path.exists, self._path(blob_hash))
+
+    def _write_file(self, blob_hash: str, data: bytes) -> None:
+        path = self._path(blob_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename, so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    async def _write(self, blob_hash: str, data: bytes, content_type: str) -> None:
+        await run_in_threadpool(self._write_file, blob_hash, data)
+
+    async def stream(self, blob_hash: str, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        f = await run_in_threadpool(open, self._path(blob_hash), "rb")
+        try:
+            await run_in_threadpool(f.seek, start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                chunk = await run_in_threadpool(f.read, size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+
+
+def create_store(db: AsyncIOMotorDatabase) -> BlobStore:
+    backend = os.getenv("BLOB_STORE", "gridfs")
+    if backend == "gridfs":
+        return GridFSBlobStore(db)
+    if backend == "filesystem":
+        return FileSystemBlobStore(os.getenv("BLOB_STORE_PATH", "/app/blobs"))
+    raise RuntimeError(f"Unknown BLOB_STORE backend: {backend}")
+
+
+def decode_data_url(content: str) -> Tuple[bytes, Optional[str]]:
+    """Split a canvas.toDataURL() string into bytes and a content type (None for bare base64)."""
+    content_type = None
+    if content.startswith("data:"):
+        header, _, content = content.partition(",")
+        content_type = header[len("data:"):].split(";")[0] or DEFAULT_CONTENT_TYPE
+    try:
+        return base64.b64decode(content, validate=True), content_type
+    except binascii.Error as e:
+        raise ValueError("Content is not valid base64") from e
+
+
+def encode_data_url(data: bytes, content_type: Optional[str]) -> str:
+    encoded = base64.b64encode(data).decode()
+    return f"data:{content_type};base64,{encoded}" if content_type else encoded
+
+
+def parse_range(header: str, size: int) -> Tuple[int, int]:
+    """
+    Parse a single "bytes=start-end" Range header into a half-open (start, end) interval.
+    Raises ValueError if the range is malformed or cannot be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        raise ValueError("Only single byte ranges are supported")
+    first, _, last = spec.strip().partition("-")
+    if first:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    else:
+        # "bytes=-N" asks for the last N bytes
+        start, end = max(0, size - int(last)), size
+    if start >= size or start >= end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+async def offload_content(store: BlobStore, fields: dict) -> dict:
+    """Replace an inline "content" field with a reference to the stored blob."""
+    if "content" not in fields:
+        return fields
+    fields = dict(fields)
+    content = fields.pop("content")
+    if not content:
+        fields.update(content_hash=None, content_type=None, content_size=0)
+        return fields
+    data, content_type = decode_data_url(content)
+    fields.update(
+        content_hash=await store.put(data, content_type or DEFAULT_CONTENT_TYPE),
+        content_type=content_type,
+        content_size=len(data),
+    )
+    return fields
+
+
+async def read_canvas(store: BlobStore, doc: dict) -> Optional[bytes]:
+    """The note's canvas bytes, wherever they are kept; None if it has none."""
+    if doc.get("content_hash"):
+        return await store.read(doc["content_hash"])
+    if doc.get("content"):
+        # Written before canvases moved to the blob store
+        return decode_data_url(doc["content"])[0]
+    return None
+
+
+async def hydrate_content(store: BlobStore, doc: dict) -> dict:
+    """Fill in "content" as a data URL for clients that expect the canvas inline."""
+    if doc.get("content_hash") and "content" not in doc:
+        doc["content"] = encode_data_url(await store.read(doc["content_hash"]), doc["content_type"])
+    doc.setdefault("content", "")
+    return doc
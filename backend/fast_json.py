@@ -0,0 +1,120 @@
+"""
+Fast response path for large JSON listings.
+
+The default path validates every document into a Pydantic model, dumps it back to a
+dict, validates it again against the response_model and encodes it with the stdlib
+json module. Documents read from our own database do not need any of that: ``shape``
+only picks the model's fields (with their defaults) so the output is the same, and
+``json_response`` encodes with orjson and compresses with brotli or gzip, whichever the
+client accepts, giving the compressed body its own ETag (see http_cache).
+
+orjson and brotli are optional: without them the stdlib json encoder and gzip are
+used. Set FAST_JSON=0 to serve listings through the regular response_model path.
+"""
+
+import gzip
+import json
+import os
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Type
+
+from fastapi import Response
+from pydantic import BaseModel
+from pydantic_core import PydanticUndefined
+from starlette.concurrency import run_in_threadpool
+
+import http_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENABLED = os.getenv("FAST_JSON", "1").lower() not in ("0", "false", "no")
+# Smaller bodies are not worth the CPU (or fit in a single packet anyway)
+MIN_COMPRESS_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", "1024"))
+# Compressing bigger bodies than this moves to a worker thread, off the event loop
+THREADED_COMPRESS_BYTES = 256 * 1024
+GZIP_LEVEL = 5
+# Brotli's high qualities are for static assets; 4 compresses better than gzip at a similar speed
+BROTLI_QUALITY = 4
+
+
+@lru_cache(maxsize=None)
+def _defaults(model: Type[BaseModel]) -> Dict[str, Any]:
+    return {
+        name: None if field.default is PydanticUndefined else field.default
+        for name, field in model.model_fields.items()
+    }
+
+
+def shape(doc: dict, model: Type[BaseModel]) -> dict:
+    """A trusted database document cut down to ``model``'s fields, without validating it."""
+    return {name: doc.get(name, default) for name, default in _defaults(model).items()}
+
+
+def shape_all(docs: Iterable[dict], model: Type[BaseModel]) -> List[dict]:
+    return [shape(doc, model) for doc in docs]
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """The best content coding we can produce that the client accepts (q=0 means refused)."""
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.lower()] = quality
+    for coding in ("br", "gzip"):
+        if coding == "br" and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+def compress(body: bytes, coding: str) -> bytes:
+    if coding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+async def json_response(content: Any, accept_encoding: Optional[str] = None,
+                        headers: Optional[Dict[str, str]] = None, status_code: int = 200) -> Response:
+    """Encode ``content`` (already shaped) and compress it if the client accepts a coding we support."""
+    body = dumps(content)
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    coding = negotiate_encoding(accept_encoding) if len(body) >= MIN_COMPRESS_BYTES else None
+    if coding is not None:
+        if len(body) >= THREADED_COMPRESS_BYTES:
+            body = await run_in_threadpool(compress, body, coding)
+        else:
+            body = compress(body, coding)
+        headers["Content-Encoding"] = coding
+        if "ETag" in headers:
+            headers["ETag"] = http_cache.encoded_etag(headers["ETag"], coding)
+    return Response(content=body, status_code=status_code, media_type="application/json", headers=headers)
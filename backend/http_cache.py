@@ -0,0 +1,95 @@
+"""
+Conditional request helpers: ETag generation, If-None-Match / If-Match matching and
+304 responses.
+
+Note ETags encode the note id and its updated_at (in milliseconds, the precision Mongo
+stores), so an If-Match header can be turned straight back into an atomic update filter.
+
+A compressed body is a different representation from the uncompressed one, so it gets
+its own strong ETag: the resource's, with the coding appended (``"…-br"``, see
+``encoded_etag``). Matching and parsing take the suffix off again, so a validator from
+any representation revalidates the resource.
+"""
+
+import hashlib
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from fastapi import Response, status
+
+EPOCH = datetime(1970, 1, 1)
+# Mutable resources: the client may keep a copy but must revalidate it on every use
+REVALIDATE = "private, no-cache"
+IMMUTABLE = "private, max-age=31536000, immutable"
+# Content codings responses may be compressed with (see fast_json)
+CODINGS = ("br", "gzip")
+
+
+def _millis(value: datetime) -> int:
+    return (value.replace(tzinfo=None) - EPOCH) // timedelta(milliseconds=1)
+
+
+def note_etag(note_id: str, updated_at: datetime) -> str:
+    return f'"{note_id}.{_millis(updated_at)}"'
+
+
+def encoded_etag(etag: str, coding: Optional[str]) -> str:
+    """The ETag of the body ``etag`` stands for, compressed with ``coding`` (None: not compressed)."""
+    if coding is None:
+        return etag
+    return f'{etag[:-1]}-{coding}"'
+
+
+def _unencoded(etag: str) -> str:
+    """Undo ``encoded_etag``."""
+    etag = etag.strip()
+    for coding in CODINGS:
+        suffix = f'-{coding}"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+def parse_note_etag(etag: str) -> Optional[Tuple[str, datetime]]:
+    """Invert ``note_etag``, of any representation. Returns None for anything it did not produce."""
+    note_id, _, millis = _unencoded(etag).strip('"').rpartition(".")
+    if not note_id or not millis.isdigit():
+        return None
+    return note_id, EPOCH + timedelta(milliseconds=int(millis))
+
+
+def hash_etag(*parts: object) -> str:
+    digest = hashlib.sha256("\x1f".join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def match(header: Optional[str], etag: str) -> Optional[str]:
+    """
+    The ETag in an If-None-Match / If-Match header value that is a representation of
+    ``etag`` (``etag`` itself for "*"), or None. A 304 should carry the one returned.
+    """
+    if not header:
+        return None
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    if "*" in candidates:
+        return etag
+    # Weak comparison for If-None-Match is fine: our ETags are never weak themselves
+    for candidate in candidates:
+        candidate = candidate.removeprefix("W/")
+        if _unencoded(candidate) == etag:
+            return candidate
+    return None
+
+
+def matches(header: Optional[str], etag: str) -> bool:
+    """True if an If-None-Match / If-Match header value lists a representation of ``etag`` (or is "*")."""
+    return match(header, etag) is not None
+
+
+def not_modified(etag: str, cache_control: str = REVALIDATE) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Cache-Control": cache_control})
+
+
+def set_headers(response: Response, etag: str, cache_control: str = REVALIDATE) -> None:
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = cache_control
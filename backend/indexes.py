@@ -0,0 +1,187 @@
+"""
+MongoDB index definitions for the Smart Pen API, created from the app lifespan.
+
+Every index the hot queries rely on is declared in INDEXES. ``ensure_indexes``
+creates missing ones and migrates ones whose definition changed, and
+``verify_query_plans`` fails if any hot query still falls back to a collection scan.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+from typing import Iterator, List, NamedTuple, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+NOTES_TEXT_INDEX = "notes_text_search"
+
+# The OCR runs with "rus+eng", so notes mix both scripts. The Russian stemmer only
+# rewrites Cyrillic words; Latin-script words are indexed as-is, so English terms
+# still match exactly while Russian ones also match across word forms.
+TEXT_SEARCH_LANGUAGE = "russian"
+
+# Clients that have not synced for longer than this must do a full resync
+TOMBSTONE_TTL_DAYS = int(os.getenv("NOTE_TOMBSTONE_TTL_DAYS", "90"))
+# Finished jobs (and their results) are kept this long
+JOB_TTL_DAYS = int(os.getenv("JOB_TTL_DAYS", "7"))
+
+# Server error codes for "an index with this name/keys already exists with other options"
+INDEX_CONFLICT_CODES = (85, 86)
+
+
+class IndexSpec(NamedTuple):
+    collection: str
+    name: str
+    keys: List[Tuple[str, object]]
+    options: dict = {}
+
+
+INDEXES = [
+    IndexSpec("users", "users_username_unique", [("username", 1)], {"unique": True}),
+    IndexSpec("users", "users_email_unique", [("email", 1)], {"unique": True}),
+    IndexSpec("notes", "notes_id_unique", [("id", 1)], {"unique": True}),
+    # Serves both the plain per-user listing and the keyset-paginated summaries
+    IndexSpec("notes", "notes_user_updated", [("user_id", 1), ("updated_at", -1), ("id", -1)]),
+    # Blob downloads check that the user owns a note referencing the blob
+    IndexSpec("notes", "notes_user_content_hash", [("user_id", 1), ("content_hash", 1)]),
+    # Prefixing the text index with user_id keeps every search inside one user's notes
+    IndexSpec(
+        "notes",
+        NOTES_TEXT_INDEX,
+        [("user_id", 1), ("title", "text"), ("text_content", "text")],
+        {"weights": {"title": 10, "text_content": 1}, "default_language": TEXT_SEARCH_LANGUAGE},
+    ),
+    # Change feed: notes and deletion tombstones in per-user sequence order
+    IndexSpec("notes", "notes_user_change_seq", [("user_id", 1), ("change_seq", 1)]),
+    IndexSpec("note_tombstones", "tombstones_user_change_seq", [("user_id", 1), ("change_seq", 1)]),
+    IndexSpec(
+        "note_tombstones",
+        "tombstones_ttl",
+        [("deleted_at", 1)],
+        {"expireAfterSeconds": TOMBSTONE_TTL_DAYS * 24 * 3600},
+    ),
+    IndexSpec("bluetooth_data", "bluetooth_id_user", [("id", 1), ("user_id", 1)]),
+    # Unique, so two writers cannot both start a live session's next chunk. Session ids come
+    # from the clients, so two users may share one: the user is part of the key
+    IndexSpec(
+        "bluetooth_chunks",
+        "bluetooth_chunks_session_index",
+        [("user_id", 1), ("session_id", 1), ("index", 1)],
+        {"unique": True},
+    ),
+    IndexSpec("jobs", "jobs_id_user", [("id", 1), ("user_id", 1)]),
+    IndexSpec("jobs", "jobs_user_created", [("user_id", 1), ("created_at", -1)]),
+    # The dispatcher's claim order: most urgent first, then oldest
+    IndexSpec("jobs", "jobs_queue", [("status", 1), ("priority", -1), ("created_at", 1)]),
+    IndexSpec("jobs", "jobs_dedupe_key", [("dedupe_key", 1), ("status", 1)]),
+    IndexSpec(
+        "jobs",
+        "jobs_ttl",
+        [("finished_at", 1)],
+        {"expireAfterSeconds": JOB_TTL_DAYS * 24 * 3600},
+    ),
+]
+
+# Hot queries that must be served by an index: (collection, filter, sort)
+HOT_QUERIES = [
+    ("users", {"username": "explain-probe"}, None),
+    ("users", {"email": "explain-probe"}, None),
+    ("notes", {"id": "explain-probe", "user_id": "explain-probe"}, None),
+    ("notes", {"user_id": "explain-probe"}, [("updated_at", -1), ("id", -1)]),
+    ("notes", {"user_id": "explain-probe", "content_hash": "explain-probe"}, None),
+    ("notes", {"user_id": "explain-probe", "change_seq": {"$gt": 0}}, [("change_seq", 1)]),
+    ("note_tombstones", {"user_id": "explain-probe", "change_seq": {"$gt": 0}}, [("change_seq", 1)]),
+    ("bluetooth_data", {"id": "explain-probe", "user_id": "explain-probe"}, None),
+    ("bluetooth_chunks", {"session_id": "explain-probe", "user_id": "explain-probe"}, [("index", 1)]),
+    ("jobs", {"id": "explain-probe", "user_id": "explain-probe"}, None),
+    ("jobs", {"user_id": "explain-probe"}, [("created_at", -1)]),
+    ("jobs", {"status": "queued"}, [("priority", -1), ("created_at", 1)]),
+]
+
+
+class QueryPlanError(RuntimeError):
+    pass
+
+
+async def _create_index(db: AsyncIOMotorDatabase, spec: IndexSpec) -> None:
+    await db[spec.collection].create_index(spec.keys, name=spec.name, **spec.options)
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create every index in INDEXES, rebuilding any whose definition has changed."""
+    for spec in INDEXES:
+        try:
+            await _create_index(db, spec)
+        except OperationFailure as e:
+            if e.code not in INDEX_CONFLICT_CODES:
+                raise
+            # Same name or keys with different options: an older definition, migrate it
+            logger.warning("Rebuilding index %s.%s: %s", spec.collection, spec.name, e)
+            existing = await db[spec.collection].index_information()
+            for name, info in existing.items():
+                if name == spec.name or list(info["key"]) == list(spec.keys):
+                    await db[spec.collection].drop_index(name)
+            await _create_index(db, spec)
+
+
+def _plan_stages(plan: dict) -> Iterator[str]:
+    """Yield every stage name in an explain() plan tree."""
+    if "stage" in plan:
+        yield plan["stage"]
+    for value in plan.values():
+        if isinstance(value, dict):
+            yield from _plan_stages(value)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    yield from _plan_stages(item)
+
+
+async def verify_query_plans(db: AsyncIOMotorDatabase) -> None:
+    """Raise QueryPlanError if any hot query's winning plan contains a COLLSCAN."""
+    failures = []
+    for collection, query, sort in HOT_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        winning_plan = explain["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _plan_stages(winning_plan):
+            failures.append(f"{collection} {query}")
+    if failures:
+        raise QueryPlanError("Hot queries fall back to COLLSCAN: " + "; ".join(failures))
+
+
+async def bootstrap(db: AsyncIOMotorDatabase) -> None:
+    """Run from the app lifespan: create indexes, then optionally check the query plans."""
+    await ensure_indexes(db)
+    if os.getenv("MONGO_VERIFY_QUERY_PLANS", "").lower() in ("1", "true", "yes"):
+        await verify_query_plans(db)
+
+
+if __name__ == "__main__":
+    # CI entry point: python indexes.py exits non-zero if a hot query is not indexed
+    from dotenv import load_dotenv
+    from repository import DATABASE_NAME, create_client
+
+    load_dotenv()
+
+    async def _main():
+        client = create_client(os.environ["MONGO_URL"])
+        try:
+            db = client[DATABASE_NAME]
+            await ensure_indexes(db)
+            await verify_query_plans(db)
+        finally:
+            client.close()
+
+    try:
+        asyncio.run(_main())
+    except QueryPlanError as e:
+        print(e)
+        sys.exit(1)
+    print("All hot queries are served by an index.")
@@ -0,0 +1,225 @@
+"""
+Background jobs for CPU-heavy note work.
+
+Jobs are documents in the "jobs" collection (see JobRepository), so they survive
+restarts and whichever app worker is free can run them. Each worker runs one
+JobScheduler: a dispatcher that claims queued jobs, most urgent first, while keeping
+at most JOB_MAX_PER_USER jobs of any one user running, and a process pool of
+JOB_WORKERS processes for the CPU-bound parts, so they never hold up request handling.
+JOB_WORKERS is per app worker and defaults to the cores divided by WEB_CONCURRENCY
+(Gunicorn's worker count), so all the pools together use every core once.
+
+A job kind is an async handler registered with ``register``. Handlers do their I/O on
+the event loop and pass CPU work to ``context.run_cpu`` as a picklable module-level
+function. The dict a handler returns becomes the job's result; a "blob" key in it
+points at a blob store entry, which the result endpoint streams.
+
+Cancelling a queued job takes it off the queue. A running job is interrupted at its
+next await; CPU work already handed to the pool runs to completion, but its output
+is dropped.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+import blobs
+from repository import Repositories
+
+logger = logging.getLogger(__name__)
+
+APP_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+PROCESS_WORKERS = int(os.getenv("JOB_WORKERS", str(max(1, (os.cpu_count() or 2) // APP_WORKERS))))
+MAX_RUNNING_PER_USER = int(os.getenv("JOB_MAX_PER_USER", "2"))
+POLL_INTERVAL = float(os.getenv("JOB_POLL_SECONDS", "2"))
+LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# How long stop() waits for the dispatcher, then for the cancelled jobs, before moving on
+STOP_TIMEOUT = float(os.getenv("JOB_STOP_SECONDS", "10"))
+
+PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH = 0, 5, 9
+
+
+class JobContext(NamedTuple):
+    repos: Repositories
+    store: blobs.BlobStore
+    job: dict
+    run_cpu: Callable[..., Awaitable]
+
+
+Handler = Callable[[JobContext, dict], Awaitable[dict]]
+
+
+class JobKind(NamedTuple):
+    handler: Handler
+    submittable: bool  # False for kinds only the server itself may queue
+
+
+KINDS: Dict[str, JobKind] = {}
+
+
+class UnknownJobKind(ValueError):
+    pass
+
+
+def register(kind: str, handler: Handler, submittable: bool = True) -> None:
+    KINDS[kind] = JobKind(handler, submittable)
+
+
+class JobScheduler:
+    def __init__(self, repos: Repositories, store: blobs.BlobStore,
+                 process_workers: int = PROCESS_WORKERS, max_running_per_user: int = MAX_RUNNING_PER_USER):
+        self.repos = repos
+        self.store = store
+        self.process_workers = process_workers
+        self.max_running_per_user = max_running_per_user
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._running: Dict[str, asyncio.Task] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # spawn rather than fork: forking a process with a running event loop and Mongo client threads is unsafe
+        return ProcessPoolExecutor(self.process_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def start(self) -> None:
+        self._pool = self._new_pool()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self) -> None:
+        self._stopping = True
+        if self._dispatcher is not None:
+            # Let the dispatcher finish its round and see _stopping rather than cancelling it:
+            # before Python 3.12, wait_for swallows a cancellation that arrives as the event is set
+            self._wakeup.set()
+            done, _ = await asyncio.wait([self._dispatcher], timeout=STOP_TIMEOUT)
+            if not done:
+                logger.warning("Job dispatcher did not stop within %.0f s, cancelling it", STOP_TIMEOUT)
+                self._dispatcher.cancel()
+                await asyncio.wait([self._dispatcher], timeout=STOP_TIMEOUT)
+        running = list(self._running)
+        for task in list(self._running.values()):
+            task.cancel()
+        if running:
+            await asyncio.wait(list(self._running.values()), timeout=STOP_TIMEOUT)
+        # Jobs cut short by the shutdown go back to the queue for another worker
+        await self.repos.jobs.release(self.worker_id, running)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    async def run_cpu(self, func: Callable, *args):
+        """Run a picklable module-level function on the process pool (on a thread if the scheduler is not started)."""
+        if self._pool is None:
+            return await run_in_threadpool(func, *args)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, func, *args)
+        except BrokenProcessPool:
+            # A pool process died (e.g. killed for memory); the pool is unusable from now on
+            logger.error("Job process pool broke, starting a new one")
+            self._pool = self._new_pool()
+            raise
+
+    async def submit(self, user_id: str, kind: str, params: dict, priority: int = PRIORITY_NORMAL,
+                     dedupe_key: Optional[str] = None) -> dict:
+        """Queue a job and return it. With ``dedupe_key``, an equivalent queued or running job is returned instead."""
+        if kind not in KINDS:
+            raise UnknownJobKind(f"Unknown job kind: {kind}")
+        if dedupe_key:
+            existing = await self.repos.jobs.find_active(dedupe_key)
+            if existing is not None:
+                return existing
+        job = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "kind": kind,
+            "params": params,
+            "priority": priority,
+            "status": "queued",
+            "attempts": 0,
+            "created_at": datetime.utcnow(),
+        }
+        if dedupe_key:
+            job["dedupe_key"] = dedupe_key
+        await self.repos.jobs.create(job)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def cancel(self, job_id: str, user_id: str) -> Optional[dict]:
+        job = await self.repos.jobs.cancel(job_id, user_id)
+        task = self._running.get(job_id)
+        if job is not None and job.get("cancel_requested") and task is not None:
+            # Running here: no need to wait for the next lease renewal to notice
+            task.cancel()
+        return job
+
+    async def _dispatch_loop(self) -> None:
+        while not self._stopping:
+            try:
+                await self._maintain()
+                await self._fill()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Job dispatcher failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _maintain(self) -> None:
+        """Renew our leases, stop jobs whose owner cancelled them, and requeue jobs of dead workers."""
+        for job_id in await self.repos.jobs.renew(self.worker_id, list(self._running), LEASE_SECONDS):
+            task = self._running.get(job_id)
+            if task is not None:
+                task.cancel()
+        await self.repos.jobs.requeue_expired(MAX_ATTEMPTS)
+
+    async def _fill(self) -> None:
+        # Users found with no slot free in this round, which saturated_users may not show yet
+        full = set()
+        while not self._stopping and len(self._running) < self.process_workers:
+            saturated = await self.repos.jobs.saturated_users(self.max_running_per_user)
+            job = await self.repos.jobs.claim(self.worker_id, LEASE_SECONDS, list(full.union(saturated)))
+            if job is None:
+                return
+            if not await self.repos.jobs.take_slot(job["user_id"], job["id"], self.max_running_per_user):
+                # Another worker took the user's last slot after saturated_users looked
+                await self.repos.jobs.unclaim(job["id"], self.worker_id)
+                full.add(job["user_id"])
+                continue
+            self._running[job["id"]] = asyncio.create_task(self._run(job))
+
+    async def _run(self, job: dict) -> None:
+        status, result, error = "failed", None, None
+        try:
+            kind = KINDS.get(job["kind"])
+            if kind is None:
+                raise UnknownJobKind(f"Unknown job kind: {job['kind']}")
+            context = JobContext(self.repos, self.store, job, self.run_cpu)
+            result = await kind.handler(context, job.get("params") or {})
+            status = "succeeded"
+        except asyncio.CancelledError:
+            if self._stopping:
+                return
+            status = "cancelled"
+        except Exception as e:
+            logger.exception("Job %s (%s) failed", job["id"], job["kind"])
+            error = str(e) or type(e).__name__
+        finally:
+            self._running.pop(job["id"], None)
+            self._wakeup.set()
+        await self.repos.jobs.finish(job["id"], self.worker_id, status, result, error)
@@ -0,0 +1,157 @@
+"""
+Live pen streaming over a WebSocket.
+
+The client sends binary frames: a little-endian uint64 sequence number followed by a
+packed stroke batch (see strokes.py). Sequence numbers start at 1 and grow by one per
+frame. The server group-commits frames to Mongo once a batch is large enough or old
+enough, and only then acknowledges them, so an ack means the points are durable.
+
+Server messages are JSON:
+    {"type": "ready", "session_id": ..., "last_seq": n}  resend every frame after n
+    {"type": "ack", "seq": n}                            every frame up to n is stored
+    {"type": "error", "detail": ...}                     sent right before closing
+
+A client that reconnects with the same session_id gets the last committed sequence
+number in "ready" and resumes from there; frames it resends that were already
+committed are acknowledged and skipped.
+
+Each committed chunk is simplified first (see simplify.py), and its raw samples are
+archived if STROKE_ARCHIVE_RAW is set. Chunks are stored as parts of the session's
+chunk documents (see sessions.py).
+"""
+
+import asyncio
+import os
+import struct
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+from fastapi import WebSocket, WebSocketDisconnect, status
+
+import blobs
+import sessions
+import simplify
+import strokes
+from repository import BluetoothRepository
+
+FRAME_HEADER = struct.Struct("<Q")
+MAX_BATCH_POINTS = int(os.getenv("STREAM_BATCH_MAX_POINTS", "2048"))
+MAX_BATCH_DELAY = int(os.getenv("STREAM_BATCH_MAX_DELAY_MS", "100")) / 1000
+
+
+class SequenceError(ValueError):
+    pass
+
+
+def parse_frame(frame: bytes) -> Tuple[int, strokes.StrokeColumns]:
+    if len(frame) < FRAME_HEADER.size:
+        raise strokes.StrokeFormatError("Frame is shorter than its sequence number")
+    (seq,) = FRAME_HEADER.unpack_from(frame)
+    return seq, strokes.decode(frame[FRAME_HEADER.size:])
+
+
+class Chunk(NamedTuple):
+    part: dict  # the simplified samples, as a chunk document part
+    totals: dict
+    last_seq: int
+    raw: Optional[bytes]  # the samples as received, packed; only when they are to be archived
+    simplification: simplify.Simplification
+
+
+class StrokeBatcher:
+    """Buffers stream frames until a size or time bound says it is time to commit them."""
+
+    def __init__(self, last_seq: int, max_points: int = MAX_BATCH_POINTS, max_delay: float = MAX_BATCH_DELAY):
+        self.committed_seq = last_seq
+        self.last_seq = last_seq
+        self.max_points = max_points
+        self.max_delay = max_delay
+        self._batches: List[strokes.StrokeColumns] = []
+        self._points = 0
+        self._first_at: Optional[float] = None
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._batches)
+
+    def add(self, seq: int, columns: strokes.StrokeColumns) -> bool:
+        """Buffer a frame. Returns False for an already seen frame, raises SequenceError on a gap."""
+        if seq <= self.last_seq:
+            return False
+        if seq != self.last_seq + 1:
+            raise SequenceError(f"Expected frame {self.last_seq + 1}, got {seq}")
+        if self._first_at is None:
+            self._first_at = time.monotonic()
+        self._batches.append(columns)
+        self._points += len(columns)
+        self.last_seq = seq
+        return True
+
+    def should_flush(self) -> bool:
+        return self._points >= self.max_points or self.time_until_flush() == 0
+
+    def time_until_flush(self) -> Optional[float]:
+        """Seconds until the oldest buffered frame hits the delay bound; None when nothing is buffered."""
+        if self._first_at is None:
+            return None
+        return max(0.0, self._first_at + self.max_delay - time.monotonic())
+
+    def drain(self) -> Chunk:
+        """Simplify and pack the buffered frames, and reset the buffer."""
+        columns = strokes.concat(self._batches)
+        simplified, simplification = simplify.simplified(columns)
+        raw = strokes.encode(columns) if simplify.ARCHIVE_RAW else None
+        self._batches, self._points, self._first_at = [], 0, None
+        part, totals = sessions.pack_part(simplified)
+        return Chunk(part, totals, self.last_seq, raw, simplification)
+
+
+async def serve_stream(websocket: WebSocket, repo: BluetoothRepository, store: blobs.BlobStore,
+                       user_id: str, session_id: str, device_id: str) -> None:
+    session = await sessions.open_live(repo, session_id, user_id, device_id)
+    batcher = StrokeBatcher(session.get("acked_seq", 0))
+    await websocket.send_json({"type": "ready", "session_id": session_id, "last_seq": batcher.last_seq})
+
+    async def flush() -> bool:
+        chunk = batcher.drain()
+        raw_blob = await simplify.archive(store, chunk.raw) if chunk.raw is not None else None
+        committed = await repo.append_live_chunk(
+            session_id, user_id, chunk.part, chunk.totals, batcher.committed_seq, chunk.last_seq,
+            chunk.simplification.stats(), raw_blob,
+        )
+        if committed:
+            batcher.committed_seq = chunk.last_seq
+        return committed
+
+    async def commit_and_ack():
+        if not await flush():
+            raise SequenceError("Session was written by another connection")
+        await websocket.send_json({"type": "ack", "seq": batcher.committed_seq})
+
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.receive(), batcher.time_until_flush())
+            except asyncio.TimeoutError:
+                await commit_and_ack()
+                continue
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+            if message.get("bytes") is None:
+                raise strokes.StrokeFormatError("Frames must be binary")
+
+            seq, columns = parse_frame(message["bytes"])
+            if not batcher.add(seq, columns) and not batcher.pending:
+                # Replayed frame that is already stored: just acknowledge it again
+                await websocket.send_json({"type": "ack", "seq": batcher.committed_seq})
+            elif batcher.should_flush():
+                await commit_and_ack()
+    except WebSocketDisconnect:
+        # The client is gone, but whatever it sent is still worth keeping
+        if batcher.pending:
+            await flush()
+    except (strokes.StrokeFormatError, SequenceError) as e:
+        if batcher.pending:
+            await flush()
+        await websocket.send_json({"type": "error", "detail": str(e)})
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
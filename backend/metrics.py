@@ -0,0 +1,196 @@
+"""
+Prometheus metrics for the API and its Mongo traffic.
+
+MetricsMiddleware times every HTTP request and records its size and the response's,
+labelled by route template (not the raw path, so note ids do not become labels).
+MongoCommandListener and MongoPoolListener are pymongo event listeners (pass
+``LISTENERS`` to the client): they time every command by collection and command
+name, and measure how long requests wait for a pooled connection, which is what
+climbs first when the pool is the bottleneck. The principal cache (principals.py)
+counts its hits and misses here too.
+
+``render`` produces the text exposition for the /metrics endpoint. Under a
+multi-process server, set PROMETHEUS_MULTIPROC_DIR and the values of all workers
+are added up.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest, multiprocess
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(4 ** i * 64 for i in range(10))  # 64 B .. 16 MB
+UNMATCHED_ROUTE = "<unmatched>"
+
+http_requests = Counter(
+    "smartpen_http_requests_total", "HTTP requests by route and status", ["method", "route", "status"]
+)
+http_request_duration = Histogram(
+    "smartpen_http_request_duration_seconds", "Time from receiving a request to sending the last of the response",
+    ["method", "route"], buckets=LATENCY_BUCKETS,
+)
+http_request_size = Histogram(
+    "smartpen_http_request_size_bytes", "Request body size", ["method", "route"], buckets=SIZE_BUCKETS
+)
+http_response_size = Histogram(
+    "smartpen_http_response_size_bytes", "Response body size", ["method", "route"], buckets=SIZE_BUCKETS
+)
+http_in_progress = Gauge(
+    "smartpen_http_requests_in_progress", "Requests being handled right now", ["method"], multiprocess_mode="livesum"
+)
+mongo_command_duration = Histogram(
+    "smartpen_mongo_command_duration_seconds", "Mongo command round trip, as measured by the driver",
+    ["collection", "command"], buckets=LATENCY_BUCKETS,
+)
+mongo_command_failures = Counter(
+    "smartpen_mongo_command_failures_total", "Mongo commands that returned an error", ["collection", "command"]
+)
+mongo_pool_wait = Histogram(
+    "smartpen_mongo_pool_wait_seconds", "Time spent waiting to check a connection out of the pool",
+    buckets=LATENCY_BUCKETS,
+)
+mongo_connections_checked_out = Gauge(
+    "smartpen_mongo_connections_checked_out", "Pooled connections in use", multiprocess_mode="livesum"
+)
+principal_cache_lookups = Counter(
+    "smartpen_principal_cache_lookups_total", "Bearer token principals looked up in the cache", ["result"]
+)
+principal_cache_entries = Gauge(
+    "smartpen_principal_cache_entries", "Principals held in the cache", multiprocess_mode="livesum"
+)
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, so streaming responses are measured without being buffered."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        request_bytes = response_bytes = 0
+        status = 500
+
+        async def counting_receive():
+            nonlocal request_bytes
+            message = await receive()
+            request_bytes += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal response_bytes, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        in_progress = http_in_progress.labels(method)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            elapsed = time.perf_counter() - started
+            in_progress.dec()
+            # FastAPI puts the matched route in the scope; its template bounds the label's values
+            route = getattr(scope.get("route"), "path", UNMATCHED_ROUTE)
+            http_requests.labels(method, route, str(status)).inc()
+            http_request_duration.labels(method, route).observe(elapsed)
+            http_request_size.labels(method, route).observe(request_bytes)
+            http_response_size.labels(method, route).observe(response_bytes)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self):
+        # Succeeded/failed events do not name the collection; remember it from the started event
+        self._collections: Dict[Tuple[int, object], str] = {}
+
+    @staticmethod
+    def _collection(event: monitoring.CommandStartedEvent) -> str:
+        if event.command_name == "getMore":
+            return str(event.command.get("collection", ""))
+        target = event.command.get(event.command_name)
+        # Database-level commands (ping, aggregate: 1, ...) have no collection
+        return target if isinstance(target, str) else ""
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        self._collections[(event.request_id, event.connection_id)] = self._collection(event)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        collection = self._collections.pop((event.request_id, event.connection_id), "")
+        mongo_command_duration.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        collection = self._collections.pop((event.request_id, event.connection_id), "")
+        mongo_command_duration.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        mongo_command_failures.labels(collection, event.command_name).inc()
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Checkout blocks the thread that asked for the connection, so a thread-local start time pairs the events."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event) -> None:
+        self._local.started = time.perf_counter()
+
+    def _waited(self) -> None:
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            mongo_pool_wait.observe(time.perf_counter() - started)
+            self._local.started = None
+
+    def connection_checked_out(self, event) -> None:
+        self._waited()
+        mongo_connections_checked_out.inc()
+
+    def connection_check_out_failed(self, event) -> None:
+        self._waited()
+
+    def connection_checked_in(self, event) -> None:
+        mongo_connections_checked_out.dec()
+
+    # The remaining pool events are not measured
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def connection_created(self, event) -> None:
+        pass
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_closed(self, event) -> None:
+        pass
+
+
+LISTENERS = [MongoCommandListener(), MongoPoolListener()]
+
+
+def render() -> Tuple[bytes, str]:
+    """The current metrics in the Prometheus text format, and its content type."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
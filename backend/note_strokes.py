@@ -0,0 +1,152 @@
+"""
+Append-only vector stroke log for notes.
+
+Instead of re-uploading the whole canvas for every stroke, a client can append packed
+stroke batches (see strokes.py) to a note. Each append is one $push onto the note's
+stroke_log array, so the write and the upload are the size of the new strokes only.
+
+Batches must come in time order: one that starts before the note's strokes end is
+refused, since the packed format cannot go back in time (its deltas are unsigned).
+
+Once the log passes a size threshold, a "compact_strokes" background job (see jobs.py)
+folds it into the note's snapshot:
+
+    strokes_hash    blob store key of the merged packed vector (every compacted stroke)
+    content_hash    the canvas, re-rendered with the log strokes drawn on top
+
+Both are content-addressed blobs, so the snapshot stays out of the note document.
+The full vector of a note is always the snapshot followed by whatever is still in
+the log.
+"""
+
+import os
+from typing import List, Optional, Tuple
+
+import blobs
+import jobs
+import raster
+import strokes
+import thumbnails
+from repository import NoteRepository
+
+COMPACT_AFTER_POINTS = int(os.getenv("STROKE_LOG_COMPACT_POINTS", "20000"))
+COMPACT_AFTER_BATCHES = int(os.getenv("STROKE_LOG_COMPACT_BATCHES", "64"))
+# Folds started over when the note changed under one, before the job gives up
+COMPACT_ATTEMPTS = 3
+
+
+class StrokesOutOfOrder(ValueError):
+    pass
+
+
+def needs_compaction(log_state: dict) -> bool:
+    return (log_state.get("stroke_log_points", 0) >= COMPACT_AFTER_POINTS or
+            log_state.get("stroke_log_length", 0) >= COMPACT_AFTER_BATCHES)
+
+
+async def load_snapshot(store: blobs.BlobStore, doc: dict) -> Optional[strokes.StrokeColumns]:
+    if not doc.get("strokes_hash"):
+        return None
+    return strokes.decode(await store.read(doc["strokes_hash"]))
+
+
+async def read_vector(repo: NoteRepository, store: blobs.BlobStore, note_id: str, user_id: str) -> Optional[Tuple[dict, bytes]]:
+    """The note's stroke state and its full vector (snapshot plus log) as one packed batch."""
+    doc = await repo.get_strokes(note_id, user_id)
+    if doc is None:
+        return None
+    snapshot = await load_snapshot(store, doc)
+    log = doc.get("stroke_log") or []
+    if not log and doc.get("strokes_hash"):
+        return doc, await store.read(doc["strokes_hash"])
+    batches = ([snapshot] if snapshot is not None else []) + [strokes.decode(chunk) for chunk in log]
+    return doc, strokes.encode(strokes.concat(batches))
+
+
+async def append(repo: NoteRepository, store: blobs.BlobStore, note_id: str, user_id: str,
+                 payload: bytes, columns: strokes.StrokeColumns) -> Optional[dict]:
+    """
+    Append a decoded batch to the note's stroke log. Returns the log state as
+    NoteRepository.append_strokes does, or None if there is no such note. Raises
+    StrokesOutOfOrder if the batch starts before the note's strokes end.
+    """
+    if not len(columns):
+        return await repo.append_strokes(note_id, user_id, payload, 0)
+    start_ts, end_ts = int(columns.timestamp[0]), int(columns.timestamp[-1])
+    for attempt in range(2):
+        log_state = await repo.append_strokes(note_id, user_id, payload, len(columns), start_ts, end_ts)
+        if log_state is not None:
+            return log_state
+        doc = await repo.get_strokes(note_id, user_id)
+        if doc is None:
+            return None
+        if "strokes_end_ts" in doc or attempt:
+            break
+        # Strokes stored before their end was recorded: find it once, then try again
+        snapshot = await load_snapshot(store, doc)
+        batches = ([snapshot] if snapshot is not None else []) + [strokes.decode(chunk) for chunk in doc.get("stroke_log") or []]
+        ends = [int(batch.timestamp[-1]) for batch in batches if len(batch)]
+        await repo.set_strokes_end_ts(note_id, user_id, max(ends, default=start_ts))
+    raise StrokesOutOfOrder("Strokes must not start before the note's existing strokes end")
+
+
+def fold(log: List[bytes], snapshot: Optional[bytes], base: Optional[bytes]) -> Tuple[bytes, bytes, int, int]:
+    """
+    The CPU side of a compaction, run on the job process pool: merge the log into the
+    snapshot vector and draw its strokes over the canvas. Returns the packed merged
+    vector, the new canvas PNG, and the number of points in the vector and folded into it.
+    """
+    batches = [strokes.decode(chunk) for chunk in log]
+    previous = [strokes.decode(snapshot)] if snapshot else []
+    snapshot_points = len(previous[0]) if previous else 0
+    merged = strokes.concat(previous + batches)
+    # Only the new strokes are drawn; if they continue the snapshot's last stroke, start
+    # from its last sample so the joining segment is drawn too
+    continues = snapshot_points and len(merged) > snapshot_points and \
+        snapshot_points not in set(merged.stroke_starts.tolist())
+    new_strokes = strokes.tail(merged, snapshot_points - 1 if continues else snapshot_points)
+    canvas = raster.render_page(new_strokes, base)
+    return strokes.encode(merged), canvas, len(merged), len(merged) - snapshot_points
+
+
+async def compact(context: jobs.JobContext, params: dict) -> dict:
+    """
+    Job handler: fold the note's current stroke log into its snapshot. If the canvas or
+    snapshot is replaced while the fold runs (a PUT of the note, say), the fold starts
+    over from the new one rather than overwrite it.
+    """
+    repo, store = context.repos.notes, context.store
+    note_id, user_id = params["note_id"], context.job["user_id"]
+    for _ in range(COMPACT_ATTEMPTS):
+        doc = await repo.get_strokes(note_id, user_id)
+        log = [bytes(chunk) for chunk in (doc or {}).get("stroke_log") or []]
+        if not log:
+            return {"compacted": False}
+
+        snapshot = await store.read(doc["strokes_hash"]) if doc.get("strokes_hash") else None
+        # An inline canvas (from before the blob store) is dropped by the update below
+        base = await blobs.read_canvas(store, doc)
+        vector, canvas, total_points, folded_points = await context.run_cpu(fold, log, snapshot, base)
+        snapshot_fields = {
+            "strokes_hash": await store.put(vector, strokes.CONTENT_TYPE),
+            "strokes_points": total_points,
+            "content_hash": await store.put(canvas, "image/png"),
+            "content_type": "image/png",
+            "content_size": len(canvas),
+        }
+        if await repo.compact_strokes(note_id, user_id, len(log), folded_points, snapshot_fields, doc):
+            # The canvas was re-rendered with the folded strokes
+            await thumbnails.refresh(repo, store, context.run_cpu, note_id, user_id)
+            return {"compacted": True, "folded_batches": len(log), "folded_points": folded_points}
+    return {"compacted": False}
+
+
+jobs.register("compact_strokes", compact, submittable=False)
+
+
+async def request_compaction(scheduler: jobs.JobScheduler, note_id: str, user_id: str) -> None:
+    """Queue a compaction of the note, unless one is already queued or running."""
+    await scheduler.submit(
+        user_id, "compact_strokes", {"note_id": note_id},
+        priority=jobs.PRIORITY_LOW, dedupe_key=f"compact_strokes:{note_id}",
+    )
@@ -0,0 +1,66 @@
+"""
+Password hashing off the event loop.
+
+bcrypt is meant to be slow, so every hash and verify runs on a small dedicated thread
+pool (bcrypt releases the GIL while it works). At most PASSWORD_HASH_MAX_PENDING
+operations may be running or queued at once; beyond that the call fails fast with
+HashingOverloaded instead of letting a login storm queue up behind the pool.
+
+The cost factor comes from BCRYPT_ROUNDS. Hashes made with any other cost are
+reported by ``verify`` together with a fresh hash, so they can be upgraded on login.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(HASH_WORKERS * 4)))
+
+# min and max pinned to the configured cost: any hash made with another cost needs an update
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="bcrypt")
+_pending = 0
+
+
+class HashingOverloaded(RuntimeError):
+    pass
+
+
+async def _run(func, *args):
+    global _pending
+    if _pending >= MAX_PENDING:
+        raise HashingOverloaded("Too many password operations in progress")
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _pending -= 1
+
+
+def pending() -> int:
+    """Password operations currently running or waiting for a worker."""
+    return _pending
+
+
+async def hash_password(password: str) -> str:
+    return await _run(pwd_context.hash, password)
+
+
+async def verify_password(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """
+    Check ``password`` against ``hashed``. Returns (valid, new_hash), where new_hash is
+    set when the password is valid but was hashed with an outdated cost or scheme.
+    """
+    return await _run(pwd_context.verify_and_update, password, hashed)
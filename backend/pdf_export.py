@@ -0,0 +1,331 @@
+"""
+Server-side PDF export of notes, streamed page by page.
+
+reportlab builds the whole document in memory before writing any of it, so this module
+writes the PDF itself, one object at a time: the header goes out first, then every
+page (canvas image, text and page object) as soon as it is laid out, and the shared
+objects (font, page tree, catalog, cross-reference table) at the end. PDF lets pages
+point at objects written later, so only object offsets and the set of glyphs used are
+kept across pages, whatever the number of notes.
+
+The font is embedded as a subset of the glyphs the document uses, made by reportlab
+once the last page is out. Pages name glyphs by their id in the full font, and a
+CIDToGIDMap maps those ids to the subset's.
+
+Each note gets its title, its canvas scaled to the page width, and its OCR text,
+continued on further pages if needed. A canvas that is not an image PIL can read is
+left out, rather than breaking a document whose first pages have already gone out.
+Text is set in an embedded TrueType font (PDF_FONT_PATH, DejaVu Sans by default) so
+Cyrillic comes out right and stays searchable.
+"""
+
+import io
+import logging
+import os
+import zlib
+from functools import lru_cache
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+from reportlab.pdfbase.ttfonts import TTFontFile
+from starlette.concurrency import run_in_threadpool
+
+import blobs
+from repository import NoteRepository
+
+logger = logging.getLogger(__name__)
+
+FONT_PATH = os.getenv("PDF_FONT_PATH", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+
+# A4 in points, with the 20 mm margins the web client's jsPDF export used
+PAGE_WIDTH, PAGE_HEIGHT = 595.28, 841.89
+MARGIN = 56.69
+CONTENT_WIDTH = PAGE_WIDTH - 2 * MARGIN
+TITLE_SIZE = 16
+TEXT_SIZE = 12
+LEADING = 1.35
+# The canvas never takes more than this share of the first page of a note
+MAX_IMAGE_HEIGHT = (PAGE_HEIGHT - 2 * MARGIN) * 0.55
+OCR_HEADING = "Распознанный текст:"
+
+# Fixed object numbers for the document-wide objects; pages are numbered from FIRST_PAGE_OBJECT
+CATALOG, PAGES, FONT, CID_FONT, FONT_DESCRIPTOR, FONT_FILE, TO_UNICODE, CID_TO_GID = range(1, 9)
+FIRST_PAGE_OBJECT = 9
+
+
+class Font(NamedTuple):
+    name: bytes
+    file: TTFontFile  # Subset for each document
+    char_to_glyph: Dict[int, int]
+    char_widths: Dict[int, float]  # In 1/1000 em, as PDF wants them
+    default_width: float
+    ascent: float
+    descent: float
+    cap_height: float
+    bbox: List[float]
+    italic_angle: float
+    stem_v: int
+    flags: int
+
+
+@lru_cache(maxsize=None)
+def load_font(path: str = FONT_PATH) -> Font:
+    try:
+        ttf = TTFontFile(path)
+    except (OSError, IOError) as e:
+        raise RuntimeError(f"PDF export font not found at {path}; set PDF_FONT_PATH") from e
+    return Font(
+        name=ttf.name, file=ttf,
+        char_to_glyph=ttf.charToGlyph, char_widths=ttf.charWidths, default_width=ttf.defaultWidth, ascent=ttf.ascent, descent=ttf.descent,
+        cap_height=ttf.capHeight, bbox=ttf.bbox, italic_angle=ttf.italicAngle,
+        stem_v=ttf.stemV, flags=ttf.flags,
+    )
+
+
+def _number(value: float) -> str:
+    return f"{value:.2f}".rstrip("0").rstrip(".")
+
+
+def _open_canvas(canvas: bytes) -> Optional[Image.Image]:
+    """The canvas as RGB on white paper, or None if it is not an image PIL can read."""
+    try:
+        pixels = Image.open(io.BytesIO(canvas))
+        if pixels.mode in ("RGBA", "LA", "P"):
+            # The canvas is transparent where nothing was drawn
+            rgba = pixels.convert("RGBA")
+            pixels = Image.new("RGB", rgba.size, (255, 255, 255))
+            pixels.paste(rgba, mask=rgba.getchannel("A"))
+        return pixels.convert("RGB")
+    except (OSError, Image.DecompressionBombError) as e:
+        logger.warning("Leaving an unreadable canvas out of a PDF export: %s", e)
+        return None
+
+
+class PDFWriter:
+    """Writes a PDF as a sequence of byte chunks; see the module docstring."""
+
+    def __init__(self, font: Font):
+        self.font = font
+        self._offset = 0
+        self._offsets: Dict[int, int] = {}
+        self._next_object = FIRST_PAGE_OBJECT
+        self._pages: List[int] = []
+        self._glyphs: Dict[int, int] = {}  # glyph id -> code point, for widths and ToUnicode
+
+    def _allocate(self) -> int:
+        self._next_object += 1
+        return self._next_object - 1
+
+    def _emit(self, chunks: List[bytes], data: bytes) -> None:
+        chunks.append(data)
+        self._offset += len(data)
+
+    def _object(self, chunks: List[bytes], number: int, body: bytes, stream: Optional[bytes] = None) -> None:
+        self._offsets[number] = self._offset
+        data = b"%d 0 obj\n" % number + body
+        if stream is not None:
+            data += b"\nstream\n" + stream + b"\nendstream"
+        self._emit(chunks, data + b"\nendobj\n")
+
+    def header(self) -> bytes:
+        chunks: List[bytes] = []
+        # The binary comment tells transfer tools the file is not plain text
+        self._emit(chunks, b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        return b"".join(chunks)
+
+    # Text
+
+    def text_width(self, text: str, size: float) -> float:
+        widths = self.font.char_widths
+        return sum(widths.get(ord(char), self.font.default_width) for char in text) * size / 1000
+
+    def wrap(self, text: str, size: float, width: float = CONTENT_WIDTH) -> List[str]:
+        """Greedy word wrap; words wider than a line are broken between characters."""
+        lines = []
+        for paragraph in text.expandtabs(4).splitlines() or [""]:
+            line = ""
+            for word in paragraph.split(" "):
+                candidate = f"{line} {word}" if line else word
+                if self.text_width(candidate, size) <= width:
+                    line = candidate
+                    continue
+                if line:
+                    lines.append(line)
+                line = ""
+                for char in word:
+                    if line and self.text_width(line + char, size) > width:
+                        lines.append(line)
+                        line = ""
+                    line += char
+            lines.append(line)
+        return lines
+
+    def _encode(self, text: str) -> bytes:
+        """Hex string of glyph ids (the font uses Identity-H), remembering which glyphs were used."""
+        glyph_ids = []
+        for char in text:
+            code = ord(char)
+            glyph = self.font.char_to_glyph.get(code, 0)
+            self._glyphs.setdefault(glyph, code)
+            glyph_ids.append(glyph)
+        return b"<" + "".join(f"{glyph:04x}" for glyph in glyph_ids).encode() + b">"
+
+    def _text_ops(self, lines: List[str], size: float, top: float) -> Tuple[bytes, float]:
+        """Content stream operators setting ``lines`` from ``top`` down; returns them and the new top."""
+        ops = []
+        for line in lines:
+            top -= size * LEADING
+            if line:
+                ops.append(b"BT /F1 %s Tf %s %s Td %s Tj ET" % (
+                    _number(size).encode(), _number(MARGIN).encode(), _number(top).encode(), self._encode(line)
+                ))
+        return b"\n".join(ops), top
+
+    # Pages
+
+    def _page(self, content: bytes, image: Optional[Tuple[int, int, bytes]] = None) -> bytes:
+        chunks: List[bytes] = []
+        resources = b"/Font << /F1 %d 0 R >>" % FONT
+        if image is not None:
+            width, height, pixels = image
+            image_object = self._allocate()
+            self._object(chunks, image_object, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+                         b"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode /Length %d >>"
+                         % (width, height, len(pixels)), pixels)
+            resources += b" /XObject << /Im1 %d 0 R >>" % image_object
+        compressed = zlib.compress(content)
+        content_object = self._allocate()
+        self._object(chunks, content_object, b"<< /Filter /FlateDecode /Length %d >>" % len(compressed), compressed)
+        page_object = self._allocate()
+        self._object(chunks, page_object, b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %s %s] "
+                     b"/Resources << %s >> /Contents %d 0 R >>"
+                     % (PAGES, _number(PAGE_WIDTH).encode(), _number(PAGE_HEIGHT).encode(), resources, content_object))
+        self._pages.append(page_object)
+        return b"".join(chunks)
+
+    def note_pages(self, title: str, text: Optional[str], canvas: Optional[bytes]) -> List[bytes]:
+        """Lay out one note and return its pages, ready to send."""
+        ops, top = self._text_ops(self.wrap(title or "", TITLE_SIZE), TITLE_SIZE, PAGE_HEIGHT - MARGIN)
+        page_ops = [ops]
+        image = None
+        pixels = _open_canvas(canvas) if canvas else None
+        if pixels is not None:
+            scale = min(CONTENT_WIDTH / pixels.width, MAX_IMAGE_HEIGHT / pixels.height)
+            width, height = pixels.width * scale, pixels.height * scale
+            top -= TEXT_SIZE * (LEADING - 1) + height
+            page_ops.append(b"q %s 0 0 %s %s %s cm /Im1 Do Q" % (
+                _number(width).encode(), _number(height).encode(), _number(MARGIN).encode(), _number(top).encode()
+            ))
+            image = (pixels.width, pixels.height, zlib.compress(pixels.tobytes()))
+
+        pages = []
+        lines = [OCR_HEADING] + self.wrap(text, TEXT_SIZE) if text else []
+        while True:
+            fit = max(0, int((top - MARGIN) // (TEXT_SIZE * LEADING)))
+            ops, top = self._text_ops(lines[:fit], TEXT_SIZE, top)
+            page_ops.append(ops)
+            pages.append(self._page(b"\n".join(page_ops), image))
+            lines, image = lines[fit:], None
+            if not lines:
+                return pages
+            page_ops, top = [], PAGE_HEIGHT - MARGIN
+
+    # Document-wide objects
+
+    def _to_unicode(self) -> bytes:
+        entries = []
+        for glyph, code in sorted(self._glyphs.items()):
+            char = chr(code).encode("utf-16-be").hex()
+            entries.append(f"<{glyph:04x}> <{char}>")
+        blocks = []
+        for i in range(0, len(entries), 100):
+            block = entries[i:i + 100]
+            blocks.append(f"{len(block)} beginbfchar\n" + "\n".join(block) + "\nendbfchar")
+        return (
+            "/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n"
+            "/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def\n"
+            "/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n"
+            "1 begincodespacerange\n<0000> <FFFF>\nendcodespacerange\n"
+            + "\n".join(blocks) +
+            "\nendcmap\nCMapName currentdict /CMap defineresource pop\nend\nend"
+        ).encode()
+
+    def _subset(self) -> Tuple[bytes, bytes, bytes]:
+        """The embedded font file for the glyphs used, its CIDToGIDMap, and a subset tag for its name."""
+        glyphs = sorted(self._glyphs.items())
+        codes = [code for _, code in glyphs]
+        # makeSubset numbers the glyphs of ``codes`` in order of first use, after glyph 0
+        new_ids = {0: 0}
+        for code in codes:
+            new_ids.setdefault(self.font.char_to_glyph.get(code, 0), len(new_ids))
+        # Not thread-safe (TTFontFile seeks in a shared buffer); finish() runs on the event loop
+        data = self.font.file.makeSubset(codes)
+
+        cid_to_gid = bytearray(2 * (glyphs[-1][0] + 1 if glyphs else 1))
+        for glyph, _ in glyphs:
+            cid_to_gid[2 * glyph:2 * glyph + 2] = new_ids[glyph].to_bytes(2, "big")
+        digest = zlib.crc32(b"".join(glyph.to_bytes(2, "big") for glyph, _ in glyphs))
+        tag = "".join(chr(ord("A") + digest // 26 ** i % 26) for i in range(6)).encode()
+        return data, bytes(cid_to_gid), tag
+
+    def finish(self) -> bytes:
+        """The font, page tree, catalog and cross-reference table that close the document."""
+        font = self.font
+        chunks: List[bytes] = []
+        font_file, cid_to_gid, tag = self._subset()
+        name = tag + b"+" + font.name
+        widths = " ".join(
+            f"{glyph} [{_number(font.char_widths.get(code, font.default_width))}]"
+            for glyph, code in sorted(self._glyphs.items())
+        )
+        self._object(chunks, FONT, b"<< /Type /Font /Subtype /Type0 /BaseFont /%s /Encoding /Identity-H "
+                     b"/DescendantFonts [%d 0 R] /ToUnicode %d 0 R >>" % (name, CID_FONT, TO_UNICODE))
+        self._object(chunks, CID_FONT, b"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /%s "
+                     b"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> "
+                     b"/FontDescriptor %d 0 R /DW %d /W [%s] /CIDToGIDMap %d 0 R >>"
+                     % (name, FONT_DESCRIPTOR, round(font.default_width), widths.encode(), CID_TO_GID))
+        self._object(chunks, FONT_DESCRIPTOR, b"<< /Type /FontDescriptor /FontName /%s /Flags %d "
+                     b"/FontBBox [%s] /ItalicAngle %s /Ascent %s /Descent %s /CapHeight %s /StemV %d "
+                     b"/FontFile2 %d 0 R >>" % (
+                         name, font.flags, " ".join(_number(v) for v in font.bbox).encode(),
+                         _number(font.italic_angle).encode(), _number(font.ascent).encode(),
+                         _number(font.descent).encode(), _number(font.cap_height).encode(),
+                         font.stem_v, FONT_FILE,
+                     ))
+        compressed = zlib.compress(font_file)
+        self._object(chunks, FONT_FILE, b"<< /Filter /FlateDecode /Length %d /Length1 %d >>"
+                     % (len(compressed), len(font_file)), compressed)
+        compressed = zlib.compress(cid_to_gid)
+        self._object(chunks, CID_TO_GID, b"<< /Filter /FlateDecode /Length %d >>" % len(compressed), compressed)
+        to_unicode = zlib.compress(self._to_unicode())
+        self._object(chunks, TO_UNICODE, b"<< /Filter /FlateDecode /Length %d >>" % len(to_unicode), to_unicode)
+        kids = " ".join(f"{page} 0 R" for page in self._pages).encode()
+        self._object(chunks, PAGES, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self._pages)))
+        self._object(chunks, CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % PAGES)
+
+        xref_offset = self._offset
+        size = self._next_object
+        xref = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        xref += [b"%010d 00000 n \n" % self._offsets[number] for number in range(1, size)]
+        self._emit(chunks, b"".join(xref))
+        self._emit(chunks, b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, CATALOG, xref_offset))
+        return b"".join(chunks)
+
+
+async def export_notes(repo: NoteRepository, store: blobs.BlobStore, user_id: str, note_ids: List[str]) -> AsyncIterator[bytes]:
+    """Yield a PDF of the given notes, in order, one page at a time. Notes deleted meanwhile are skipped."""
+    writer = PDFWriter(load_font())
+    yield writer.header()
+    for note_id in note_ids:
+        note = await repo.get(note_id, user_id)
+        if note is None:
+            continue
+        try:
+            canvas = await blobs.read_canvas(store, note)
+        except ValueError:
+            # An inline canvas that is not even base64
+            canvas = None
+        pages = await run_in_threadpool(writer.note_pages, note.get("title", ""), note.get("text_content"), canvas)
+        for page in pages:
+            yield page
+    yield writer.finish()
@@ -0,0 +1,101 @@
+"""
+Cache of authenticated principals, so resolving a bearer token does not cost a Mongo
+round-trip on every request.
+
+Entries are keyed by username (the token's "sub") and expire after a TTL kept below
+the token lifetime, so a deleted or changed user stops being served from the cache
+within that bound even without explicit invalidation. Call ``invalidate`` whenever a
+user document changes to make it immediate.
+
+The PrincipalCache interface is async so a shared backend (e.g. Redis, for several
+Gunicorn workers) can implement it later. Pick one with PRINCIPAL_CACHE. Hits, misses
+and the number of entries are exported as Prometheus metrics (see metrics.py).
+"""
+
+import abc
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import metrics
+
+# Never keep the password hash around longer than the login that needs it
+PRIVATE_FIELDS = ("password",)
+
+
+def principal(user: dict) -> dict:
+    """The user document as handed to the routes: everything but the private fields."""
+    return {key: value for key, value in user.items() if key not in PRIVATE_FIELDS}
+
+
+class PrincipalCache(abc.ABC):
+    @abc.abstractmethod
+    async def get(self, username: str) -> Optional[dict]:
+        ...
+
+    @abc.abstractmethod
+    async def put(self, username: str, user: dict) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def invalidate(self, username: str) -> None:
+        ...
+
+
+class NullPrincipalCache(PrincipalCache):
+    """Caches nothing: every request reads the user from Mongo, as before."""
+
+    async def get(self, username: str) -> Optional[dict]:
+        metrics.principal_cache_lookups.labels("miss").inc()
+        return None
+
+    async def put(self, username: str, user: dict) -> None:
+        pass
+
+    async def invalidate(self, username: str) -> None:
+        pass
+
+
+class MemoryPrincipalCache(PrincipalCache):
+    """A per-process LRU of principals whose entries expire ``ttl`` seconds after being stored."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+    async def get(self, username: str) -> Optional[dict]:
+        entry = self._entries.get(username)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[username]
+                metrics.principal_cache_entries.set(len(self._entries))
+            metrics.principal_cache_lookups.labels("miss").inc()
+            return None
+        self._entries.move_to_end(username)
+        metrics.principal_cache_lookups.labels("hit").inc()
+        return entry[1]
+
+    async def put(self, username: str, user: dict) -> None:
+        self._entries[username] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        metrics.principal_cache_entries.set(len(self._entries))
+
+    async def invalidate(self, username: str) -> None:
+        self._entries.pop(username, None)
+        metrics.principal_cache_entries.set(len(self._entries))
+
+
+def create_cache(token_lifetime_seconds: int) -> PrincipalCache:
+    backend = os.getenv("PRINCIPAL_CACHE", "memory")
+    if backend == "none":
+        return NullPrincipalCache()
+    if backend == "memory":
+        ttl = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+        # However it is configured, a stale principal is served for well under a token's lifetime
+        ttl = min(ttl, token_lifetime_seconds / 2)
+        return MemoryPrincipalCache(int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", "10000")), ttl)
+    raise RuntimeError(f"Unknown PRINCIPAL_CACHE backend: {backend}")
@@ -0,0 +1,273 @@
+"""
+Opt-in profiling of single requests, to find out where a slow request spends its time.
+
+A request is profiled when it carries ``X-Profile: <PROFILE_TOKEN>`` (nothing happens
+without a token configured), or at random with probability PROFILE_SAMPLE_RATE. At
+most one request per process is profiled at a time; others run as usual.
+
+Two profilers are available, chosen with PROFILE_MODE or the ``X-Profile-Mode`` header:
+
+    sample         a thread samples the event loop's stack every PROFILE_SAMPLE_INTERVAL_MS
+                   and the counts are written as collapsed stacks (``.collapsed``), the
+                   input format of flamegraph.pl, inferno and speedscope
+    deterministic  cProfile, written as pstats (``.prof``) for snakeviz or flameprof
+
+Both observe the whole event loop thread, so requests served concurrently show up in
+the profile too; work handed to a thread pool shows up as the loop waiting. The sampler
+needs the GIL to take a sample, so a request of a few milliseconds may come back with
+no samples at all; profile those in deterministic mode.
+
+Profiles go to PROFILE_DIR, which keeps the newest PROFILE_MAX_FILES. The response names
+the file in ``X-Profile-Id`` and breaks the request's time down in ``Server-Timing``:
+
+    auth           resolving the bearer token to a user
+    db             Mongo commands, as timed by the driver (also counted in the phase that issued them)
+    validation     parsing and validating the request, other than auth
+    serialization  turning the endpoint's result into the response body
+    total          until the response headers were sent
+"""
+
+import asyncio
+import cProfile
+import functools
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, Optional
+
+from fastapi.routing import APIRoute
+from pymongo import monitoring
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+MODE = os.getenv("PROFILE_MODE", "sample")
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "1")) / 1000
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/app/profiles")
+MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+PHASES = ("auth", "db", "validation", "serialization")
+
+
+class Timings:
+    """Seconds spent per phase by one request. Mongo events arrive on executor threads, hence the lock."""
+
+    def __init__(self):
+        self.phases: Dict[str, float] = defaultdict(float)
+        self.endpoint_started: Optional[float] = None
+        self.endpoint_finished: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self.phases[phase] += seconds
+
+    def handled(self, started: float, finished: float) -> None:
+        """Split the route handler's own time around the endpoint call into validation and serialization."""
+        entered = self.endpoint_started or finished
+        left = self.endpoint_finished or finished
+        self.add("validation", max(0.0, entered - started - self.phases["auth"]))
+        self.add("serialization", finished - left)
+
+    def header(self, total: float) -> str:
+        durations = [(phase, self.phases[phase]) for phase in PHASES] + [("total", total)]
+        return ", ".join(f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in durations)
+
+
+# Only set while a profiled request is being handled; everything below is a no-op otherwise
+_timings: ContextVar[Optional[Timings]] = ContextVar("profiling_timings", default=None)
+
+
+@contextmanager
+def phase(name: str):
+    """Count the time spent in the block towards ``name`` in the current request's breakdown."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+
+class DatabaseTimer(monitoring.CommandListener):
+    """Adds Mongo command durations to the breakdown. Motor runs commands in a copy of the caller's context."""
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        timings = _timings.get()
+        if timings is not None:
+            timings.add("db", event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self.succeeded(event)
+
+
+class ProfiledRoute(APIRoute):
+    """Marks when the endpoint itself starts and finishes, so the handler's time around it can be attributed."""
+
+    def get_route_handler(self):
+        call = self.dependant.call
+        if asyncio.iscoroutinefunction(call):
+            @functools.wraps(call)
+            async def endpoint(*args, **kwargs):
+                timings = _timings.get()
+                if timings is None:
+                    return await call(*args, **kwargs)
+                timings.endpoint_started = time.perf_counter()
+                try:
+                    return await call(*args, **kwargs)
+                finally:
+                    timings.endpoint_finished = time.perf_counter()
+            self.dependant.call = endpoint
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            timings = _timings.get()
+            if timings is None:
+                return await handler(request)
+            started = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                timings.handled(started, time.perf_counter())
+
+        return timed_handler
+
+
+class StackSampler:
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def save(self, path: str) -> str:
+        path += ".collapsed"
+        with open(path, "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in self.stacks.items())
+        return path
+
+
+class DeterministicProfiler:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self) -> None:
+        self.profile.enable()
+
+    def stop(self) -> None:
+        self.profile.disable()
+
+    def save(self, path: str) -> str:
+        path += ".prof"
+        self.profile.dump_stats(path)
+        return path
+
+
+def create_profiler(mode: str):
+    if mode == "deterministic":
+        return DeterministicProfiler()
+    return StackSampler(threading.get_ident())
+
+
+def save(profiler, name: str) -> str:
+    """Write the profile, then delete the oldest ones beyond MAX_FILES. Runs on the thread pool."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = profiler.save(os.path.join(PROFILE_DIR, name))
+    with os.scandir(PROFILE_DIR) as entries:
+        profiles = sorted((entry for entry in entries if entry.is_file()), key=lambda entry: entry.stat().st_mtime)
+    for entry in profiles[:max(0, len(profiles) - MAX_FILES)]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+    return path
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.active = False
+
+    def _requested(self, scope) -> Optional[str]:
+        """The profiler mode if this request should be profiled, else None."""
+        headers = dict(scope["headers"])
+        token = headers.get(b"x-profile")
+        if token is not None and PROFILE_TOKEN and hmac.compare_digest(token, PROFILE_TOKEN.encode()):
+            return headers.get(b"x-profile-mode", MODE.encode()).decode("latin-1")
+        if SAMPLE_RATE and random.random() < SAMPLE_RATE:
+            return MODE
+        return None
+
+    async def __call__(self, scope, receive, send):
+        mode = self._requested(scope) if scope["type"] == "http" and not self.active else None
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+
+        self.active = True
+        timings = Timings()
+        token = _timings.set(timings)
+        profiler = create_profiler(mode)
+        name = None
+        started = time.perf_counter()
+
+        async def profiled_send(message):
+            nonlocal name
+            if message["type"] == "http.response.start":
+                route = getattr(scope.get("route"), "path", scope["path"])
+                name = "-".join((
+                    datetime.utcnow().strftime("%Y%m%dT%H%M%S"), scope["method"],
+                    re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_"), uuid.uuid4().hex[:8],
+                ))
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timings.header(time.perf_counter() - started).encode()))
+                headers.append((b"x-profile-id", name.encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, profiled_send)
+        finally:
+            profiler.stop()
+            _timings.reset(token)
+            self.active = False
+            if name is not None:
+                path = await run_in_threadpool(save, profiler, name)
+                logger.info("Profiled %s %s: %s", scope["method"], scope["path"], path)
@@ -0,0 +1,202 @@
+"""
+Server-side rendering of stored pen strokes into fixed-size PNG tiles.
+
+The 0..4096 pen coordinate space is rendered as a square page of TILE_SIZE * 2**zoom
+pixels, cut into TILE_SIZE tiles. Line width follows the pen pressure the same way
+DrawingCanvas.drawPoint does, scaled with the zoom level. Rendered tiles are kept in
+an LRU cache keyed by session, stroke version and tile, so panning over a big page
+only ever renders the tiles in view once.
+
+render_page draws strokes straight onto a note canvas, for stroke log compaction, and
+the "rasterize_session" job renders a whole session page in the background.
+"""
+
+import io
+import os
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import numpy as np
+from PIL import Image, ImageDraw
+from starlette.concurrency import run_in_threadpool
+
+import jobs
+import sessions
+import strokes
+from repository import BluetoothRepository
+
+PEN_SPACE = 4096
+TILE_SIZE = 256
+MAX_ZOOM = 4
+# DrawingCanvas draws max(1, pressure / 255 * 5) px wide lines; treat that as the width at this page size
+MAX_LINE_WIDTH = 5
+REFERENCE_PAGE_PX = 1024
+INK_COLOR = (0, 0, 0, 255)
+
+
+class LRUCache:
+    """A bounded least-recently-used cache with hit/miss counters."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, object]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[object]:
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: object) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+tile_cache = LRUCache(int(os.getenv("TILE_CACHE_MAX_ENTRIES", "2048")))
+# Decoded sessions, so rendering the tiles of one page does not decode it once per tile
+session_cache = LRUCache(int(os.getenv("TILE_SESSION_CACHE_MAX_ENTRIES", "32")))
+
+
+def valid_tile(zoom: int, tile_x: int, tile_y: int) -> bool:
+    tiles = 2 ** zoom
+    return 0 <= zoom <= MAX_ZOOM and 0 <= tile_x < tiles and 0 <= tile_y < tiles
+
+
+def render_tile(columns: strokes.StrokeColumns, zoom: int, tile_x: int, tile_y: int) -> bytes:
+    """Render one tile of a session's strokes as a transparent PNG."""
+    image = Image.new("RGBA", (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+
+    page_px = TILE_SIZE * 2 ** zoom
+    scale = page_px / PEN_SPACE
+    width_scale = MAX_LINE_WIDTH * page_px / REFERENCE_PAGE_PX / 255
+    # Pen-space bounds of this tile, padded by the widest possible line
+    pad = MAX_LINE_WIDTH * PEN_SPACE / REFERENCE_PAGE_PX
+    tile_pen = TILE_SIZE / scale
+    left, top = tile_x * tile_pen - pad, tile_y * tile_pen - pad
+    right, bottom = left + tile_pen + 2 * pad, top + tile_pen + 2 * pad
+
+    bounds = strokes.stroke_bounds(columns)
+    if not bounds:
+        return _png(image)
+    starts = np.array([start for start, _ in bounds])
+    x = columns.x.astype(np.float64)
+    y = columns.y.astype(np.float64)
+    visible = (
+        (np.maximum.reduceat(x, starts) >= left) & (np.minimum.reduceat(x, starts) <= right) &
+        (np.maximum.reduceat(y, starts) >= top) & (np.minimum.reduceat(y, starts) <= bottom)
+    )
+
+    px = x * scale - tile_x * TILE_SIZE
+    py = y * scale - tile_y * TILE_SIZE
+    widths = np.maximum(1.0, columns.pressure * width_scale)
+    for (start, end), is_visible in zip(bounds, visible):
+        if not is_visible:
+            continue
+        _draw_stroke(draw, px[start:end], py[start:end], widths[start:end])
+    return _png(image)
+
+
+def render_page(columns: strokes.StrokeColumns, base: Optional[bytes] = None,
+                size: int = REFERENCE_PAGE_PX, line_scale: float = 1.0) -> bytes:
+    """
+    Draw strokes over a whole note canvas (a blank ``size`` px page if ``base`` is None)
+    and return it as a PNG. The pen space is stretched over the canvas size, and lines are
+    ``line_scale`` times as wide as DrawingCanvas.drawPoint would draw them.
+    """
+    if base:
+        image = Image.open(io.BytesIO(base)).convert("RGBA")
+    else:
+        image = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    width, height = image.size
+    px = columns.x.astype(np.float64) * (width / PEN_SPACE)
+    py = columns.y.astype(np.float64) * (height / PEN_SPACE)
+    widths = np.maximum(1.0, columns.pressure * (MAX_LINE_WIDTH * line_scale / 255))
+    for start, end in strokes.stroke_bounds(columns):
+        _draw_stroke(draw, px[start:end], py[start:end], widths[start:end])
+    return _png(image)
+
+
+def render_session_page(packed: bytes, zoom: int) -> bytes:
+    """A session's whole page at ``zoom`` as one PNG, lines scaled as on its tiles. Runs on the job process pool."""
+    page_px = TILE_SIZE * 2 ** zoom
+    return render_page(strokes.decode(packed), size=page_px, line_scale=page_px / REFERENCE_PAGE_PX)
+
+
+def _draw_stroke(draw: ImageDraw.ImageDraw, px: np.ndarray, py: np.ndarray, widths: np.ndarray) -> None:
+    points = list(zip(px.tolist(), py.tolist()))
+    for i, ((x, y), width) in enumerate(zip(points, widths.tolist())):
+        # Round caps at every sample hide the seams between segments of different width
+        r = width / 2
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=INK_COLOR)
+        if i:
+            draw.line((points[i - 1], (x, y)), fill=INK_COLOR, width=max(1, round(width)))
+
+
+def _png(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=False)
+    return buffer.getvalue()
+
+
+def session_version(header: dict) -> float:
+    """A value that changes whenever the session's strokes change."""
+    return (header.get("updated_at") or header["created_at"]).timestamp()
+
+
+async def session_columns(repo: BluetoothRepository, header: dict, session_key: tuple) -> strokes.StrokeColumns:
+    """The decoded strokes of a session, from session_cache if this version was decoded before."""
+    columns = session_cache.get(session_key)
+    if columns is None:
+        columns = await sessions.columns(repo, header)
+        session_cache.put(session_key, columns)
+    return columns
+
+
+async def get_tile(repo: BluetoothRepository, session_id: str, user_id: str,
+                   zoom: int, tile_x: int, tile_y: int) -> Optional[bytes]:
+    """Return the PNG for one tile, rendering it only on a cache miss. None if the session does not exist."""
+    header = await repo.get_header(session_id, user_id)
+    if header is None:
+        return None
+    session_key = (user_id, session_id, session_version(header))
+    tile_key = session_key + (zoom, tile_x, tile_y)
+    tile = tile_cache.get(tile_key)
+    if tile is not None:
+        return tile
+
+    columns = await session_columns(repo, header, session_key)
+    tile = await run_in_threadpool(render_tile, columns, zoom, tile_x, tile_y)
+    tile_cache.put(tile_key, tile)
+    return tile
+
+
+async def rasterize_session_job(context: jobs.JobContext, params: dict) -> dict:
+    """Job handler: render a stored session to a single PNG in the blob store."""
+    zoom = int(params.get("zoom", 2))
+    if not 0 <= zoom <= MAX_ZOOM:
+        raise ValueError(f"zoom must be between 0 and {MAX_ZOOM}")
+    if not params.get("session_id"):
+        raise ValueError("session_id is required")
+    repo = context.repos.bluetooth
+    header = await repo.get_header(params["session_id"], context.job["user_id"])
+    if header is None:
+        raise LookupError("Bluetooth data not found")
+    packed = b"".join([piece async for piece in sessions.packed(repo, header)])
+    png = await context.run_cpu(render_session_page, packed, zoom)
+    return {"blob": await context.store.put(png, "image/png"), "content_type": "image/png", "size": len(png)}
+
+
+jobs.register("rasterize_session", rasterize_session_job)
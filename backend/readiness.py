@@ -0,0 +1,91 @@
+"""
+Readiness probe and graceful drain, so rolling restarts do not drop requests.
+
+/api/ready tells the load balancer whether this worker should get traffic. It pings
+Mongo, but caches the answer for READY_CACHE_SECONDS (concurrent probes share one ping),
+so a balancer polling every worker does not add a Mongo round trip per poll.
+
+With SHUTDOWN_DRAIN_SECONDS set, a worker that receives SIGTERM first drains: it keeps
+serving, but reports not ready so the balancer takes it out of rotation, and only then
+shuts down the way uvicorn does on SIGINT (stop accepting connections, finish the
+requests in flight, run the lifespan shutdown). A second SIGTERM skips the rest of the
+wait. Set it to at least the balancer's probe interval times its failure threshold, and
+give Gunicorn a --graceful-timeout longer than the drain plus the slowest request.
+Without it, SIGTERM stops the worker straight away.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import time
+from typing import Optional, Tuple
+
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+CACHE_SECONDS = float(os.getenv("READY_CACHE_SECONDS", "2"))
+PING_TIMEOUT_SECONDS = float(os.getenv("READY_PING_TIMEOUT_SECONDS", "2"))
+DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "0"))
+
+
+class Readiness:
+    def __init__(self, cache_seconds: float = CACHE_SECONDS, drain_seconds: float = DRAIN_SECONDS):
+        self.cache_seconds = cache_seconds
+        self.drain_seconds = drain_seconds
+        self.draining = False
+        self._status: Tuple[bool, str] = (False, "starting")
+        self._checked_at = float("-inf")
+        self._ping: Optional[asyncio.Future] = None
+        self._shutdown: Optional[asyncio.TimerHandle] = None
+
+    async def check(self, client) -> Tuple[bool, str]:
+        """(ready, reason). ``client`` is None until the lifespan has connected."""
+        if self.draining:
+            return False, "draining"
+        if client is None:
+            return False, "starting"
+        if time.monotonic() - self._checked_at >= self.cache_seconds:
+            if self._ping is None:
+                self._ping = asyncio.ensure_future(self._run_ping(client))
+            # One caller giving up must not cancel the ping the others are waiting on
+            await asyncio.shield(self._ping)
+        return self._status
+
+    async def _run_ping(self, client) -> None:
+        try:
+            await asyncio.wait_for(client.admin.command("ping"), PING_TIMEOUT_SECONDS)
+            self._status = (True, "ready")
+        except asyncio.TimeoutError:
+            self._status = (False, "mongo ping timed out")
+        except PyMongoError as e:
+            self._status = (False, f"mongo unavailable: {type(e).__name__}")
+        finally:
+            self._checked_at = time.monotonic()
+            self._ping = None
+
+    def handle_sigterm(self) -> None:
+        """Take SIGTERM over from uvicorn to drain first. Call from the lifespan, after uvicorn set up its handlers."""
+        if self.drain_seconds <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self._on_sigterm, loop)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Only the main thread can handle signals (not the case under a test client)
+            logger.warning("Cannot handle SIGTERM here, shutting down without draining")
+
+    def _on_sigterm(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self._shutdown is not None:
+            self._shutdown.cancel()
+            self._shut_down()
+            return
+        self.draining = True
+        logger.info("SIGTERM: draining for %.0f s before shutting down", self.drain_seconds)
+        self._shutdown = loop.call_later(self.drain_seconds, self._shut_down)
+
+    @staticmethod
+    def _shut_down() -> None:
+        # uvicorn's graceful shutdown; it treats a second SIGINT as "exit now"
+        os.kill(os.getpid(), signal.SIGINT)
@@ -0,0 +1,876 @@
+"""
+Async MongoDB data-access layer for the Smart Pen API.
+
+All database access from the request handlers goes through the repositories
+defined here, so that no route ever blocks the event loop on a Mongo round-trip.
+"""
+
+import base64
+import json
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator, List, Optional, Sequence, Set, Tuple
+
+from bson import Binary
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCursor, AsyncIOMotorDatabase
+from pymongo import DeleteOne, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+DATABASE_NAME = "smartpen_db"
+
+# Never hand Mongo's ObjectId back to the handlers; every document carries its own "id".
+NO_OBJECT_ID = {"_id": 0}
+# Full notes: the pending stroke log is only read through the stroke endpoints
+NOTE_PROJECTION = {"_id": 0, "stroke_log": 0}
+# Listing projection: everything except the base64 canvas blob and the stroke log
+NOTE_SUMMARY_PROJECTION = {"_id": 0, "content": 0, "stroke_log": 0}
+# Thumbnail lookups: the canvas reference and the thumbnail recorded for it
+THUMBNAIL_PROJECTION = {
+    "_id": 0, "id": 1, "content_hash": 1, "content_type": 1,
+    "thumbnail_hash": 1, "thumbnail_type": 1, "thumbnail_source": 1,
+}
+# Session metadata: everything except the stroke payload, whichever way it was stored
+SESSION_HEADER_PROJECTION = {"_id": 0, "stroke_data": 0, "packed": 0, "chunks": 0, "raw_blobs": 0}
+# Sessions whose samples live in bluetooth_chunks rather than in the session document (see sessions.py)
+CHUNKED_STORAGE = "chunked"
+# A live session's last chunk takes appends until it holds this many samples
+SESSION_CHUNK_POINTS = int(os.getenv("SESSION_CHUNK_POINTS", "32768"))
+# Chunks fetched per round-trip when reading a session
+CHUNK_READ_BATCH = 4
+# Largest count $slice accepts, i.e. "everything from here on"
+MAX_INT32 = 2 ** 31 - 1
+# A change sequence value still in flight after this long is taken to belong to a writer that died
+CHANGE_SEQ_LEASE_SECONDS = float(os.getenv("CHANGE_SEQ_LEASE_SECONDS", "60"))
+
+
+def encode_cursor(updated_at: datetime, note_id: str) -> str:
+    """Encode a keyset position as an opaque, URL-safe cursor."""
+    raw = json.dumps({"u": updated_at.isoformat(), "i": note_id}).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Decode a cursor produced by ``encode_cursor``. Raises ValueError if it is malformed."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(data["u"]), str(data["i"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def encode_change_cursor(change_seq: int) -> str:
+    """Encode a change-feed position, stamped with when it was issued."""
+    issued = int(datetime.utcnow().timestamp())
+    return base64.urlsafe_b64encode(json.dumps({"s": change_seq, "t": issued}).encode()).decode()
+
+
+def decode_change_cursor(cursor: str) -> Tuple[int, datetime]:
+    """Decode a cursor produced by ``encode_change_cursor`` into (change_seq, issued_at)."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(data["s"]), datetime.utcfromtimestamp(int(data["t"]))
+    except (KeyError, TypeError, ValueError, OverflowError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def create_client(mongo_url: str, event_listeners: Sequence = ()) -> AsyncIOMotorClient:
+    """
+    Create a Motor client with its pool, timeouts and read preference from the environment.
+    These take precedence over the same options in the URL. Create it in the process that
+    uses it (the pool's sockets and monitor threads do not survive a fork).
+    """
+    options = dict(
+        maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+        minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+        maxConnecting=int(os.getenv("MONGO_MAX_CONNECTING", "2")),
+        maxIdleTimeMS=int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000")),
+        waitQueueTimeoutMS=int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000")),
+        connectTimeoutMS=int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "10000")),
+        serverSelectionTimeoutMS=int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000")),
+        readPreference=os.getenv("MONGO_READ_PREFERENCE", "primary"),
+    )
+    # Unset by default: no limit, as in the driver
+    if os.getenv("MONGO_SOCKET_TIMEOUT_MS"):
+        options["socketTimeoutMS"] = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS"))
+    if os.getenv("MONGO_TIMEOUT_MS"):
+        options["timeoutMS"] = int(os.getenv("MONGO_TIMEOUT_MS"))
+    return AsyncIOMotorClient(mongo_url, event_listeners=list(event_listeners), **options)
+
+
+class UserRepository:
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self.collection = db.users
+
+    async def get_by_username(self, username: str) -> Optional[dict]:
+        return await self.collection.find_one({"username": username}, NO_OBJECT_ID)
+
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        return await self.collection.find_one({"email": email}, NO_OBJECT_ID)
+
+    async def create(self, user_doc: dict) -> None:
+        # insert_one adds "_id" to the dict it is given, so keep the caller's copy clean
+        await self.collection.insert_one(dict(user_doc))
+
+    async def update_password(self, user_id: str, hashed_password: str) -> None:
+        await self.collection.update_one({"id": user_id}, {"$set": {"password": hashed_password}})
+
+
+class NoteRepository:
+    """
+    Notes, plus the per-user change feed: every write stamps the note with the next value
+    of the user's change sequence, and deletes leave a tombstone carrying their own.
+
+    A writer reserves its sequence value before its write, so concurrent writes can land
+    in another order than their values. The counter document therefore lists the values
+    still in flight, and the feed only goes up to the lowest of them: a client reading
+    the feed never skips a change that lands later. A value in flight for longer than
+    CHANGE_SEQ_LEASE_SECONDS is given up on (its writer is taken to have died), so a write
+    that takes longer than that may still be missed.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self.collection = db.notes
+        self.tombstones = db.note_tombstones
+        self.counters = db.counters
+
+    @staticmethod
+    def _counter_id(user_id: str) -> str:
+        return f"note_changes:{user_id}"
+
+    async def _reserve_change_seqs(self, user_id: str, count: int) -> int:
+        """
+        Reserve ``count`` consecutive change sequence values and return the first one. The
+        values are marked in flight in the same update, so the feed holds back from them.
+        """
+        counter_id = self._counter_id(user_id)
+        while True:
+            counter = await self.counters.find_one({"_id": counter_id}, {"seq": 1})
+            in_flight = {"seq": (counter["seq"] if counter else 0) + 1, "at": datetime.utcnow()}
+            if counter is None:
+                try:
+                    await self.counters.insert_one({"_id": counter_id, "seq": count, "in_flight": [in_flight]})
+                    return in_flight["seq"]
+                except DuplicateKeyError:
+                    continue
+            # Compare and swap: another writer may have reserved the same values in the meantime
+            reserved = await self.counters.update_one(
+                {"_id": counter_id, "seq": counter["seq"]},
+                {"$set": {"seq": counter["seq"] + count}, "$push": {"in_flight": in_flight}},
+            )
+            if reserved.modified_count:
+                return in_flight["seq"]
+
+    @asynccontextmanager
+    async def _change_seqs(self, user_id: str, count: int = 1) -> AsyncIterator[int]:
+        """Reserve ``count`` change sequence values for the writes made in the block, which gets the first one."""
+        first = await self._reserve_change_seqs(user_id, count)
+        try:
+            yield first
+        finally:
+            await self.counters.update_one({"_id": self._counter_id(user_id)}, {"$pull": {"in_flight": {"seq": first}}})
+
+    async def _visible_change_seq(self, user_id: str) -> int:
+        """The highest change sequence value below every write still in flight."""
+        counter = await self.counters.find_one({"_id": self._counter_id(user_id)})
+        if counter is None:
+            return 0
+        expired = datetime.utcnow() - timedelta(seconds=CHANGE_SEQ_LEASE_SECONDS)
+        in_flight = [entry["seq"] for entry in counter.get("in_flight", []) if entry["at"] >= expired]
+        if len(in_flight) < len(counter.get("in_flight", [])):
+            await self.counters.update_one({"_id": counter["_id"]}, {"$pull": {"in_flight": {"at": {"$lt": expired}}}})
+        return min(in_flight) - 1 if in_flight else counter["seq"]
+
+    async def list_for_user(self, user_id: str) -> List[dict]:
+        cursor = self.collection.find({"user_id": user_id}, NOTE_PROJECTION)
+        return await cursor.to_list(length=None)
+
+    async def fingerprint(self, user_id: str) -> Tuple[int, Optional[datetime]]:
+        """(note count, latest updated_at): changes on every create, update and delete, read from the index alone."""
+        count = await self.collection.count_documents({"user_id": user_id})
+        latest = await self.collection.find_one(
+            {"user_id": user_id},
+            {"_id": 0, "updated_at": 1},
+            sort=[("updated_at", -1)]
+        )
+        return count, latest["updated_at"] if latest else None
+
+    async def list_summaries(self, user_id: str, limit: int, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Return one page of note metadata, newest first, and the cursor for the next page.
+
+        Pagination is keyset-based on (updated_at, id), so each page costs the same
+        no matter how deep into the listing the client is.
+        """
+        query = {"user_id": user_id}
+        if cursor:
+            updated_at, note_id = decode_cursor(cursor)
+            query["$or"] = [
+                {"updated_at": {"$lt": updated_at}},
+                {"updated_at": updated_at, "id": {"$lt": note_id}},
+            ]
+        docs = await self.collection.find(query, NOTE_SUMMARY_PROJECTION) \
+            .sort([("updated_at", -1), ("id", -1)]) \
+            .limit(limit + 1) \
+            .to_list(length=limit + 1)
+
+        next_cursor = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            next_cursor = encode_cursor(docs[-1]["updated_at"], docs[-1]["id"])
+        return docs, next_cursor
+
+    async def search(self, user_id: str, query: str, limit: int, offset: int = 0) -> List[dict]:
+        """Full-text search over title and OCR text, best matches first. Canvas blobs are never read."""
+        projection = dict(NOTE_SUMMARY_PROJECTION, score={"$meta": "textScore"})
+        cursor = self.collection.find({"user_id": user_id, "$text": {"$search": query}}, projection) \
+            .sort([("score", {"$meta": "textScore"}), ("updated_at", -1)]) \
+            .skip(offset) \
+            .limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def get(self, note_id: str, user_id: str) -> Optional[dict]:
+        return await self.collection.find_one({"id": note_id, "user_id": user_id}, NOTE_PROJECTION)
+
+    async def get_content(self, note_id: str, user_id: str) -> Optional[dict]:
+        return await self.collection.find_one(
+            {"id": note_id, "user_id": user_id},
+            {"_id": 0, "id": 1, "content": 1, "content_hash": 1, "content_type": 1, "updated_at": 1}
+        )
+
+    async def get_thumbnail(self, note_id: str, user_id: str) -> Optional[dict]:
+        return await self.collection.find_one({"id": note_id, "user_id": user_id}, THUMBNAIL_PROJECTION)
+
+    async def move_inline_content(self, note_id: str, user_id: str, content: str, fields: dict) -> bool:
+        """
+        Swap the inline canvas ``content`` (written before the blob store) for ``fields``, the
+        reference to its blob (see blobs.offload_content); a no-op if the canvas changed since.
+        The note still shows the same canvas, so its version stays as it was.
+        """
+        result = await self.collection.update_one(
+            {"id": note_id, "user_id": user_id, "content": content, "content_hash": None},
+            {"$set": fields, "$unset": {"content": ""}},
+        )
+        return result.modified_count == 1
+
+    async def set_thumbnail(self, note_id: str, user_id: str, content_hash: str, fields: dict) -> bool:
+        """Record a thumbnail of the canvas ``content_hash``; a no-op if the note's canvas has changed since."""
+        result = await self.collection.update_one(
+            {"id": note_id, "user_id": user_id, "content_hash": content_hash}, {"$set": fields}
+        )
+        return result.modified_count == 1
+
+    async def stale_thumbnails(self, user_id: str, settings: str, after_id: Optional[str], limit: int) -> List[dict]:
+        """
+        The next ``limit`` notes (by id, after ``after_id``) with a canvas but no thumbnail of
+        it made with ``settings`` (see thumbnails.source). That includes notes whose canvas
+        is still inline, which have no thumbnail at all.
+        """
+        query = {
+            "user_id": user_id,
+            "$and": [
+                {"$or": [{"content_hash": {"$ne": None}}, {"content": {"$nin": [None, ""]}}]},
+                {"$or": [
+                    {"thumbnail_source": {"$exists": False}},
+                    {"$expr": {"$ne": ["$thumbnail_source", {"$concat": ["$content_hash", ":" + settings]}]}},
+                ]},
+            ],
+        }
+        if after_id is not None:
+            query["id"] = {"$gt": after_id}
+        cursor = self.collection.find(query, THUMBNAIL_PROJECTION).sort("id", 1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def existing_ids(self, user_id: str, note_ids: List[str]) -> Set[str]:
+        """The subset of ``note_ids`` that are notes of this user."""
+        if not note_ids:
+            return set()
+        return {doc["id"] async for doc in self.collection.find(
+            {"user_id": user_id, "id": {"$in": note_ids}}, {"_id": 0, "id": 1}
+        )}
+
+    async def find_blob_reference(self, user_id: str, blob_hash: str) -> Optional[dict]:
+        """Any one of the user's notes that references the blob, or None if they have no access to it."""
+        return await self.collection.find_one(
+            {"user_id": user_id, "content_hash": blob_hash},
+            {"_id": 0, "content_type": 1, "content_size": 1}
+        )
+
+    async def create(self, note_doc: dict) -> None:
+        async with self._change_seqs(note_doc["user_id"]) as change_seq:
+            await self.collection.insert_one(dict(note_doc, change_seq=change_seq))
+
+    async def update(self, note_id: str, user_id: str, fields: dict,
+                     expected_updated_at: Optional[datetime] = None) -> Optional[dict]:
+        """
+        Apply ``fields`` to the note and return the updated document, or None if not found.
+        With ``expected_updated_at``, the update only applies if the note has not changed since.
+        """
+        query = {"id": note_id, "user_id": user_id}
+        if expected_updated_at is not None:
+            query["updated_at"] = expected_updated_at
+        async with self._change_seqs(user_id) as change_seq:
+            return await self.collection.find_one_and_update(
+                query,
+                self._update_document(fields, change_seq),
+                projection=NOTE_PROJECTION,
+                return_document=ReturnDocument.AFTER,
+            )
+
+    @staticmethod
+    def _update_document(fields: dict, change_seq: int) -> dict:
+        update = {"$set": dict(fields, change_seq=change_seq)}
+        if "content_hash" in fields:
+            # The canvas now lives in the blob store; drop any inline copy written before that
+            update["$unset"] = {"content": ""}
+        return update
+
+    async def append_strokes(self, note_id: str, user_id: str, payload: bytes, point_count: int,
+                             start_ts: Optional[int] = None, end_ts: Optional[int] = None) -> Optional[dict]:
+        """
+        Push a packed stroke batch, whose samples run from ``start_ts`` to ``end_ts``, onto
+        the note's stroke log. Returns the note's id, updated_at and log size afterwards, or
+        None if the note does not exist or the batch starts before its strokes end.
+
+        The note's strokes_end_ts is where its strokes (snapshot and log) end. A note with
+        strokes but without it (written before it was recorded) takes no batches until
+        ``set_strokes_end_ts`` has filled it in.
+        """
+        query = {"id": note_id, "user_id": user_id}
+        update = {
+            "$push": {"stroke_log": Binary(payload)},
+            "$inc": {"stroke_log_points": point_count, "stroke_log_length": 1},
+        }
+        if point_count:
+            query["$or"] = [
+                {"strokes_end_ts": {"$lte": start_ts}},
+                {"strokes_end_ts": {"$exists": False}, "strokes_hash": None, "stroke_log_length": {"$in": [0, None]}},
+            ]
+            update["$max"] = {"strokes_end_ts": end_ts}
+        async with self._change_seqs(user_id) as change_seq:
+            update["$set"] = {"updated_at": datetime.utcnow(), "change_seq": change_seq}
+            # The state before, so the filter need not match the updated note
+            before = await self.collection.find_one_and_update(
+                query, update, projection={"_id": 0, "id": 1, "stroke_log_points": 1, "stroke_log_length": 1},
+            )
+        if before is None:
+            return None
+        return {
+            "id": note_id,
+            "updated_at": update["$set"]["updated_at"],
+            "stroke_log_points": before.get("stroke_log_points", 0) + point_count,
+            "stroke_log_length": before.get("stroke_log_length", 0) + 1,
+        }
+
+    async def set_strokes_end_ts(self, note_id: str, user_id: str, end_ts: int) -> None:
+        """Record where the note's strokes end, unless that is known already."""
+        await self.collection.update_one(
+            {"id": note_id, "user_id": user_id, "strokes_end_ts": {"$exists": False}},
+            {"$set": {"strokes_end_ts": end_ts}},
+        )
+
+    async def get_strokes(self, note_id: str, user_id: str) -> Optional[dict]:
+        """The stroke log together with the snapshot it applies on top of."""
+        return await self.collection.find_one(
+            {"id": note_id, "user_id": user_id},
+            {"_id": 0, "id": 1, "updated_at": 1, "stroke_log": 1, "strokes_hash": 1, "strokes_end_ts": 1,
+             "content": 1, "content_hash": 1, "content_type": 1}
+        )
+
+    async def compact_strokes(self, note_id: str, user_id: str, folded_chunks: int, folded_points: int,
+                              snapshot: dict, expected: dict) -> bool:
+        """
+        Store a new snapshot and drop the first ``folded_chunks`` log entries it covers.
+
+        Batches appended while the snapshot was being built stay in the log. The snapshot
+        replaces the canvas, so the note gets a new version (updated_at and change_seq) and
+        loses any inline canvas written before the blob store. ``expected`` is the note as
+        the snapshot was built from it (see get_strokes): the update is skipped (returns
+        False) if another compaction replaced the snapshot, or a write replaced the canvas,
+        in the meantime.
+        """
+        query = {"id": note_id, "user_id": user_id}
+        query.update({field: expected.get(field) for field in ("strokes_hash", "content_hash", "content")})
+        async with self._change_seqs(user_id) as change_seq:
+            snapshot = dict(snapshot, updated_at=datetime.utcnow(), change_seq=change_seq)
+            result = await self.collection.update_one(
+                query,
+                [
+                    {"$set": dict(
+                        {field: {"$literal": value} for field, value in snapshot.items()},
+                        stroke_log={"$slice": ["$stroke_log", folded_chunks, MAX_INT32]},
+                        stroke_log_points={"$subtract": ["$stroke_log_points", folded_points]},
+                        stroke_log_length={"$subtract": ["$stroke_log_length", folded_chunks]},
+                    )},
+                    {"$project": {"content": 0}},
+                ],
+            )
+        return result.modified_count == 1
+
+    async def delete(self, note_id: str, user_id: str) -> bool:
+        result = await self.collection.delete_one({"id": note_id, "user_id": user_id})
+        if result.deleted_count == 0:
+            return False
+        async with self._change_seqs(user_id) as change_seq:
+            await self.tombstones.insert_one({
+                "id": note_id,
+                "user_id": user_id,
+                "change_seq": change_seq,
+                "deleted_at": datetime.utcnow(),
+            })
+        return True
+
+    async def apply_batch(self, user_id: str, operations: List[dict]) -> List[Tuple[str, Optional[dict]]]:
+        """
+        Apply mixed creates, updates and deletes with a single unordered bulk_write.
+
+        Operations look like {"op": "create", "doc": {...}}, {"op": "update", "id", "fields"}
+        or {"op": "delete", "id"}; updates and deletes may carry "expected_updated_at".
+        Note ids must be unique within a batch. Returns one (outcome, note summary) pair per
+        operation, where outcome is "applied", "not_found", "conflict", "duplicate" or "error".
+
+        Every operation gets its own change sequence value, so reading the notes back shows
+        exactly which updates landed without needing per-operation results from the server.
+        """
+        if not operations:
+            return []
+        async with self._change_seqs(user_id, len(operations)) as first_seq:
+            return await self._apply_batch(user_id, operations, first_seq)
+
+    async def _apply_batch(self, user_id: str, operations: List[dict], first_seq: int) -> List[Tuple[str, Optional[dict]]]:
+        existing = await self.existing_ids(user_id, [op["id"] for op in operations if op["op"] != "create"])
+
+        outcomes: List[Tuple[str, Optional[dict]]] = [("not_found", None)] * len(operations)
+        requests, request_ops = [], []
+        for i, op in enumerate(operations):
+            if op["op"] == "create":
+                requests.append(InsertOne(dict(op["doc"], change_seq=first_seq + i)))
+            elif op["id"] not in existing:
+                continue
+            else:
+                query = {"id": op["id"], "user_id": user_id}
+                if op.get("expected_updated_at") is not None:
+                    query["updated_at"] = op["expected_updated_at"]
+                if op["op"] == "update":
+                    requests.append(UpdateOne(query, self._update_document(op["fields"], first_seq + i)))
+                else:
+                    requests.append(DeleteOne(query))
+            request_ops.append(i)
+        if not requests:
+            return outcomes
+
+        failed = {}
+        try:
+            await self.collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                failed[request_ops[error["index"]]] = "duplicate" if error["code"] == 11000 else "error"
+
+        note_ids = [op["doc"]["id"] if op["op"] == "create" else op["id"] for op in operations]
+        touched = [note_ids[i] for i in request_ops if i not in failed]
+        docs = {doc["id"]: doc async for doc in self.collection.find(
+            {"user_id": user_id, "id": {"$in": touched}}, NOTE_SUMMARY_PROJECTION
+        )}
+
+        tombstones = []
+        for i in request_ops:
+            doc = docs.get(note_ids[i])
+            if i in failed:
+                outcomes[i] = (failed[i], None)
+            elif operations[i]["op"] == "delete":
+                outcomes[i] = ("applied", None) if doc is None else ("conflict", None)
+                if doc is None:
+                    tombstones.append({
+                        "id": note_ids[i],
+                        "user_id": user_id,
+                        "change_seq": first_seq + i,
+                        "deleted_at": datetime.utcnow(),
+                    })
+            elif doc is not None and doc.get("change_seq") == first_seq + i:
+                outcomes[i] = ("applied", doc)
+            else:
+                outcomes[i] = ("conflict", None)
+        if tombstones:
+            await self.tombstones.insert_many(tombstones)
+        return outcomes
+
+    async def changes_since(self, user_id: str, since_seq: int, limit: int) -> Tuple[List[dict], bool]:
+        """
+        Up to ``limit`` changes after ``since_seq`` in sequence order, and whether more are pending.
+        Each change is {"seq", "id", "deleted", "note"}; "note" holds the summary for upserts.
+        Changes after a write still in flight are held back until it lands (see the class docstring).
+        """
+        # Read before the changes: values reserved after this are above it
+        visible_seq = await self._visible_change_seq(user_id)
+        query = {"user_id": user_id, "change_seq": {"$gt": since_seq, "$lte": visible_seq}}
+        notes = await self.collection.find(query, NOTE_SUMMARY_PROJECTION) \
+            .sort("change_seq", 1).limit(limit + 1).to_list(length=limit + 1)
+        tombstones = await self.tombstones.find(query, NO_OBJECT_ID) \
+            .sort("change_seq", 1).limit(limit + 1).to_list(length=limit + 1)
+
+        changes = [{"seq": n["change_seq"], "id": n["id"], "deleted": False, "note": n} for n in notes]
+        changes += [{"seq": t["change_seq"], "id": t["id"], "deleted": True, "note": None} for t in tombstones]
+        changes.sort(key=lambda change: change["seq"])
+        return changes[:limit], len(changes) > limit
+
+    async def backfill_change_seqs(self, user_id: str) -> None:
+        """Give notes written before the change feed existed a place in it, oldest first."""
+        cursor = self.collection.find(
+            {"user_id": user_id, "change_seq": {"$exists": False}},
+            {"_id": 0, "id": 1}
+        ).sort("updated_at", 1)
+        async for doc in cursor:
+            async with self._change_seqs(user_id) as change_seq:
+                await self.collection.update_one(
+                    {"id": doc["id"], "change_seq": {"$exists": False}},
+                    {"$set": {"change_seq": change_seq}}
+                )
+
+
+class BluetoothRepository:
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self.collection = db.bluetooth_data
+        self.chunks = db.bluetooth_chunks
+
+    async def create(self, session_doc: dict, chunks: List[dict]) -> None:
+        """
+        Store a complete session. The chunks go in first, so the session only becomes
+        visible once all of its samples are there.
+        """
+        docs = [
+            dict(chunk, session_id=session_doc["id"], user_id=session_doc["user_id"], index=index)
+            for index, chunk in enumerate(chunks)
+        ]
+        if docs:
+            await self.chunks.insert_many(docs)
+        await self.collection.insert_one(dict(session_doc, storage=CHUNKED_STORAGE))
+
+    async def get(self, session_id: str, user_id: str) -> Optional[dict]:
+        return await self.collection.find_one({"id": session_id, "user_id": user_id}, NO_OBJECT_ID)
+
+    async def get_header(self, session_id: str, user_id: str) -> Optional[dict]:
+        """The session document without any of its stroke payload."""
+        return await self.collection.find_one({"id": session_id, "user_id": user_id}, SESSION_HEADER_PROJECTION)
+
+    def iter_chunks(self, session_id: str, user_id: str, fields: Sequence[str] = ()) -> AsyncIOMotorCursor:
+        """
+        The session's chunks in order, fetched a few at a time as the cursor is iterated.
+        ``fields`` limits each chunk to those fields (dotted paths reach into the parts).
+        """
+        projection = {"_id": 0, "index": 1, **{field: 1 for field in fields}} if fields else NO_OBJECT_ID
+        return self.chunks.find(
+            {"session_id": session_id, "user_id": user_id}, projection
+        ).sort("index", 1).batch_size(CHUNK_READ_BATCH)
+
+    async def open_live_session(self, session_id: str, user_id: str, device_id: str) -> dict:
+        """Return the live session's header, creating it on first use. Its acked_seq is where the stored stream ends."""
+        now = datetime.utcnow()
+        header = await self.collection.find_one_and_update(
+            {"id": session_id, "user_id": user_id},
+            {"$setOnInsert": {
+                "id": session_id,
+                "user_id": user_id,
+                "device_id": device_id,
+                "storage": CHUNKED_STORAGE,
+                "point_count": 0,
+                "acked_seq": 0,
+                "timestamp": now,
+                "created_at": now,
+            }},
+            projection=SESSION_HEADER_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        # The header's acked_seq is only updated after the chunk that commits a batch
+        last = await self.chunks.find_one(
+            {"session_id": session_id, "user_id": user_id}, {"_id": 0, "last_seq": 1}, sort=[("index", -1)]
+        )
+        if last is not None and "last_seq" in last:
+            header["acked_seq"] = last["last_seq"]
+        return header
+
+    async def adopt_legacy_chunks(self, session_id: str, user_id: str, chunk: Optional[dict]) -> None:
+        """
+        Move a live session written before chunked storage over to it: ``chunk`` holds the
+        samples pushed into the session document so far (None if there are none).
+        """
+        if chunk is not None:
+            try:
+                await self.chunks.insert_one(dict(chunk, session_id=session_id, user_id=user_id, index=0))
+            except DuplicateKeyError:
+                # Moved already, by a connection that did not get to update the header
+                pass
+        await self.collection.update_one(
+            {"id": session_id, "user_id": user_id},
+            {"$set": {"storage": CHUNKED_STORAGE}, "$unset": {"chunks": "", "raw_blobs": ""}},
+        )
+
+    async def _seal_last_chunk(self, session_id: str, user_id: str, expected_seq: int) -> Optional[int]:
+        """
+        Close the chunk that ends at ``expected_seq`` to appends and return the index the
+        next chunk gets. None if the session does not end at ``expected_seq``.
+        """
+        last = await self.chunks.find_one_and_update(
+            {"session_id": session_id, "user_id": user_id, "last_seq": expected_seq},
+            {"$set": {"sealed": True}},
+            projection={"_id": 0, "index": 1},
+        )
+        if last is not None:
+            return last["index"] + 1
+        if await self.chunks.count_documents({"session_id": session_id, "user_id": user_id}, limit=1):
+            return None
+        # No chunk yet: the stream starts where the header says
+        header = await self.collection.find_one(
+            {"id": session_id, "user_id": user_id, "acked_seq": expected_seq}, {"_id": 1}
+        )
+        return 0 if header is not None else None
+
+    async def append_live_chunk(self, session_id: str, user_id: str, part: dict, totals: dict,
+                                expected_seq: int, last_seq: int, simplification: dict,
+                                raw_blob: Optional[str] = None) -> bool:
+        """
+        Append one committed batch (a chunk part, see sessions.py) to the session.
+
+        The chunk that ends at ``expected_seq`` takes the part unless it is full; otherwise the
+        part starts the next chunk, whose index is unique. Either way the write only applies
+        if the stream is still at ``expected_seq``, so a batch is never stored twice or out of
+        order. Returns False if another writer got there first. ``totals`` are the part's
+        counts and time range; ``simplification`` is its Simplification.stats(), folded into
+        the session's.
+        """
+        update = {
+            "$push": {"parts": part, "raw_blobs": {"$each": [raw_blob] if raw_blob else []}},
+            "$inc": {"point_count": totals["point_count"], "start_count": totals["start_count"]},
+            "$set": {"last_seq": last_seq},
+        }
+        if "start_ts" in totals:
+            # An empty batch has no time range
+            update.update({"$min": {"start_ts": totals["start_ts"]}, "$max": {"end_ts": totals["end_ts"]}})
+        appended = await self.chunks.update_one(
+            {
+                "session_id": session_id, "user_id": user_id, "last_seq": expected_seq,
+                "sealed": False, "point_count": {"$lt": SESSION_CHUNK_POINTS},
+            },
+            update,
+        )
+        if not appended.modified_count:
+            index = await self._seal_last_chunk(session_id, user_id, expected_seq)
+            if index is None:
+                return False
+            try:
+                await self.chunks.insert_one(dict(
+                    totals, session_id=session_id, user_id=user_id, index=index, parts=[part],
+                    raw_blobs=[raw_blob] if raw_blob else [], last_seq=last_seq, sealed=False,
+                ))
+            except DuplicateKeyError:
+                return False
+
+        # The batch is committed; the header only keeps the session's totals up to date
+        await self.collection.update_one(
+            {"id": session_id, "user_id": user_id},
+            {
+                "$inc": {"point_count": totals["point_count"], "simplification.raw_point_count": simplification["raw_point_count"]},
+                "$max": {
+                    "acked_seq": last_seq,
+                    "simplification.max_error": simplification["max_error"],
+                    "simplification.max_pressure_error": simplification["max_pressure_error"],
+                },
+                "$set": {"updated_at": datetime.utcnow()},
+            }
+        )
+        return True
+
+
+class JobRepository:
+    """
+    Background jobs. A job is "queued", "running" or one of the FINISHED_STATUSES. Running
+    jobs hold a lease that their worker keeps renewing; a job whose lease ran out (its
+    worker died) goes back to the queue.
+
+    A running job also holds one of its user's slots: the ids of a user's running jobs are
+    listed in a counter document, and take_slot only adds one while the list is short of
+    the cap, in a single update, so workers claiming at the same time cannot overshoot it.
+    Slots of jobs that stopped running without giving theirs back (their worker died) are
+    cleared the next time the user's slots are found full.
+    """
+
+    FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self.collection = db.jobs
+        self.counters = db.counters
+
+    @staticmethod
+    def _slots_id(user_id: str) -> str:
+        return f"running_jobs:{user_id}"
+
+    async def create(self, job_doc: dict) -> None:
+        await self.collection.insert_one(dict(job_doc))
+
+    async def get(self, job_id: str, user_id: str) -> Optional[dict]:
+        return await self.collection.find_one({"id": job_id, "user_id": user_id}, NO_OBJECT_ID)
+
+    async def list_for_user(self, user_id: str, limit: int) -> List[dict]:
+        cursor = self.collection.find({"user_id": user_id}, NO_OBJECT_ID).sort("created_at", -1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def find_active(self, dedupe_key: str) -> Optional[dict]:
+        """A queued or running job submitted with this dedupe key, if any."""
+        return await self.collection.find_one(
+            {"dedupe_key": dedupe_key, "status": {"$in": ["queued", "running"]}}, NO_OBJECT_ID
+        )
+
+    async def saturated_users(self, max_running: int) -> List[str]:
+        """
+        Users who already have ``max_running`` jobs running, across all workers. Only a hint
+        for claim, as it may be out of date by the time claim runs; take_slot enforces the cap.
+        """
+        cursor = self.collection.aggregate([
+            {"$match": {"status": "running", "lease_until": {"$gte": datetime.utcnow()}}},
+            {"$group": {"_id": "$user_id", "running": {"$sum": 1}}},
+            {"$match": {"running": {"$gte": max_running}}},
+        ])
+        return [doc["_id"] async for doc in cursor]
+
+    async def claim(self, worker_id: str, lease_seconds: float, exclude_users: List[str]) -> Optional[dict]:
+        """Atomically take the most urgent runnable job (highest priority, then oldest) and lease it."""
+        now = datetime.utcnow()
+        query = {"status": "queued"}
+        if exclude_users:
+            query["user_id"] = {"$nin": exclude_users}
+        claimed = {
+            "status": "running",
+            "worker_id": worker_id,
+            "started_at": now,
+            "lease_until": now + timedelta(seconds=lease_seconds),
+        }
+        # The job as it was, so the filter need not match the claimed job
+        job = await self.collection.find_one_and_update(
+            query,
+            {"$set": claimed, "$inc": {"attempts": 1}},
+            sort=[("priority", -1), ("created_at", 1)],
+            projection=NO_OBJECT_ID,
+        )
+        if job is None:
+            return None
+        return dict(job, attempts=job.get("attempts", 0) + 1, **claimed)
+
+    async def unclaim(self, job_id: str, worker_id: str) -> None:
+        """Undo claim: put the job back in the queue as it was, e.g. when its user has no slot free."""
+        await self.collection.update_one(
+            {"id": job_id, "worker_id": worker_id, "status": "running"},
+            {"$set": {"status": "queued"}, "$inc": {"attempts": -1},
+             "$unset": {"lease_until": "", "worker_id": "", "started_at": ""}},
+        )
+
+    async def take_slot(self, user_id: str, job_id: str, max_running: int) -> bool:
+        """Count a claimed job against its user's running jobs; False if they already have ``max_running``."""
+        slots_id = self._slots_id(user_id)
+        for attempt in range(2):
+            try:
+                # Matches only while the list has fewer than max_running ids, or already holds this
+                # job (requeued from a dead worker); otherwise the upsert's insert collides instead
+                await self.counters.update_one(
+                    {"_id": slots_id, "$or": [{f"jobs.{max_running - 1}": {"$exists": False}}, {"jobs": job_id}]},
+                    {"$addToSet": {"jobs": job_id}},
+                    upsert=True,
+                )
+                return True
+            except DuplicateKeyError:
+                pass
+            if attempt:
+                break
+            slots = await self.counters.find_one({"_id": slots_id}) or {}
+            held = slots.get("jobs", [])
+            running = {doc["id"] async for doc in self.collection.find(
+                {"id": {"$in": held}, "status": "running"}, {"_id": 0, "id": 1}
+            )}
+            stale = [held_id for held_id in held if held_id not in running]
+            if not stale:
+                break
+            await self.counters.update_one({"_id": slots_id}, {"$pull": {"jobs": {"$in": stale}}})
+        return False
+
+    async def _free_slots(self, jobs: List[dict]) -> None:
+        by_user = {}
+        for job in jobs:
+            by_user.setdefault(job["user_id"], []).append(job["id"])
+        for user_id, job_ids in by_user.items():
+            await self.counters.update_one({"_id": self._slots_id(user_id)}, {"$pull": {"jobs": {"$in": job_ids}}})
+
+    async def requeue_expired(self, max_attempts: int) -> None:
+        """Put jobs whose worker stopped renewing their lease back in the queue, or fail them if they keep dying."""
+        expired = {"status": "running", "lease_until": {"$lt": datetime.utcnow()}}
+        await self.collection.update_many(
+            dict(expired, attempts={"$gte": max_attempts}),
+            {"$set": {"status": "failed", "error": "Worker lost", "finished_at": datetime.utcnow()},
+             "$unset": {"lease_until": ""}},
+        )
+        await self.collection.update_many(
+            expired, {"$set": {"status": "queued"}, "$unset": {"lease_until": "", "worker_id": ""}}
+        )
+
+    async def renew(self, worker_id: str, job_ids: List[str], lease_seconds: float) -> List[str]:
+        """Extend the leases of this worker's running jobs; returns the ids whose owner asked to cancel them."""
+        if not job_ids:
+            return []
+        query = {"id": {"$in": job_ids}, "worker_id": worker_id, "status": "running"}
+        await self.collection.update_many(
+            query, {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=lease_seconds)}}
+        )
+        return [doc["id"] async for doc in self.collection.find(
+            dict(query, cancel_requested=True), {"_id": 0, "id": 1}
+        )]
+
+    async def finish(self, job_id: str, worker_id: str, status: str,
+                     result: Optional[dict] = None, error: Optional[str] = None) -> bool:
+        """Record the outcome and free the job's slot, unless another worker took the job over in the meantime."""
+        job = await self.collection.find_one_and_update(
+            {"id": job_id, "worker_id": worker_id, "status": "running"},
+            {"$set": {"status": status, "result": result, "error": error, "finished_at": datetime.utcnow()},
+             "$unset": {"lease_until": ""}},
+            projection={"_id": 0, "id": 1, "user_id": 1},
+        )
+        if job is None:
+            return False
+        await self._free_slots([job])
+        return True
+
+    async def release(self, worker_id: str, job_ids: List[str]) -> None:
+        """Hand running jobs back to the queue and free their slots, e.g. when this worker shuts down."""
+        if not job_ids:
+            return
+        query = {"id": {"$in": job_ids}, "worker_id": worker_id, "status": "running"}
+        jobs = await self.collection.find(query, {"_id": 0, "id": 1, "user_id": 1}).to_list(length=None)
+        await self.collection.update_many(
+            query, {"$set": {"status": "queued"}, "$unset": {"lease_until": "", "worker_id": ""}}
+        )
+        await self._free_slots(jobs)
+
+    async def cancel(self, job_id: str, user_id: str) -> Optional[dict]:
+        """
+        Cancel a queued job outright, or flag a running one for its worker to stop.
+        Returns the job afterwards, or None if it does not exist.
+        """
+        query = {"id": job_id, "user_id": user_id}
+        cancelled = await self.collection.find_one_and_update(
+            dict(query, status="queued"),
+            {"$set": {"status": "cancelled", "finished_at": datetime.utcnow()}},
+            projection=NO_OBJECT_ID,
+            return_document=ReturnDocument.AFTER,
+        )
+        if cancelled is not None:
+            return cancelled
+        await self.collection.update_one(dict(query, status="running"), {"$set": {"cancel_requested": True}})
+        return await self.get(job_id, user_id)
+
+
+class Repositories:
+    """Bundle of every repository bound to one database."""
+
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self.db = db
+        self.users = UserRepository(db)
+        self.notes = NoteRepository(db)
+        self.bluetooth = BluetoothRepository(db)
+        self.jobs = JobRepository(db)
@@ -1,20 +1,64 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response, WebSocket, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
-from pydantic import BaseModel, Field
-from typing import Optional, List
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import Literal, Optional, List
 import os
+import asyncio
+from urllib.parse import quote
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 import uuid
 
+from starlette.concurrency import run_in_threadpool
+
+import blobs
+import fast_json
+import http_cache
+import jobs
+import live
+import metrics
+import note_strokes
+import passwords
+import pdf_export
+import principals
+import profiling
+import raster
+import readiness
+import sessions
+import simplify
+import spatial
+import strokes
+import thumbnails
+from indexes import TOMBSTONE_TTL_DAYS, bootstrap as bootstrap_indexes
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from repository import DATABASE_NAME, Repositories, create_client, decode_change_cursor, encode_change_cursor
+
 # Load environment variables
 from dotenv import load_dotenv
 load_dotenv()
 
-app = FastAPI(title="Smart Pen API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Each Gunicorn worker connects after the fork, never the master
+    global client, db, repos, blob_store, job_scheduler
+    client = create_client(mongo_url, event_listeners=[*metrics.LISTENERS, profiling.DatabaseTimer()])
+    db = client[DATABASE_NAME]
+    repos = Repositories(db)
+    blob_store = blobs.create_store(db)
+    job_scheduler = jobs.JobScheduler(repos, blob_store)
+    await bootstrap_indexes(db)
+    await job_scheduler.start()
+    readiness_probe.handle_sigterm()
+    yield
+    # uvicorn has finished the requests in flight by now
+    await job_scheduler.stop()
+    client.close()
+
+app = FastAPI(title="Smart Pen API", version="1.0.0", lifespan=lifespan)
+app.router.route_class = profiling.ProfiledRoute
 
 # CORS configuration
 # WARNING: This is a permissive CORS configuration. For production, you should restrict this
@@ -27,17 +71,24 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(profiling.ProfilingMiddleware)
+# Outermost, so the time spent in the other middleware is counted
+app.add_middleware(metrics.MetricsMiddleware)
 
 # MongoDB connection
 mongo_url = os.getenv("MONGO_URL")
 if not mongo_url:
     raise RuntimeError("MONGO_URL environment variable is not set.")
-client = MongoClient(mongo_url)
-db = client.smartpen_db
+# Set up by the lifespan
+client: Optional[AsyncIOMotorClient] = None
+db: Optional[AsyncIOMotorDatabase] = None
+repos: Optional[Repositories] = None
+blob_store: Optional[blobs.BlobStore] = None
+job_scheduler: Optional[jobs.JobScheduler] = None
+readiness_probe = readiness.Readiness()
 
 # Security
 security = HTTPBearer()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # It's crucial that JWT_SECRET_KEY is set in your environment.
 # A hardcoded key is a significant security risk.
 SECRET_KEY = os.getenv("JWT_SECRET_KEY")
@@ -45,6 +96,11 @@ if not SECRET_KEY:
     raise RuntimeError("JWT_SECRET_KEY environment variable is not set.")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# When set, scrapers must send it as a bearer token
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+principal_cache = principals.create_cache(ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+# Packed stroke batches are read into memory whole before they are split into chunks
+MAX_STROKE_PAYLOAD_BYTES = 8 * 1024 * 1024
 
 # Pydantic models
 class UserCreate(BaseModel):
@@ -64,6 +120,9 @@ class Note(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     title: str
     content: str  # Base64 encoded canvas data
+    content_hash: Optional[str] = None  # Blob store key of the canvas
+    strokes_hash: Optional[str] = None  # Blob store key of the compacted stroke vector
+    stroke_log_points: int = 0  # Points appended since the last compaction
     text_content: Optional[str] = None  # OCR extracted text
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
@@ -74,17 +133,82 @@ class Note(BaseModel):
         # This allows the model to be created from a dictionary that includes _id
         from_attributes = True
 
+class NoteSummary(BaseModel):
+    id: str
+    title: str
+    content_hash: Optional[str] = None
+    strokes_hash: Optional[str] = None
+    stroke_log_points: int = 0
+    text_content: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    user_id: str
+    google_drive_id: Optional[str] = None
+
+class NoteSummaryPage(BaseModel):
+    items: List[NoteSummary]
+    next_cursor: Optional[str] = None
+
+class NoteSearchResult(NoteSummary):
+    score: float
+
+class NoteSearchPage(BaseModel):
+    items: List[NoteSearchResult]
+    next_offset: Optional[int] = None
+
+class NoteChange(BaseModel):
+    seq: int
+    id: str
+    deleted: bool = False
+    note: Optional[NoteSummary] = None  # Set for creates and updates
+
+class NoteChangesPage(BaseModel):
+    changes: List[NoteChange]
+    next_cursor: str  # Pass back as "since" to get what changed after this page
+    has_more: bool
+
+class NoteContent(BaseModel):
+    id: str
+    content: str  # Base64 encoded canvas data
+    updated_at: datetime
+
 class NoteUpdate(BaseModel):
     title: Optional[str] = None
     content: Optional[str] = None
     text_content: Optional[str] = None
 
-# Helper functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+class NoteBatchOperation(BaseModel):
+    op: Literal["create", "update", "delete"]
+    id: Optional[str] = None  # Required for update/delete; optional client-generated id for create
+    if_match: Optional[str] = None  # ETag the client last saw, as in the If-Match header
+    data: Optional[NoteUpdate] = None
+
+class NoteBatchRequest(BaseModel):
+    operations: List[NoteBatchOperation] = Field(..., max_length=500)
+
+class NoteExportRequest(BaseModel):
+    note_ids: List[str] = Field(..., min_length=1, max_length=500)
+
+class NoteBatchResult(BaseModel):
+    index: int
+    op: str
+    id: Optional[str] = None
+    status: int
+    detail: Optional[str] = None
+    note: Optional[NoteSummary] = None
+    etag: Optional[str] = None
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+class NoteBatchResponse(BaseModel):
+    results: List[NoteBatchResult]
+
+# Helper functions
+def password_overloaded() -> HTTPException:
+    # Shed logins rather than queue them: clients retry, everyone else's requests keep flowing
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many authentication requests, try again shortly",
+        headers={"Retry-After": "1"},
+    )
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -96,42 +220,65 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def authenticate_token(token: str) -> dict:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    
-    user = db.users.find_one({"username": username})
+
+    user = await principal_cache.get(username)
     if user is None:
-        raise credentials_exception
-    # Ensure the user object contains the 'id' field for dependency injection
-    if "_id" in user:
-        user["id"] = str(user["id"])
+        user = await repos.users.get_by_username(username)
+        if user is None:
+            raise credentials_exception
+        user = principals.principal(user)
+        await principal_cache.put(username, user)
     return user
 
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    with profiling.phase("auth"):
+        return await authenticate_token(credentials.credentials)
+
 # API Routes
 @app.get("/api/health")
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.utcnow()}
 
+@app.get("/api/ready")
+async def readiness_check(response: Response):
+    ready, reason = await readiness_probe.check(client)
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": reason, "timestamp": datetime.utcnow()}
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    body, media_type = metrics.render()
+    # Set the header directly; media_type would get a second charset appended
+    return Response(content=body, headers={"Content-Type": media_type})
+
 @app.post("/api/auth/register", response_model=Token)
 async def register(user: UserCreate):
-    if db.users.find_one({"username": user.username}):
+    if await repos.users.get_by_username(user.username):
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    if db.users.find_one({"email": user.email}):
+    if await repos.users.get_by_email(user.email):
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    hashed_password = get_password_hash(user.password)
+    try:
+        hashed_password = await passwords.hash_password(user.password)
+    except passwords.HashingOverloaded:
+        raise password_overloaded()
     user_doc = {
         "id": str(uuid.uuid4()),
         "username": user.username,
@@ -140,74 +287,506 @@ async def register(user: UserCreate):
         "created_at": datetime.utcnow()
     }
     
-    db.users.insert_one(user_doc)
+    await repos.users.create(user_doc)
     
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/api/auth/login", response_model=Token)
 async def login(user: UserLogin):
-    db_user = db.users.find_one({"username": user.username})
-    if not db_user or not verify_password(user.password, db_user.get("password", "")):
+    db_user = await repos.users.get_by_username(user.username)
+    valid, new_hash = False, None
+    if db_user:
+        try:
+            valid, new_hash = await passwords.verify_password(user.password, db_user.get("password", ""))
+        except passwords.HashingOverloaded:
+            raise password_overloaded()
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
         )
-    
+    if new_hash:
+        # Hashed with an older cost factor: upgrade it now that we have the plain password
+        await repos.users.update_password(db_user["id"], new_hash)
+        await principal_cache.invalidate(user.username)
+
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/api/notes", response_model=List[Note])
-async def get_notes(current_user: dict = Depends(get_current_user)):
-    notes_cursor = db.notes.find({"user_id": current_user["id"]})
-    # Transform documents to Note models, handling the _id to id mapping
-    return [Note.model_validate(note) for note in notes_cursor]
+async def get_notes(
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    count, latest = await repos.notes.fingerprint(current_user["id"])
+    etag = http_cache.hash_etag("notes", current_user["id"], count, latest)
+    # The client may hold a compressed representation, whose ETag the 304 has to repeat
+    matched = http_cache.match(if_none_match, etag)
+    if matched is not None:
+        return http_cache.not_modified(matched)
+
+    notes = await repos.notes.list_for_user(current_user["id"])
+    notes = await asyncio.gather(*(blobs.hydrate_content(blob_store, note) for note in notes))
+    if fast_json.ENABLED:
+        with profiling.phase("serialization"):
+            return await fast_json.json_response(
+                fast_json.shape_all(notes, Note), accept_encoding,
+                {"ETag": etag, "Cache-Control": http_cache.REVALIDATE},
+            )
+    http_cache.set_headers(response, etag)
+    return [Note.model_validate(note) for note in notes]
+
+@app.get("/api/notes/summary", response_model=NoteSummaryPage)
+async def get_note_summaries(
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    try:
+        items, next_cursor = await repos.notes.list_summaries(current_user["id"], limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    etag = http_cache.hash_etag("summary", next_cursor, *(http_cache.note_etag(n["id"], n["updated_at"]) for n in items))
+    matched = http_cache.match(if_none_match, etag)
+    if matched is not None:
+        return http_cache.not_modified(matched)
+    if fast_json.ENABLED:
+        with profiling.phase("serialization"):
+            return await fast_json.json_response(
+                {"items": fast_json.shape_all(items, NoteSummary), "next_cursor": next_cursor}, accept_encoding,
+                {"ETag": etag, "Cache-Control": http_cache.REVALIDATE},
+            )
+    http_cache.set_headers(response, etag)
+    return {"items": items, "next_cursor": next_cursor}
+
+@app.get("/api/notes/search", response_model=NoteSearchPage)
+async def search_notes(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user: dict = Depends(get_current_user)
+):
+    items = await repos.notes.search(current_user["id"], q, limit, offset)
+    next_offset = offset + limit if len(items) == limit else None
+    return {"items": items, "next_offset": next_offset}
+
+@app.get("/api/notes/changes", response_model=NoteChangesPage)
+async def get_note_changes(
+    since: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    current_user: dict = Depends(get_current_user)
+):
+    since_seq = 0
+    if since:
+        try:
+            since_seq, issued_at = decode_change_cursor(since)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if datetime.utcnow() - issued_at > timedelta(days=TOMBSTONE_TTL_DAYS):
+            # Tombstones older than this are gone, so the delta could silently miss deletions
+            raise HTTPException(status_code=status.HTTP_410_GONE, detail="Cursor expired, full resync required")
+    else:
+        await repos.notes.backfill_change_seqs(current_user["id"])
+
+    changes, has_more = await repos.notes.changes_since(current_user["id"], since_seq, limit)
+    last_seq = changes[-1]["seq"] if changes else since_seq
+    return {"changes": changes, "next_cursor": encode_change_cursor(last_seq), "has_more": has_more}
+
+@app.get("/api/notes/{note_id}", response_model=Note)
+async def get_note(
+    note_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    note = await repos.notes.get(note_id, current_user["id"])
+    if note is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+
+    etag = http_cache.note_etag(note["id"], note["updated_at"])
+    if http_cache.matches(if_none_match, etag):
+        return http_cache.not_modified(etag)
+    http_cache.set_headers(response, etag)
+    return Note.model_validate(await blobs.hydrate_content(blob_store, note))
 
+@app.get("/api/notes/{note_id}/content", response_model=NoteContent)
+async def get_note_content(
+    note_id: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    content = await repos.notes.get_content(note_id, current_user["id"])
+    if content is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+
+    if content.get("content_hash"):
+        # The blob hash identifies the canvas bytes, however often the note's metadata changes
+        etag = http_cache.hash_etag("content", content["content_hash"], content.get("content_type"))
+    else:
+        etag = http_cache.note_etag(content["id"], content["updated_at"])
+    if http_cache.matches(if_none_match, etag):
+        return http_cache.not_modified(etag)
+    http_cache.set_headers(response, etag)
+    return await blobs.hydrate_content(blob_store, content)
+
+@app.get("/api/notes/{note_id}/thumbnail")
+async def get_note_thumbnail(
+    note_id: str,
+    v: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    note = await repos.notes.get_thumbnail(note_id, current_user["id"])
+    if note is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+    if not note.get("content_hash"):
+        try:
+            note = await thumbnails.store_inline_canvas(repos.notes, blob_store, note_id, current_user["id"])
+        except thumbnails.ThumbnailError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if note is None:
+            raise HTTPException(status_code=404, detail="Note has no canvas")
+
+    etag = http_cache.hash_etag("thumbnail", thumbnails.source(note["content_hash"]))
+    # A URL naming the canvas it wants (?v=<content_hash>) always gets the same picture
+    cache_control = http_cache.IMMUTABLE if v == note["content_hash"] else http_cache.REVALIDATE
+    if http_cache.matches(if_none_match, etag):
+        return http_cache.not_modified(etag, cache_control)
+    try:
+        # Normally the job queued on the last content change already did this
+        note = await thumbnails.refresh(repos.notes, blob_store, job_scheduler.run_cpu, note_id, current_user["id"], note)
+    except thumbnails.ThumbnailError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return StreamingResponse(
+        blob_store.stream(note["thumbnail_hash"]),
+        media_type=note["thumbnail_type"],
+        headers={"ETag": etag, "Cache-Control": cache_control},
+    )
+
+@app.get("/api/blobs/{blob_hash}")
+async def get_blob(
+    blob_hash: str,
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_none_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    reference = await repos.notes.find_blob_reference(current_user["id"], blob_hash)
+    if reference is None:
+        raise HTTPException(status_code=404, detail="Blob not found")
+
+    # Content-addressed: the bytes behind a hash never change
+    etag = f'"{blob_hash}"'
+    if http_cache.matches(if_none_match, etag):
+        return http_cache.not_modified(etag, http_cache.IMMUTABLE)
+
+    size = reference["content_size"]
+    headers = {"Accept-Ranges": "bytes", "ETag": etag, "Cache-Control": http_cache.IMMUTABLE}
+    media_type = reference.get("content_type") or blobs.DEFAULT_CONTENT_TYPE
+    if range_header is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(blob_store.stream(blob_hash), media_type=media_type, headers=headers)
+
+    try:
+        start, end = blobs.parse_range(range_header, size)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    headers["Content-Length"] = str(end - start)
+    return StreamingResponse(
+        blob_store.stream(blob_hash, start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers=headers,
+    )
 
 @app.post("/api/notes", response_model=Note)
-async def create_note(note_data: NoteUpdate, current_user: dict = Depends(get_current_user)):
+async def create_note(note_data: NoteUpdate, response: Response, current_user: dict = Depends(get_current_user)):
     new_note = Note(
         **note_data.dict(),
         user_id=current_user["id"]
     )
-    
-    db.notes.insert_one(new_note.dict())
+
+    try:
+        note_doc = await blobs.offload_content(blob_store, new_note.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await repos.notes.create(note_doc)
+    new_note.content_hash = note_doc["content_hash"]
+    if new_note.content_hash:
+        await thumbnails.request_thumbnail(job_scheduler, new_note.id, current_user["id"])
+    http_cache.set_headers(response, http_cache.note_etag(new_note.id, new_note.updated_at))
     return new_note
 
 
+def expected_version(note_id: str, if_match: Optional[str]) -> Optional[datetime]:
+    """Optimistic concurrency: turn the ETag the client last saw into the updated_at it expects."""
+    if not if_match or if_match.strip() == "*":
+        return None
+    parsed = http_cache.parse_note_etag(if_match)
+    if parsed is None or parsed[0] != note_id:
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Note has been modified")
+    return parsed[1]
+
+@app.post("/api/notes/batch", response_model=NoteBatchResponse)
+async def batch_notes(batch: NoteBatchRequest, current_user: dict = Depends(get_current_user)):
+    user_id = current_user["id"]
+
+    async def prepare(item: NoteBatchOperation) -> dict:
+        if item.op == "delete":
+            return {"op": "delete", "id": item.id, "expected_updated_at": expected_version(item.id, item.if_match)}
+        data = item.data.dict(exclude_unset=True) if item.data else {}
+        if item.op == "create":
+            try:
+                note = Note(**data, user_id=user_id, **({"id": item.id} if item.id else {}))
+            except ValidationError as e:
+                detail = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+                raise HTTPException(status_code=400, detail=detail)
+            return {"op": "create", "doc": await blobs.offload_content(blob_store, note.dict())}
+        if not data:
+            raise HTTPException(status_code=400, detail="No fields to update")
+        data["updated_at"] = datetime.utcnow()
+        return {
+            "op": "update",
+            "id": item.id,
+            "fields": await blobs.offload_content(blob_store, data),
+            "expected_updated_at": expected_version(item.id, item.if_match),
+        }
+
+    results = [NoteBatchResult(index=i, op=item.op, id=item.id, status=0) for i, item in enumerate(batch.operations)]
+    pending, seen_ids = [], set()
+    for item, result in zip(batch.operations, results):
+        if item.op != "create" and not item.id:
+            result.status, result.detail = 400, "Missing note id"
+        elif item.id and item.id in seen_ids:
+            result.status, result.detail = 400, "Duplicate note id in batch"
+        else:
+            seen_ids.add(item.id)
+            pending.append((item, result))
+
+    prepared = await asyncio.gather(*(prepare(item) for item, _ in pending), return_exceptions=True)
+    operations, operation_results = [], []
+    for (item, result), op in zip(pending, prepared):
+        if isinstance(op, HTTPException):
+            result.status, result.detail = op.status_code, op.detail
+        elif isinstance(op, ValueError):
+            result.status, result.detail = 400, str(op)
+        elif isinstance(op, BaseException):
+            raise op
+        else:
+            operations.append(op)
+            operation_results.append(result)
+
+    applied_status = {"create": 201, "update": 200, "delete": 204}
+    failure_status = {
+        "not_found": (404, "Note not found"),
+        "conflict": (412, "Note has been modified"),
+        "duplicate": (409, "Note already exists"),
+        "error": (500, "Write failed"),
+    }
+    outcomes = await repos.notes.apply_batch(user_id, operations)
+    for op, result, (outcome, doc) in zip(operations, operation_results, outcomes):
+        if op["op"] == "create":
+            result.id = op["doc"]["id"]
+        if outcome == "applied":
+            result.status = applied_status[op["op"]]
+            if doc is not None:
+                result.note = NoteSummary.model_validate(doc)
+                result.etag = http_cache.note_etag(doc["id"], doc["updated_at"])
+        else:
+            result.status, result.detail = failure_status[outcome]
+    await asyncio.gather(*(
+        thumbnails.request_thumbnail(job_scheduler, result.id, user_id)
+        for op, result, (outcome, _) in zip(operations, operation_results, outcomes)
+        if outcome == "applied" and (op.get("doc") or op.get("fields") or {}).get("content_hash")
+    ))
+    return {"results": results}
+
 @app.put("/api/notes/{note_id}", response_model=Note)
-async def update_note(note_id: str, note_update: NoteUpdate, current_user: dict = Depends(get_current_user)):
+async def update_note(
+    note_id: str,
+    note_update: NoteUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
     update_data = note_update.dict(exclude_unset=True)
     if not update_data:
         raise HTTPException(status_code=400, detail="No fields to update")
 
+    expected_updated_at = expected_version(note_id, if_match)
     update_data["updated_at"] = datetime.utcnow()
-    
-    result = db.notes.update_one(
-        {"id": note_id, "user_id": current_user["id"]},
-        {"$set": update_data}
+    try:
+        stored_data = await blobs.offload_content(blob_store, update_data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    updated_note_doc = await repos.notes.update(note_id, current_user["id"], stored_data, expected_updated_at)
+    if updated_note_doc is None:
+        if expected_updated_at is not None and await repos.notes.get(note_id, current_user["id"]):
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Note has been modified")
+        raise HTTPException(status_code=404, detail="Note not found")
+    if "content" in update_data:
+        # No need to read back the canvas we were just sent
+        updated_note_doc["content"] = update_data["content"]
+        if stored_data["content_hash"]:
+            await thumbnails.request_thumbnail(job_scheduler, note_id, current_user["id"])
+
+    http_cache.set_headers(response, http_cache.note_etag(note_id, updated_note_doc["updated_at"]))
+    return Note.model_validate(await blobs.hydrate_content(blob_store, updated_note_doc))
+
+@app.post("/api/notes/{note_id}/strokes")
+async def append_note_strokes(note_id: str, request: Request, response: Response, current_user: dict = Depends(get_current_user)):
+    payload = await request.body()
+    if len(payload) > MAX_STROKE_PAYLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Stroke payload too large")
+    try:
+        columns = strokes.decode(payload)
+    except strokes.StrokeFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        log_state = await note_strokes.append(repos.notes, blob_store, note_id, current_user["id"], payload, columns)
+    except note_strokes.StrokesOutOfOrder as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if log_state is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+    compacting = note_strokes.needs_compaction(log_state)
+    if compacting:
+        await note_strokes.request_compaction(job_scheduler, note_id, current_user["id"])
+
+    http_cache.set_headers(response, http_cache.note_etag(note_id, log_state["updated_at"]))
+    return {
+        "id": note_id,
+        "point_count": len(columns),
+        "stroke_log_points": log_state["stroke_log_points"],
+        "compacting": compacting,
+    }
+
+@app.get("/api/notes/{note_id}/strokes")
+async def get_note_strokes(note_id: str, if_none_match: Optional[str] = Header(None), current_user: dict = Depends(get_current_user)):
+    vector = await note_strokes.read_vector(repos.notes, blob_store, note_id, current_user["id"])
+    if vector is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+    doc, payload = vector
+    # Every append and compaction gives the note a new version
+    etag = http_cache.note_etag(note_id, doc["updated_at"])
+    if http_cache.matches(if_none_match, etag):
+        return http_cache.not_modified(etag)
+    return Response(
+        content=payload,
+        media_type="application/octet-stream",
+        headers={"ETag": etag, "Cache-Control": http_cache.REVALIDATE},
     )
-    
-    if result.matched_count == 0:
+
+async def pdf_response(user_id: str, note_ids: List[str], filename: str) -> StreamingResponse:
+    # Load the font up front, so a misconfigured font fails the request instead of a half-sent PDF
+    await run_in_threadpool(pdf_export.load_font)
+    ascii_name = filename.encode("ascii", "ignore").decode().replace('"', "") or "notes.pdf"
+    return StreamingResponse(
+        pdf_export.export_notes(repos.notes, blob_store, user_id, note_ids),
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="{ascii_name}"; filename*=UTF-8\'\'{quote(filename)}'},
+    )
+
+@app.get("/api/notes/{note_id}/export.pdf")
+async def export_note_pdf(note_id: str, current_user: dict = Depends(get_current_user)):
+    note = await repos.notes.get(note_id, current_user["id"])
+    if note is None:
         raise HTTPException(status_code=404, detail="Note not found")
-        
-    updated_note_doc = db.notes.find_one({"id": note_id, "user_id": current_user["id"]})
+    return await pdf_response(current_user["id"], [note_id], f"{note.get('title') or 'note'}.pdf")
 
-    return Note.model_validate(updated_note_doc)
+@app.post("/api/notes/export")
+async def export_notes_pdf(export: NoteExportRequest, current_user: dict = Depends(get_current_user)):
+    missing = set(export.note_ids) - await repos.notes.existing_ids(current_user["id"], list(set(export.note_ids)))
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Notes not found: {', '.join(sorted(missing))}")
+    return await pdf_response(current_user["id"], export.note_ids, "notes.pdf")
 
 @app.delete("/api/notes/{note_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_note(note_id: str, current_user: dict = Depends(get_current_user)):
-    result = db.notes.delete_one({"id": note_id, "user_id": current_user["id"]})
-    
-    if result.deleted_count == 0:
+    if not await repos.notes.delete(note_id, current_user["id"]):
         raise HTTPException(status_code=404, detail="Note not found")
     
     return {} # Return empty response for 204
 
+class JobSubmit(BaseModel):
+    kind: str
+    params: dict = Field(default_factory=dict)
+    priority: int = Field(jobs.PRIORITY_NORMAL, ge=jobs.PRIORITY_LOW, le=jobs.PRIORITY_HIGH)
+
+class Job(BaseModel):
+    id: str
+    kind: str
+    params: dict
+    priority: int
+    status: Literal["queued", "running", "succeeded", "failed", "cancelled"]
+    attempts: int = 0
+    cancel_requested: bool = False
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+@app.post("/api/jobs", response_model=Job, status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(job: JobSubmit, current_user: dict = Depends(get_current_user)):
+    kind = jobs.KINDS.get(job.kind)
+    if kind is None or not kind.submittable:
+        raise HTTPException(status_code=400, detail=f"Unknown job kind: {job.kind}")
+    return await job_scheduler.submit(current_user["id"], job.kind, job.params, job.priority)
+
+@app.get("/api/jobs", response_model=List[Job])
+async def list_jobs(limit: int = Query(20, ge=1, le=100), current_user: dict = Depends(get_current_user)):
+    return await repos.jobs.list_for_user(current_user["id"], limit)
+
+@app.get("/api/jobs/{job_id}", response_model=Job)
+async def get_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    job = await repos.jobs.get(job_id, current_user["id"])
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str, current_user: dict = Depends(get_current_user)):
+    job = await repos.jobs.get(job_id, current_user["id"])
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != "succeeded":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    result = job.get("result") or {}
+    if "blob" not in result:
+        return result
+    return StreamingResponse(
+        blob_store.stream(result["blob"]),
+        media_type=result.get("content_type") or "application/octet-stream",
+        headers={"Cache-Control": http_cache.IMMUTABLE},
+    )
+
+@app.delete("/api/jobs/{job_id}", response_model=Job)
+async def cancel_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    job = await job_scheduler.cancel(job_id, current_user["id"])
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] in ("succeeded", "failed"):
+        raise HTTPException(status_code=409, detail=f"Job already {job['status']}")
+    return job
+
 # The Bluetooth endpoints are maintained as they were, assuming they are still needed.
 class BluetoothData(BaseModel):
     device_id: str
-    stroke_data: List[dict]
+    stroke_data: List[strokes.Point]
     timestamp: datetime
 
 @app.post("/api/bluetooth/connect")
@@ -216,19 +795,136 @@ async def bluetooth_connect(data: BluetoothData, current_user: dict = Depends(ge
         "id": str(uuid.uuid4()),
         "user_id": current_user["id"],
         "device_id": data.device_id,
-        "stroke_data": data.stroke_data,
+        "point_count": len(data.stroke_data),
         "timestamp": data.timestamp,
         "created_at": datetime.utcnow()
     }
-    db.bluetooth_data.insert_one(bluetooth_doc)
+    points = [point.model_dump() for point in data.stroke_data]
+    await repos.bluetooth.create(bluetooth_doc, sessions.point_chunks(points))
     return {"message": "Bluetooth data received successfully", "id": bluetooth_doc["id"]}
 
+@app.post("/api/bluetooth/strokes")
+async def ingest_packed_strokes(request: Request, device_id: str = Query(...), current_user: dict = Depends(get_current_user)):
+    payload = await request.body()
+    if len(payload) > MAX_STROKE_PAYLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Stroke payload too large")
+    try:
+        columns = strokes.decode(payload)
+    except strokes.StrokeFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    raw_point_count = len(columns)
+    columns, simplification = await run_in_threadpool(simplify.simplified, columns)
+    chunks = await run_in_threadpool(sessions.packed_chunks, columns)
+    timestamp = datetime.utcfromtimestamp(columns.timestamp[0] / 1000) if len(columns) else datetime.utcnow()
+    bluetooth_doc = {
+        "id": str(uuid.uuid4()),
+        "user_id": current_user["id"],
+        "device_id": device_id,
+        "encoding": strokes.ENCODING,
+        "point_count": len(columns),
+        "stroke_count": len(strokes.stroke_bounds(columns)),
+        "simplification": simplification.stats(),
+        "timestamp": timestamp,
+        "created_at": datetime.utcnow()
+    }
+    raw_blob = await simplify.archive(blob_store, payload)
+    if raw_blob:
+        bluetooth_doc["raw_blob"] = raw_blob
+    await repos.bluetooth.create(bluetooth_doc, chunks)
+    return {
+        "message": "Bluetooth data received successfully",
+        "id": bluetooth_doc["id"],
+        "point_count": len(columns),
+        "raw_point_count": raw_point_count,
+    }
+
 @app.get("/api/bluetooth/data/{session_id}")
 async def get_bluetooth_data(session_id: str, current_user: dict = Depends(get_current_user)):
-    data = db.bluetooth_data.find_one({"id": session_id, "user_id": current_user["id"]})
-    if not data:
+    header = await repos.bluetooth.get_header(session_id, current_user["id"])
+    if not header:
+        raise HTTPException(status_code=404, detail="Bluetooth data not found")
+    # Older clients only understand the List[dict] shape; build it a chunk at a time
+    return StreamingResponse(sessions.json_document(repos.bluetooth, header), media_type="application/json")
+
+@app.get("/api/bluetooth/data/{session_id}/packed")
+async def get_bluetooth_data_packed(session_id: str, current_user: dict = Depends(get_current_user)):
+    header = await repos.bluetooth.get_header(session_id, current_user["id"])
+    if not header:
+        raise HTTPException(status_code=404, detail="Bluetooth data not found")
+    return StreamingResponse(sessions.packed(repos.bluetooth, header), media_type="application/octet-stream")
+
+@app.get("/api/bluetooth/data/{session_id}/raw")
+async def get_bluetooth_data_raw(session_id: str, current_user: dict = Depends(get_current_user)):
+    header = await repos.bluetooth.get_header(session_id, current_user["id"])
+    if not header:
+        raise HTTPException(status_code=404, detail="Bluetooth data not found")
+    if "simplification" not in header:
+        # Stored before ingest simplified anything: what we have is the raw stream
+        return StreamingResponse(sessions.packed(repos.bluetooth, header), media_type="application/octet-stream")
+    if "raw_blob" in header:
+        return StreamingResponse(blob_store.stream(header["raw_blob"]), media_type="application/octet-stream")
+    raw_blobs = await sessions.raw_blobs(repos.bluetooth, header)
+    if not raw_blobs:
+        raise HTTPException(status_code=404, detail="Raw samples were not archived")
+    return StreamingResponse(sessions.raw_packed(blob_store, raw_blobs), media_type="application/octet-stream")
+
+@app.get("/api/bluetooth/data/{session_id}/region")
+async def get_bluetooth_region(
+    session_id: str,
+    min_x: int = Query(..., ge=0),
+    min_y: int = Query(..., ge=0),
+    max_x: int = Query(..., ge=0),
+    max_y: int = Query(..., ge=0),
+    packed: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    if min_x > max_x or min_y > max_y:
+        raise HTTPException(status_code=400, detail="Region minimum must not exceed its maximum")
+    result = await spatial.query_session(repos.bluetooth, session_id, current_user["id"], (min_x, min_y, max_x, max_y))
+    if result is None:
         raise HTTPException(status_code=404, detail="Bluetooth data not found")
-    return data
+    stroke_ids, columns = result
+    if packed:
+        # Every stroke in the payload starts a stroke of its own; X-Stroke-Count says how many there are
+        return Response(
+            content=strokes.encode(columns),
+            media_type="application/octet-stream",
+            headers={"X-Stroke-Count": str(len(stroke_ids))},
+        )
+    points = strokes.to_points(columns)
+    return {
+        "id": session_id,
+        "strokes": [
+            {"index": stroke_id, "points": points[start:end]}
+            for stroke_id, (start, end) in zip(stroke_ids.tolist(), strokes.stroke_bounds(columns))
+        ],
+    }
+
+@app.get("/api/bluetooth/data/{session_id}/tiles/{zoom}/{tile_x}/{tile_y}.png")
+async def get_bluetooth_tile(session_id: str, zoom: int, tile_x: int, tile_y: int, current_user: dict = Depends(get_current_user)):
+    if not raster.valid_tile(zoom, tile_x, tile_y):
+        raise HTTPException(status_code=404, detail="Tile not found")
+    tile = await raster.get_tile(repos.bluetooth, session_id, current_user["id"], zoom, tile_x, tile_y)
+    if tile is None:
+        raise HTTPException(status_code=404, detail="Bluetooth data not found")
+    return Response(content=tile, media_type="image/png")
+
+@app.websocket("/api/bluetooth/stream")
+async def stream_strokes(
+    websocket: WebSocket,
+    token: str,
+    device_id: str,
+    session_id: Optional[str] = None
+):
+    # Browsers cannot set an Authorization header on a WebSocket, so the token comes in the query
+    try:
+        current_user = await authenticate_token(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    await live.serve_stream(websocket, repos.bluetooth, blob_store, current_user["id"], session_id or str(uuid.uuid4()), device_id)
 
 if __name__ == "__main__":
     import uvicorn
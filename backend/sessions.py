@@ -0,0 +1,283 @@
+"""
+Chunked storage for pen sessions, so no session runs into Mongo's 16 MB document limit.
+
+A session is a header document in bluetooth_data (device, timestamps, totals, no
+samples) plus its samples in bluetooth_chunks, in documents of about
+SESSION_CHUNK_POINTS samples, numbered in time order:
+
+    session_id, user_id, index
+    parts                                       the samples, as one or more parts (below)
+    point_count, start_count, start_ts, end_ts  totals over the parts, timestamps in ms
+    raw_blobs, last_seq, sealed                 live sessions only (see BluetoothRepository)
+
+A part is a packed batch (see strokes.py) stored column by column, so a read can fetch
+one column of every chunk without the others:
+
+    x, y, pressure, dt, starts  the packed columns, as Binary
+    base_ts                     the timestamp dt[0] is relative to (the first sample's)
+    point_count
+
+Sessions posted in one request are cut into full chunks of one part each. A live session
+appends one part per committed batch to its last chunk until that is full, then starts
+the next one. Sessions posted to /api/bluetooth/connect keep their point dicts as they
+were sent, in a ``points`` list instead of parts.
+
+Reads are async generators over the chunks, a few fetched at a time, so the memory a
+read needs is bounded by the chunk size rather than by the length of the session.
+Sessions stored before this layout (samples inside the header) are still read as they were.
+"""
+
+from typing import AsyncIterator, List, Tuple
+
+import numpy as np
+from bson import Binary
+
+import fast_json
+import strokes
+from blobs import BlobStore
+from repository import CHUNKED_STORAGE, SESSION_CHUNK_POINTS, BluetoothRepository
+
+# Point dicts are several times the size of packed samples, and clients may add keys
+POINTS_PER_CHUNK = SESSION_CHUNK_POINTS // 8
+
+
+def is_chunked(header: dict) -> bool:
+    return header.get("storage") == CHUNKED_STORAGE
+
+
+def split(columns: strokes.StrokeColumns, size: int = SESSION_CHUNK_POINTS) -> List[strokes.StrokeColumns]:
+    """Cut columns into batches of ``size`` samples; strokes.concat joins them back."""
+    starts = columns.stroke_starts.astype(np.int64)
+    batches = []
+    for begin in range(0, len(columns), size):
+        end = begin + size
+        batches.append(strokes.StrokeColumns(
+            x=columns.x[begin:end],
+            y=columns.y[begin:end],
+            pressure=columns.pressure[begin:end],
+            timestamp=columns.timestamp[begin:end],
+            stroke_starts=(starts[(starts >= begin) & (starts < end)] - begin).astype(np.uint32),
+        ))
+    return batches
+
+
+def pack_part(columns: strokes.StrokeColumns) -> Tuple[dict, dict]:
+    """(part, totals) for one batch. Raises StrokeFormatError if its timestamps go backwards."""
+    n = len(columns)
+    base_ts = int(columns.timestamp[0]) if n else 0
+    part = {
+        "x": Binary(np.asarray(columns.x, dtype="<u2").tobytes()),
+        "y": Binary(np.asarray(columns.y, dtype="<u2").tobytes()),
+        "pressure": Binary(np.asarray(columns.pressure, dtype="u1").tobytes()),
+        "dt": Binary(strokes.time_deltas(columns.timestamp, base_ts).tobytes()),
+        "starts": Binary(np.asarray(columns.stroke_starts, dtype="<u4").tobytes()),
+        "base_ts": base_ts,
+        "point_count": n,
+    }
+    totals = {"point_count": n, "start_count": len(columns.stroke_starts)}
+    if n:
+        totals.update(start_ts=base_ts, end_ts=int(columns.timestamp[-1]))
+    return part, totals
+
+
+def unpack_part(part: dict) -> strokes.StrokeColumns:
+    return strokes.StrokeColumns(
+        x=np.frombuffer(part["x"], dtype="<u2"),
+        y=np.frombuffer(part["y"], dtype="<u2"),
+        pressure=np.frombuffer(part["pressure"], dtype="u1"),
+        timestamp=part["base_ts"] + np.cumsum(np.frombuffer(part["dt"], dtype="<u4"), dtype=np.int64),
+        stroke_starts=np.frombuffer(part["starts"], dtype="<u4"),
+    )
+
+
+def packed_chunks(columns: strokes.StrokeColumns) -> List[dict]:
+    """The chunk documents (less their keys) for a complete session."""
+    chunks = []
+    for batch in split(columns):
+        part, totals = pack_part(batch)
+        chunks.append(dict(totals, parts=[part]))
+    return chunks
+
+
+def point_chunks(points: List[dict]) -> List[dict]:
+    return [
+        {"points": points[begin:begin + POINTS_PER_CHUNK], "point_count": len(points[begin:begin + POINTS_PER_CHUNK])}
+        for begin in range(0, len(points), POINTS_PER_CHUNK)
+    ]
+
+
+async def open_live(repo: BluetoothRepository, session_id: str, user_id: str, device_id: str) -> dict:
+    """Open a live session, first moving one written before chunked storage over to it."""
+    header = await repo.open_live_session(session_id, user_id, device_id)
+    # Only live sessions have an acked_seq; others cannot be appended to either way
+    if not is_chunked(header) and "acked_seq" in header:
+        data = await repo.get(session_id, user_id)
+        chunk = None
+        if data.get("chunks"):
+            # Everything up to acked_seq, as one sealed chunk that later batches follow
+            batches = [strokes.decode(payload) for payload in data["chunks"]]
+            parts, totals = zip(*(pack_part(batch) for batch in batches))
+            columns = strokes.concat(batches)
+            chunk = dict(
+                parts=list(parts), raw_blobs=data.get("raw_blobs", []), last_seq=data["acked_seq"], sealed=True,
+                point_count=len(columns), start_count=sum(t["start_count"] for t in totals),
+            )
+            if len(columns):
+                chunk.update(start_ts=int(columns.timestamp.min()), end_ts=int(columns.timestamp.max()))
+        await repo.adopt_legacy_chunks(session_id, user_id, chunk)
+    return header
+
+
+async def batches(repo: BluetoothRepository, header: dict) -> AsyncIterator[strokes.StrokeColumns]:
+    """The session's samples a part at a time; strokes.concat of them all is the whole session."""
+    if not is_chunked(header):
+        data = await repo.get(header["id"], header["user_id"])
+        if data is not None:
+            yield strokes.from_session(data)
+        return
+    async for chunk in repo.iter_chunks(header["id"], header["user_id"]):
+        if "points" in chunk:
+            yield strokes.from_points(chunk["points"], continued=chunk["index"] > 0)
+            continue
+        for part in chunk["parts"]:
+            yield unpack_part(part)
+
+
+async def columns(repo: BluetoothRepository, header: dict) -> strokes.StrokeColumns:
+    """The whole session at once, for the readers that need all of it (rendering, the spatial index)."""
+    return strokes.concat([batch async for batch in batches(repo, header)])
+
+
+async def packed(repo: BluetoothRepository, header: dict) -> AsyncIterator[bytes]:
+    """
+    The session as one packed payload, produced piece by piece. The payload is laid out
+    column by column, so chunked sessions are read once per column, each time fetching
+    only that column of every chunk.
+    """
+    if not is_chunked(header):
+        data = await repo.get(header["id"], header["user_id"])
+        if data is not None:
+            yield bytes(data["packed"]) if "packed" in data else strokes.encode(strokes.from_session(data))
+        return
+
+    session_id, user_id = header["id"], header["user_id"]
+    totals = [chunk async for chunk in repo.iter_chunks(session_id, user_id, ("point_count", "start_count", "start_ts"))]
+    if any("start_count" not in chunk for chunk in totals):
+        # Point dicts are not stored by column
+        yield strokes.encode(await columns(repo, header))
+        return
+
+    base_ts = next((chunk["start_ts"] for chunk in totals if chunk["point_count"]), 0)
+    yield strokes.HEADER.pack(
+        strokes.MAGIC, sum(chunk["point_count"] for chunk in totals),
+        sum(chunk["start_count"] for chunk in totals), base_ts,
+    )
+    for field in ("x", "y", "pressure"):
+        async for chunk in repo.iter_chunks(session_id, user_id, (f"parts.{field}",)):
+            for part in chunk["parts"]:
+                yield bytes(part[field])
+
+    previous_ts = base_ts
+    async for chunk in repo.iter_chunks(session_id, user_id, ("parts.dt", "parts.base_ts", "parts.point_count")):
+        for part in chunk["parts"]:
+            if not part["point_count"]:
+                continue
+            dt = np.frombuffer(part["dt"], dtype="<u4")
+            # Rebase the part's first delta on the end of the previous part; raises, as encode
+            # would, if a part starts before the previous one ended
+            first = strokes.time_deltas(np.array([part["base_ts"]]), previous_ts)
+            previous_ts = part["base_ts"] + int(dt.sum(dtype=np.int64))
+            yield first.tobytes() + dt[1:].tobytes()
+
+    offset = 0
+    async for chunk in repo.iter_chunks(session_id, user_id, ("parts.starts", "parts.point_count")):
+        for part in chunk["parts"]:
+            yield (np.frombuffer(part["starts"], dtype="<u4") + np.uint32(offset)).astype("<u4").tobytes()
+            offset += part["point_count"]
+
+
+async def stroke_data(repo: BluetoothRepository, header: dict) -> AsyncIterator[List[dict]]:
+    """The session as the legacy List[dict] stroke_data, a chunk at a time."""
+    if not is_chunked(header):
+        data = await repo.get(header["id"], header["user_id"])
+        if data is None:
+            return
+        if "packed" in data or "chunks" in data:
+            yield strokes.to_points(strokes.from_session(data))
+        else:
+            yield data.get("stroke_data", [])
+        return
+    async for chunk in repo.iter_chunks(header["id"], header["user_id"]):
+        if "points" in chunk:
+            yield chunk["points"]
+            continue
+        for part in chunk["parts"]:
+            yield strokes.to_points(unpack_part(part))
+
+
+async def json_document(repo: BluetoothRepository, header: dict) -> AsyncIterator[bytes]:
+    """
+    The session as the JSON document older clients expect (its fields plus stroke_data),
+    encoded a chunk at a time.
+    """
+    fields = {key: value for key, value in header.items() if key != "storage"}
+    opening = fast_json.dumps(fields)[:-1]
+    yield opening + (b',"stroke_data":[' if fields else b'"stroke_data":[')
+    separator = b""
+    async for points in stroke_data(repo, header):
+        if points:
+            yield separator + fast_json.dumps(points)[1:-1]
+            separator = b","
+    yield b"]}"
+
+
+async def raw_blobs(repo: BluetoothRepository, header: dict) -> List[str]:
+    """The blob hashes of the raw batches archived while a live session was streamed, in order."""
+    if not is_chunked(header):
+        data = await repo.get(header["id"], header["user_id"])
+        return data.get("raw_blobs", []) if data else []
+    return [
+        blob_hash
+        async for chunk in repo.iter_chunks(header["id"], header["user_id"], ("raw_blobs",))
+        for blob_hash in chunk.get("raw_blobs", [])
+    ]
+
+
+async def raw_packed(store: BlobStore, blob_hashes: List[str]) -> AsyncIterator[bytes]:
+    """
+    The archived raw batches joined into one packed payload, produced piece by piece as
+    packed() does: each column is streamed as ranges of every blob, so no blob is read whole.
+    """
+    counts = []
+    for blob_hash in blob_hashes:
+        header = b"".join([piece async for piece in store.stream(blob_hash, 0, strokes.HEADER.size)])
+        _, n, m, base_ts = strokes.HEADER.unpack(header)
+        counts.append((blob_hash, n, m, base_ts))
+
+    base_ts = next((base for _, n, _, base in counts if n), 0)
+    yield strokes.HEADER.pack(strokes.MAGIC, sum(n for _, n, _, _ in counts), sum(m for _, _, m, _ in counts), base_ts)
+    # Column offsets within a batch, per point: x at 0, y at 2, pressure at 4, dt at 5, starts at 9
+    for begin, size in ((0, 2), (2, 2), (4, 1)):
+        for blob_hash, n, _, _ in counts:
+            offset = strokes.HEADER.size + begin * n
+            async for piece in store.stream(blob_hash, offset, offset + size * n):
+                yield piece
+
+    previous_ts = base_ts
+    for blob_hash, n, _, batch_base_ts in counts:
+        if not n:
+            continue
+        offset = strokes.HEADER.size + 5 * n
+        dt = np.frombuffer(b"".join([piece async for piece in store.stream(blob_hash, offset, offset + 4 * n)]), dtype="<u4")
+        # As in packed(): rebase the batch's first delta on the end of the previous batch
+        first_ts = batch_base_ts + int(dt[0])
+        first = strokes.time_deltas(np.array([first_ts]), previous_ts)
+        previous_ts = batch_base_ts + int(dt.sum(dtype=np.int64))
+        yield first.tobytes() + dt[1:].tobytes()
+
+    point_offset = 0
+    for blob_hash, n, m, _ in counts:
+        offset = strokes.HEADER.size + strokes.BYTES_PER_POINT * n
+        starts = b"".join([piece async for piece in store.stream(blob_hash, offset, offset + 4 * m)])
+        yield (np.frombuffer(starts, dtype="<u4") + np.uint32(point_offset)).astype("<u4").tobytes()
+        point_offset += n
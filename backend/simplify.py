@@ -0,0 +1,112 @@
+"""
+Stroke simplification at ingest.
+
+The pen samples at a fixed rate, so slow or straight movements produce long runs of
+points that add nothing to the line. ``simplify`` drops them with Ramer-Douglas-Peucker:
+a sample is only kept if leaving it out would move the line by more than TOLERANCE pen
+units, or change the pressure (and so the drawn line width) by more than
+PRESSURE_TOLERANCE. The first and last sample of every stroke are always kept.
+
+Instead of recursing one segment at a time, every pass looks at all the segments of
+all the strokes at once: each sample's distance to the chord between its kept
+neighbours is one NumPy expression, and the worst sample of every segment that is
+still out of tolerance is kept. Passes repeat until no segment is.
+
+The result records the largest error actually left in the simplified line. With
+STROKE_ARCHIVE_RAW set, the raw samples are also kept in the blob store.
+"""
+
+import os
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+
+import blobs
+import strokes
+
+# Pen units (0..4096 across the page); 1 unit is a pixel at the deepest tile zoom. 0 turns simplification off
+TOLERANCE = float(os.getenv("STROKE_SIMPLIFY_TOLERANCE", "1.0"))
+# Raw pressure units (0..255); line width is proportional to pressure
+PRESSURE_TOLERANCE = float(os.getenv("STROKE_SIMPLIFY_PRESSURE_TOLERANCE", "8"))
+ARCHIVE_RAW = os.getenv("STROKE_ARCHIVE_RAW", "0").lower() in ("1", "true", "yes")
+
+
+class Simplification(NamedTuple):
+    keep: np.ndarray           # bool mask over the raw samples
+    max_error: float           # furthest a dropped sample lies from the simplified line, in pen units
+    max_pressure_error: float  # largest pressure difference between a dropped sample and the simplified line
+
+    def stats(self) -> dict:
+        return {
+            "raw_point_count": len(self.keep),
+            "max_error": round(self.max_error, 3),
+            "max_pressure_error": round(self.max_pressure_error, 3),
+        }
+
+
+def _chord_errors(x, y, p, samples, left, right):
+    """Distance of each sample from the chord between its kept neighbours, and its pressure difference."""
+    dx, dy = x[right] - x[left], y[right] - y[left]
+    length2 = dx * dx + dy * dy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = ((x[samples] - x[left]) * dx + (y[samples] - y[left]) * dy) / length2
+    # A zero-length chord (the pen held still) measures from its end point
+    t = np.clip(np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0), 0.0, 1.0)
+    distance = np.hypot(x[samples] - (x[left] + t * dx), y[samples] - (y[left] + t * dy))
+    pressure = np.abs(p[samples] - (p[left] + t * (p[right] - p[left])))
+    return distance, pressure
+
+
+def simplify(columns: strokes.StrokeColumns, tolerance: float = TOLERANCE,
+             pressure_tolerance: float = PRESSURE_TOLERANCE) -> Simplification:
+    n = len(columns)
+    keep = np.zeros(n, dtype=bool)
+    for start, end in strokes.stroke_bounds(columns):
+        keep[start] = keep[end - 1] = True
+    if tolerance <= 0 or n <= 2:
+        keep[:] = True
+        return Simplification(keep, 0.0, 0.0)
+
+    x = columns.x.astype(np.float64)
+    y = columns.y.astype(np.float64)
+    p = columns.pressure.astype(np.float64)
+    max_error = max_pressure_error = 0.0
+    # Samples whose segment is still out of tolerance; once a segment is within it, nothing in it changes again
+    pending = np.flatnonzero(~keep)
+    while len(pending):
+        kept = np.flatnonzero(keep)
+        segment = np.searchsorted(kept, pending)
+        distance, pressure = _chord_errors(x, y, p, pending, kept[segment - 1], kept[segment])
+        error = distance / tolerance
+        if pressure_tolerance > 0:
+            error = np.maximum(error, pressure / pressure_tolerance)
+
+        # pending is sorted, so each segment's samples are contiguous
+        first_of_segment = np.empty(len(pending), dtype=bool)
+        first_of_segment[0] = True
+        np.not_equal(segment[1:], segment[:-1], out=first_of_segment[1:])
+        group = np.cumsum(first_of_segment) - 1
+        worst = np.maximum.reduceat(error, np.flatnonzero(first_of_segment))[group]
+        settled = worst <= 1.0
+        if settled.any():
+            max_error = max(max_error, float(distance[settled].max()))
+            max_pressure_error = max(max_pressure_error, float(pressure[settled].max()))
+
+        # Keep the worst sample of every segment still out of tolerance, which splits it in two
+        candidates = np.flatnonzero(~settled & (error == worst))
+        _, first = np.unique(group[candidates], return_index=True)
+        keep[pending[candidates[first]]] = True
+        pending = pending[~settled & ~keep[pending]]
+    return Simplification(keep, max_error, max_pressure_error)
+
+
+def simplified(columns: strokes.StrokeColumns) -> Tuple[strokes.StrokeColumns, Simplification]:
+    result = simplify(columns)
+    return strokes.select(columns, result.keep), result
+
+
+async def archive(store: blobs.BlobStore, payload: bytes) -> Optional[str]:
+    """Keep the raw packed samples in the blob store if STROKE_ARCHIVE_RAW is set; returns the blob hash."""
+    if not ARCHIVE_RAW:
+        return None
+    return await store.put(payload, strokes.CONTENT_TYPE)
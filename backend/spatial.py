@@ -0,0 +1,127 @@
+"""
+Spatial index over the strokes of a session, for viewport and region queries.
+
+The 0..4096 pen coordinate space is cut into a GRID_CELLS x GRID_CELLS grid (one cell
+per tile at the deepest zoom). Every stroke's bounding box is listed in each cell it
+overlaps, in CSR form: cell_offsets[c]..cell_offsets[c + 1] index the stroke ids of
+cell c in cell_strokes. A region query only looks at the strokes of the cells the
+region covers, then checks their boxes exactly.
+
+Indexes are built from the decoded session on first use and cached per session
+version, like rendered tiles (see raster.py), so panning and zooming over a page
+queries the same index without going back to Mongo.
+"""
+
+import os
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+from starlette.concurrency import run_in_threadpool
+
+import raster
+import strokes
+from repository import BluetoothRepository
+
+GRID_CELLS = 2 ** raster.MAX_ZOOM
+CELL_SIZE = raster.PEN_SPACE // GRID_CELLS
+
+
+class StrokeIndex(NamedTuple):
+    starts: np.ndarray        # int64[stroke], index of each stroke's first sample
+    ends: np.ndarray          # int64[stroke], one past its last sample
+    boxes: np.ndarray         # int32[stroke, 4], min_x, min_y, max_x, max_y
+    cell_offsets: np.ndarray  # int64[GRID_CELLS ** 2 + 1]
+    cell_strokes: np.ndarray  # int64, stroke ids grouped by cell, ascending within a cell
+
+    def __len__(self):
+        return len(self.starts)
+
+
+index_cache = raster.LRUCache(int(os.getenv("SPATIAL_INDEX_CACHE_MAX_ENTRIES", "64")))
+
+
+def _cells(coordinate: np.ndarray) -> np.ndarray:
+    # Points past the edge of the page (the pen reports up to 65535) land in the last cell
+    return np.minimum(coordinate // CELL_SIZE, GRID_CELLS - 1)
+
+
+def build(columns: strokes.StrokeColumns) -> StrokeIndex:
+    bounds = np.array(strokes.stroke_bounds(columns), dtype=np.int64).reshape(-1, 2)
+    starts, ends = bounds[:, 0], bounds[:, 1]
+    if not len(starts):
+        empty = np.zeros(0, dtype=np.int64)
+        return StrokeIndex(empty, empty, np.zeros((0, 4), dtype=np.int32),
+                           np.zeros(GRID_CELLS * GRID_CELLS + 1, dtype=np.int64), empty)
+
+    x = columns.x.astype(np.int32)
+    y = columns.y.astype(np.int32)
+    boxes = np.stack([
+        np.minimum.reduceat(x, starts), np.minimum.reduceat(y, starts),
+        np.maximum.reduceat(x, starts), np.maximum.reduceat(y, starts),
+    ], axis=1)
+
+    # One (cell, stroke) pair for every cell under every stroke's box
+    cx0, cy0, cx1, cy1 = (_cells(boxes[:, i]) for i in range(4))
+    width = cx1 - cx0 + 1
+    counts = width * (cy1 - cy0 + 1)
+    stroke_ids = np.repeat(np.arange(len(starts)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cells = (cy0[stroke_ids] + local // width[stroke_ids]) * GRID_CELLS + cx0[stroke_ids] + local % width[stroke_ids]
+
+    order = np.argsort(cells, kind="stable")
+    cell_offsets = np.zeros(GRID_CELLS * GRID_CELLS + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells, minlength=GRID_CELLS * GRID_CELLS), out=cell_offsets[1:])
+    return StrokeIndex(starts, ends, boxes, cell_offsets, stroke_ids[order])
+
+
+def query(index: StrokeIndex, min_x: int, min_y: int, max_x: int, max_y: int) -> np.ndarray:
+    """Ids, in drawing order, of the strokes whose bounding box intersects the region (edges included)."""
+    if not len(index):
+        return np.zeros(0, dtype=np.int64)
+    cx0, cx1 = _cells(np.array([min_x, max_x]))
+    cy0, cy1 = _cells(np.array([min_y, max_y]))
+    cells = (np.arange(cy0, cy1 + 1)[:, None] * GRID_CELLS + np.arange(cx0, cx1 + 1)).ravel()
+    candidates = np.unique(np.concatenate([
+        index.cell_strokes[index.cell_offsets[cell]:index.cell_offsets[cell + 1]] for cell in cells
+    ]))
+    boxes = index.boxes[candidates]
+    hit = (boxes[:, 0] <= max_x) & (boxes[:, 2] >= min_x) & (boxes[:, 1] <= max_y) & (boxes[:, 3] >= min_y)
+    return candidates[hit]
+
+
+def extract(columns: strokes.StrokeColumns, index: StrokeIndex, stroke_ids: np.ndarray) -> strokes.StrokeColumns:
+    """The samples of the given strokes, each one starting a stroke of its own."""
+    starts, ends = index.starts[stroke_ids], index.ends[stroke_ids]
+    lengths = ends - starts
+    samples = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    return strokes.StrokeColumns(
+        x=columns.x[samples],
+        y=columns.y[samples],
+        pressure=columns.pressure[samples],
+        timestamp=columns.timestamp[samples],
+        stroke_starts=(np.cumsum(lengths) - lengths).astype(np.uint32),
+    )
+
+
+def _query_region(columns: strokes.StrokeColumns, index: StrokeIndex,
+                  region: Tuple[int, int, int, int]) -> Tuple[np.ndarray, strokes.StrokeColumns]:
+    stroke_ids = query(index, *region)
+    return stroke_ids, extract(columns, index, stroke_ids)
+
+
+async def query_session(repo: BluetoothRepository, session_id: str, user_id: str,
+                        region: Tuple[int, int, int, int]) -> Optional[Tuple[np.ndarray, strokes.StrokeColumns]]:
+    """
+    (stroke ids, their samples) for the strokes of a session that intersect ``region``
+    (min_x, min_y, max_x, max_y in pen units). None if the session does not exist.
+    """
+    header = await repo.get_header(session_id, user_id)
+    if header is None:
+        return None
+    session_key = (user_id, session_id, raster.session_version(header))
+    columns = await raster.session_columns(repo, header, session_key)
+    index = index_cache.get(session_key)
+    if index is None:
+        index = await run_in_threadpool(build, columns)
+        index_cache.put(session_key, index)
+    return await run_in_threadpool(_query_region, columns, index, region)
@@ -0,0 +1,210 @@
+"""
+Packed columnar encoding for pen samples.
+
+A batch of samples (x, y, pressure, timestamp, as produced by the pen) is sent as
+one little-endian binary payload instead of one JSON object per point:
+
+    header   magic b"SPS1", uint32 point_count, uint32 stroke_count, int64 base_timestamp_ms
+    x        uint16[point_count]   pen coordinates, 0..4096
+    y        uint16[point_count]
+    pressure uint8[point_count]    raw pen pressure, 0..255
+    dt       uint32[point_count]   ms since the previous sample (the first one is relative to base)
+    starts   uint32[stroke_count]  indices of the samples that begin a new stroke (pen down)
+
+Samples before the first start continue the stroke in progress, so a live stream can
+split one stroke across batches. On its own, such a leading run is a stroke by itself.
+Decoding is a handful of NumPy buffer views and one cumulative sum, whatever the
+number of points.
+"""
+
+import struct
+from datetime import datetime, timezone
+from typing import Iterable, List, NamedTuple, Tuple
+
+import numpy as np
+from pydantic import BaseModel, Field, TypeAdapter, field_validator
+
+MAGIC = b"SPS1"
+ENCODING = "packed-v1"
+CONTENT_TYPE = "application/x-smartpen-strokes"
+HEADER = struct.Struct("<4sIIq")
+# x + y + pressure + dt
+BYTES_PER_POINT = 2 + 2 + 1 + 4
+
+
+class StrokeFormatError(ValueError):
+    pass
+
+
+class StrokeColumns(NamedTuple):
+    x: np.ndarray          # uint16
+    y: np.ndarray          # uint16
+    pressure: np.ndarray   # uint8
+    timestamp: np.ndarray  # int64, absolute ms
+    stroke_starts: np.ndarray  # uint32, indices of the points that begin a new stroke
+
+    def __len__(self):
+        return len(self.x)
+
+
+def decode(payload: bytes) -> StrokeColumns:
+    """Decode and validate a packed payload. Raises StrokeFormatError if it is malformed."""
+    if len(payload) < HEADER.size:
+        raise StrokeFormatError("Payload is shorter than the header")
+    magic, n, m, base_timestamp = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise StrokeFormatError("Unknown stroke encoding")
+    expected = HEADER.size + n * BYTES_PER_POINT + m * 4
+    if len(payload) != expected:
+        raise StrokeFormatError(f"Expected {expected} bytes for {n} points and {m} strokes, got {len(payload)}")
+
+    offset = HEADER.size
+    columns = []
+    for dtype in ("<u2", "<u2", "u1", "<u4"):
+        column = np.frombuffer(payload, dtype=dtype, count=n, offset=offset)
+        columns.append(column)
+        offset += column.nbytes
+    x, y, pressure, dt = columns
+    stroke_starts = np.frombuffer(payload, dtype="<u4", count=m, offset=offset)
+
+    if m and (np.any(np.diff(stroke_starts.astype(np.int64)) <= 0) or stroke_starts[-1] >= n):
+        raise StrokeFormatError("Stroke starts must be strictly increasing and within the batch")
+
+    timestamp = base_timestamp + np.cumsum(dt, dtype=np.int64)
+    return StrokeColumns(x, y, pressure, timestamp, stroke_starts)
+
+
+def time_deltas(timestamp: np.ndarray, base_timestamp: int) -> np.ndarray:
+    """The dt column: ms since the previous sample, the first one relative to ``base_timestamp``."""
+    dt = np.diff(np.asarray(timestamp, dtype=np.int64), prepend=base_timestamp)
+    if np.any(dt < 0) or np.any(dt > np.iinfo(np.uint32).max):
+        raise StrokeFormatError("Timestamps must be non-decreasing")
+    return dt.astype("<u4")
+
+
+def encode(columns: StrokeColumns) -> bytes:
+    """Pack columns back into the wire/storage format."""
+    n = len(columns.x)
+    base_timestamp = int(columns.timestamp[0]) if n else 0
+    starts = np.asarray(columns.stroke_starts, dtype="<u4")
+    return b"".join((
+        HEADER.pack(MAGIC, n, len(starts), base_timestamp),
+        np.asarray(columns.x, dtype="<u2").tobytes(),
+        np.asarray(columns.y, dtype="<u2").tobytes(),
+        np.asarray(columns.pressure, dtype="u1").tobytes(),
+        time_deltas(columns.timestamp, base_timestamp).tobytes(),
+        starts.tobytes(),
+    ))
+
+
+def concat(batches: Iterable[StrokeColumns]) -> StrokeColumns:
+    """Join consecutive batches; a batch's leading samples extend the previous batch's last stroke."""
+    batches = list(batches) or [from_points([])]
+    offsets = np.cumsum([0] + [len(b) for b in batches[:-1]], dtype=np.int64)
+    starts = [b.stroke_starts.astype(np.int64) + offset for b, offset in zip(batches, offsets)]
+    return StrokeColumns(
+        x=np.concatenate([b.x for b in batches]),
+        y=np.concatenate([b.y for b in batches]),
+        pressure=np.concatenate([b.pressure for b in batches]),
+        timestamp=np.concatenate([b.timestamp for b in batches]),
+        stroke_starts=np.concatenate(starts).astype(np.uint32),
+    )
+
+
+def tail(columns: StrokeColumns, start: int) -> StrokeColumns:
+    """The samples from index ``start`` on, with stroke starts shifted to match."""
+    starts = columns.stroke_starts.astype(np.int64)
+    return StrokeColumns(
+        x=columns.x[start:],
+        y=columns.y[start:],
+        pressure=columns.pressure[start:],
+        timestamp=columns.timestamp[start:],
+        stroke_starts=(starts[starts >= start] - start).astype(np.uint32),
+    )
+
+
+def select(columns: StrokeColumns, keep: np.ndarray) -> StrokeColumns:
+    """The samples where the boolean mask ``keep`` is set. Every stroke's first sample must be kept."""
+    starts = columns.stroke_starts.astype(np.int64)
+    return StrokeColumns(
+        x=columns.x[keep],
+        y=columns.y[keep],
+        pressure=columns.pressure[keep],
+        timestamp=columns.timestamp[keep],
+        stroke_starts=(np.cumsum(keep)[starts] - 1).astype(np.uint32),
+    )
+
+
+def stroke_bounds(columns: StrokeColumns) -> List[Tuple[int, int]]:
+    """Return (start, end) index pairs of every stroke in a self-contained batch."""
+    n = len(columns)
+    if not n:
+        return []
+    starts = columns.stroke_starts.tolist()
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    return list(zip(starts, starts[1:] + [n]))
+
+
+_DATETIME = TypeAdapter(datetime)
+
+
+class Point(BaseModel):
+    """One sample in the legacy List[dict] shape, checked to fit the columns before it is stored."""
+    x: int = Field(0, ge=0, le=65535)
+    y: int = Field(0, ge=0, le=65535)
+    pressure: int = Field(0, ge=0, le=255)
+    timestamp: int = Field(0, ge=0, le=2 ** 63 - 1)  # ms since the epoch
+
+    @field_validator("x", "y", mode="before")
+    @classmethod
+    def _round_coordinate(cls, value):
+        return round(value) if isinstance(value, float) else value
+
+    @field_validator("pressure", mode="before")
+    @classmethod
+    def _scale_pressure(cls, value):
+        # Some clients report the force normalized to 0..1 rather than as the raw 0..255
+        if isinstance(value, float):
+            return round(value * 255) if 0 <= value <= 1 else round(value)
+        return value
+
+    @field_validator("timestamp", mode="before")
+    @classmethod
+    def _epoch_ms(cls, value):
+        if isinstance(value, str) and not value.isdigit():
+            value = _DATETIME.validate_python(value)
+        if isinstance(value, datetime):
+            if value.tzinfo is None:
+                # Naive times are UTC, as everywhere else in the API
+                value = value.replace(tzinfo=timezone.utc)
+            return round(value.timestamp() * 1000)
+        return value
+
+
+def from_points(points: List[dict], continued: bool = False) -> StrokeColumns:
+    """Build columns from the legacy List[dict] stroke_data (one stroke, or more of the previous one if ``continued``)."""
+    n = len(points)
+    return StrokeColumns(
+        x=np.fromiter((p.get("x", 0) for p in points), dtype=np.uint16, count=n),
+        y=np.fromiter((p.get("y", 0) for p in points), dtype=np.uint16, count=n),
+        pressure=np.fromiter((p.get("pressure", 0) for p in points), dtype=np.uint8, count=n),
+        timestamp=np.fromiter((p.get("timestamp", 0) for p in points), dtype=np.int64, count=n),
+        stroke_starts=np.zeros(1 if n and not continued else 0, dtype=np.uint32),
+    )
+
+
+def from_session(doc: dict) -> StrokeColumns:
+    """Columns for a stored bluetooth_data document, whichever way it was written."""
+    if "packed" in doc:
+        return decode(doc["packed"])
+    if "chunks" in doc:
+        return concat(decode(chunk) for chunk in doc["chunks"])
+    return from_points(doc.get("stroke_data", []))
+
+
+def to_points(columns: StrokeColumns) -> List[dict]:
+    """Expand columns into the legacy List[dict] shape for clients that still expect it."""
+    keys = ("x", "y", "pressure", "timestamp")
+    rows = zip(columns.x.tolist(), columns.y.tolist(), columns.pressure.tolist(), columns.timestamp.tolist())
+    return [dict(zip(keys, row)) for row in rows]
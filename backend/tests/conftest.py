@@ -0,0 +1,44 @@
+"""
+Shared fixtures. Mongo is replaced by mongomock-motor, an in-memory implementation of
+Motor's API, so the suite runs without a server (see requirements-dev.txt):
+
+    cd backend && pip install -r requirements-dev.txt && python -m pytest
+
+Async tests are marked ``@pytest.mark.anyio`` and run on asyncio.
+"""
+
+import os
+import sys
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+# Read at import by the modules under test; keep the process pools small
+os.environ.setdefault("JOB_WORKERS", "1")
+os.environ.setdefault("JOB_POLL_SECONDS", "0.05")
+
+from mongomock_motor import AsyncMongoMockClient  # noqa: E402
+
+import blobs  # noqa: E402
+from repository import DATABASE_NAME, Repositories  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient()[DATABASE_NAME]
+
+
+@pytest.fixture
+def repos(db):
+    return Repositories(db)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return blobs.FileSystemBlobStore(str(tmp_path / "blobs"))
@@ -0,0 +1,73 @@
+import base64
+
+import pytest
+
+import blobs
+
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+
+
+@pytest.mark.anyio
+async def test_offload_and_hydrate_round_trip(store):
+    content = "data:image/png;base64," + base64.b64encode(PNG_HEADER + b"pixels").decode()
+    fields = await blobs.offload_content(store, {"title": "t", "content": content})
+
+    assert "content" not in fields
+    assert fields["content_type"] == "image/png"
+    assert fields["content_size"] == len(PNG_HEADER) + 6
+    assert (await blobs.hydrate_content(store, fields))["content"] == content
+
+
+@pytest.mark.anyio
+async def test_bare_base64_reads_back_bare(store):
+    content = base64.b64encode(b"canvas").decode()
+    fields = await blobs.offload_content(store, {"content": content})
+
+    assert fields["content_type"] is None
+    assert (await blobs.hydrate_content(store, fields))["content"] == content
+
+
+@pytest.mark.anyio
+async def test_empty_content_clears_the_reference(store):
+    fields = await blobs.offload_content(store, {"content": ""})
+    assert fields == {"content_hash": None, "content_type": None, "content_size": 0}
+
+
+@pytest.mark.anyio
+async def test_invalid_base64_is_rejected(store):
+    with pytest.raises(ValueError):
+        await blobs.offload_content(store, {"content": "not base64!"})
+
+
+@pytest.mark.anyio
+async def test_identical_content_is_stored_once(store, tmp_path):
+    first = await store.put(b"same bytes")
+    second = await store.put(b"same bytes")
+
+    assert first == second
+    assert len(list((tmp_path / "blobs").rglob(first))) == 1
+
+
+@pytest.mark.anyio
+async def test_stream_range(store):
+    blob_hash = await store.put(bytes(range(256)) * 4096)
+    chunks = [chunk async for chunk in store.stream(blob_hash, 1000, 300000)]
+
+    assert b"".join(chunks) == (bytes(range(256)) * 4096)[1000:300000]
+    assert all(len(chunk) <= blobs.CHUNK_SIZE for chunk in chunks)
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 100)),
+    ("bytes=100-", (100, 1000)),
+    ("bytes=-10", (990, 1000)),
+    ("bytes=900-5000", (900, 1000)),
+])
+def test_parse_range(header, expected):
+    assert blobs.parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=0-1,5-6", "items=0-1", "bytes=5-2"])
+def test_parse_range_rejects_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        blobs.parse_range(header, 1000)
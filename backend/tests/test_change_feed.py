@@ -0,0 +1,101 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import repository
+
+USER = "user-1"
+
+
+def note(note_id: str) -> dict:
+    now = datetime.utcnow()
+    return {"id": note_id, "user_id": USER, "title": note_id, "content_hash": None, "created_at": now, "updated_at": now}
+
+
+class GatedCollection:
+    """The notes collection, except that an update of ``note_id`` waits for ``release``."""
+
+    def __init__(self, collection, note_id: str):
+        self._collection = collection
+        self._note_id = note_id
+        self.waiting = asyncio.Event()
+        self.release = asyncio.Event()
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    async def find_one_and_update(self, query, *args, **kwargs):
+        if query.get("id") == self._note_id:
+            self.waiting.set()
+            await self.release.wait()
+        return await self._collection.find_one_and_update(query, *args, **kwargs)
+
+
+async def feed(notes, since: int = 0):
+    changes, _ = await notes.changes_since(USER, since, 100)
+    return [(change["id"], change["seq"], change["deleted"]) for change in changes]
+
+
+@pytest.mark.anyio
+async def test_changes_in_sequence_order(repos):
+    notes = repos.notes
+    await notes.create(note("a"))
+    await notes.create(note("b"))
+    await notes.update("a", USER, {"title": "edited"})
+    await notes.delete("b", USER)
+
+    assert await feed(notes) == [("a", 3, False), ("b", 4, True)]
+    assert await feed(notes, 3) == [("b", 4, True)]
+
+
+@pytest.mark.anyio
+async def test_write_that_lands_late_is_not_skipped(repos):
+    notes = repos.notes
+    await notes.create(note("a"))
+    await notes.create(note("b"))
+    since = (await feed(notes))[-1][1]
+
+    gate = GatedCollection(notes.collection, "a")
+    notes.collection = gate
+    slow = asyncio.create_task(notes.update("a", USER, {"title": "slow"}))
+    await gate.waiting.wait()
+    # b's writer reserves the next value after a's, but writes first
+    await notes.update("b", USER, {"title": "fast"})
+    assert await feed(notes, since) == []
+
+    gate.release.set()
+    await slow
+    assert await feed(notes, since) == [("a", 3, False), ("b", 4, False)]
+
+
+@pytest.mark.anyio
+async def test_abandoned_reservation_stops_holding_the_feed_back(repos, monkeypatch):
+    notes = repos.notes
+    await notes.create(note("a"))
+    await notes._reserve_change_seqs(USER, 1)  # Its writer never finishes
+    await notes.create(note("b"))
+    assert await feed(notes) == [("a", 1, False)]
+
+    monkeypatch.setattr(repository, "CHANGE_SEQ_LEASE_SECONDS", 0)
+    assert await feed(notes) == [("a", 1, False), ("b", 3, False)]
+
+
+@pytest.mark.anyio
+async def test_concurrent_reservations_do_not_overlap(repos):
+    firsts = await asyncio.gather(*(repos.notes._reserve_change_seqs(USER, 2) for _ in range(10)))
+    assert sorted(firsts) == list(range(1, 21, 2))
+
+
+@pytest.mark.anyio
+async def test_batch_operations_get_consecutive_values(repos):
+    notes = repos.notes
+    await notes.create(note("a"))
+    outcomes = await notes.apply_batch(USER, [
+        {"op": "create", "doc": note("b")},
+        {"op": "update", "id": "a", "fields": {"title": "edited"}},
+        {"op": "delete", "id": "missing"},
+    ])
+
+    assert [outcome for outcome, _ in outcomes] == ["applied", "applied", "not_found"]
+    assert await feed(notes) == [("b", 2, False), ("a", 3, False)]
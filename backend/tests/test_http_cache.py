@@ -0,0 +1,96 @@
+import gzip
+import json
+from datetime import datetime
+
+import pytest
+
+import fast_json
+import http_cache
+
+UPDATED_AT = datetime(2024, 5, 1, 12, 30, 15, 123000)
+NOTE_ID = "3f2b6c1e-9a4d-4e8b-b1f0-6d2c9e7a5b10"
+LISTING = [{"id": str(i), "title": "note " * 20} for i in range(50)]
+
+
+def test_note_etag_round_trip():
+    etag = http_cache.note_etag(NOTE_ID, UPDATED_AT)
+    assert http_cache.parse_note_etag(etag) == (NOTE_ID, UPDATED_AT)
+    assert http_cache.parse_note_etag(f" {etag} ") == (NOTE_ID, UPDATED_AT)
+
+
+@pytest.mark.parametrize("coding", http_cache.CODINGS)
+def test_parse_note_etag_of_a_compressed_representation(coding):
+    etag = http_cache.encoded_etag(http_cache.note_etag(NOTE_ID, UPDATED_AT), coding)
+    assert etag.endswith(f'-{coding}"')
+    assert http_cache.parse_note_etag(etag) == (NOTE_ID, UPDATED_AT)
+
+
+@pytest.mark.parametrize("etag", ['"nodot"', '"id.notanumber"', '".123"', '"id.12-zstd"', ""])
+def test_parse_note_etag_rejects_foreign_etags(etag):
+    assert http_cache.parse_note_etag(etag) is None
+
+
+def test_encoded_etag_without_coding_is_unchanged():
+    assert http_cache.encoded_etag('"abc"', None) == '"abc"'
+
+
+def test_match():
+    etag = http_cache.hash_etag("notes", "user", 3)
+    br = http_cache.encoded_etag(etag, "br")
+    assert http_cache.match(None, etag) is None
+    assert http_cache.match('"other"', etag) is None
+    assert http_cache.match(etag, etag) == etag
+    assert http_cache.match(f'"other", W/{etag}', etag) == etag
+    # The 304 repeats the representation the client holds
+    assert http_cache.match(br, etag) == br
+    assert http_cache.match("*", etag) == etag
+    assert not http_cache.matches(http_cache.encoded_etag('"other"', "gzip"), etag)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("coding", ["br", "gzip"])
+async def test_compressed_responses_get_their_own_etag(coding):
+    etag = http_cache.hash_etag("notes", "user", 50)
+    response = await fast_json.json_response(LISTING, coding, {"ETag": etag})
+    assert response.headers["Content-Encoding"] == coding
+    assert response.headers["ETag"] == http_cache.encoded_etag(etag, coding)
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert http_cache.matches(response.headers["ETag"], etag)
+
+
+@pytest.mark.anyio
+async def test_uncompressed_responses_keep_the_etag():
+    etag = http_cache.hash_etag("notes", "user", 50)
+    for accept_encoding in (None, "identity", "gzip;q=0, br;q=0"):
+        response = await fast_json.json_response(LISTING, accept_encoding, {"ETag": etag})
+        assert "Content-Encoding" not in response.headers
+        assert response.headers["ETag"] == etag
+        assert json.loads(response.body) == LISTING
+    small = await fast_json.json_response([], "gzip", {"ETag": etag})
+    assert small.headers["ETag"] == etag
+
+
+@pytest.mark.anyio
+async def test_gzip_body():
+    response = await fast_json.json_response(LISTING, "gzip")
+    assert json.loads(gzip.decompress(response.body)) == LISTING
+    assert "ETag" not in response.headers
+
+
+@pytest.mark.anyio
+async def test_if_match_guards_updates(repos):
+    await repos.notes.create({
+        "id": NOTE_ID, "user_id": "user", "title": "a", "content_hash": None,
+        "created_at": UPDATED_AT, "updated_at": UPDATED_AT,
+    })
+    seen = http_cache.encoded_etag(http_cache.note_etag(NOTE_ID, UPDATED_AT), "gzip")
+    note_id, expected = http_cache.parse_note_etag(seen)
+    assert note_id == NOTE_ID
+
+    # (mongomock returns None from an update whose filter no longer matches afterwards, so
+    # check the note itself)
+    await repos.notes.update(NOTE_ID, "user", {"title": "b", "updated_at": datetime(2024, 5, 2)}, expected)
+    assert (await repos.notes.get(NOTE_ID, "user"))["title"] == "b"
+    # The ETag the client saw is stale now
+    await repos.notes.update(NOTE_ID, "user", {"title": "c", "updated_at": datetime(2024, 5, 3)}, expected)
+    assert (await repos.notes.get(NOTE_ID, "user"))["title"] == "b"
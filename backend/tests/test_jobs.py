@@ -0,0 +1,215 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import jobs
+
+USER = "user-1"
+
+
+@pytest.fixture
+def kinds(monkeypatch):
+    """Test job kinds: "echo" returns its params, "block" runs until cancelled."""
+    async def echo(context, params):
+        return params
+
+    async def block(context, params):
+        await asyncio.Event().wait()
+
+    monkeypatch.setitem(jobs.KINDS, "echo", jobs.JobKind(echo, True))
+    monkeypatch.setitem(jobs.KINDS, "block", jobs.JobKind(block, True))
+
+
+async def until(condition, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not await condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def status(repos, job_id):
+    return (await repos.jobs.get(job_id, USER))["status"]
+
+
+async def queue(repos, job_id, **fields):
+    await repos.jobs.create(dict({
+        "id": job_id, "user_id": USER, "kind": "block", "params": {}, "priority": jobs.PRIORITY_NORMAL,
+        "status": "queued", "attempts": 0, "created_at": datetime.utcnow(),
+    }, **fields))
+
+
+async def slots(repos, user_id=USER):
+    doc = await repos.db.counters.find_one({"_id": f"running_jobs:{user_id}"})
+    return doc["jobs"] if doc else []
+
+
+@pytest.mark.anyio
+async def test_stop_right_after_submit(repos, store, kinds):
+    scheduler = jobs.JobScheduler(repos, store)
+    await scheduler.start()
+    await scheduler.submit(USER, "echo", {})
+    # The submit left the dispatcher's wakeup set, which used to make it ignore the cancellation
+    await asyncio.wait_for(scheduler.stop(), 5)
+    assert scheduler._dispatcher.done()
+
+
+@pytest.mark.anyio
+async def test_job_runs_to_completion(repos, store, kinds):
+    scheduler = jobs.JobScheduler(repos, store)
+    await scheduler.start()
+    try:
+        job = await scheduler.submit(USER, "echo", {"answer": 42})
+
+        async def finished():
+            return await status(repos, job["id"]) == "succeeded"
+        await until(finished)
+        assert (await repos.jobs.get(job["id"], USER))["result"] == {"answer": 42}
+        assert await slots(repos) == []
+    finally:
+        await asyncio.wait_for(scheduler.stop(), 5)
+
+
+@pytest.mark.anyio
+async def test_stop_hands_running_jobs_back(repos, store, kinds):
+    scheduler = jobs.JobScheduler(repos, store)
+    await scheduler.start()
+    job = await scheduler.submit(USER, "block", {})
+
+    async def running():
+        return await status(repos, job["id"]) == "running"
+    await until(running)
+    await asyncio.wait_for(scheduler.stop(), 5)
+
+    stopped = await repos.jobs.get(job["id"], USER)
+    assert stopped["status"] == "queued"
+    assert "worker_id" not in stopped
+    assert await slots(repos) == []
+
+
+@pytest.mark.anyio
+async def test_schedulers_share_the_per_user_cap(repos, store, kinds):
+    schedulers = [jobs.JobScheduler(repos, store, process_workers=2, max_running_per_user=1) for _ in range(2)]
+    for scheduler in schedulers:
+        await scheduler.start()
+    try:
+        for _ in range(3):
+            await schedulers[0].submit(USER, "block", {})
+
+        async def one_running():
+            return await repos.jobs.collection.count_documents({"status": "running"}) == 1
+        await until(one_running)
+        await asyncio.sleep(0.2)
+        assert await repos.jobs.collection.count_documents({"status": "running"}) == 1
+        assert sum(len(scheduler._running) for scheduler in schedulers) == 1
+    finally:
+        for scheduler in schedulers:
+            await asyncio.wait_for(scheduler.stop(), 5)
+
+
+@pytest.mark.anyio
+async def test_take_slot_enforces_the_cap_after_racing_claims(repos):
+    await queue(repos, "a")
+    await queue(repos, "b")
+    # Both workers checked saturated_users before either claimed
+    first = await repos.jobs.claim("worker-1", 60, [])
+    second = await repos.jobs.claim("worker-2", 60, [])
+
+    assert await repos.jobs.take_slot(USER, first["id"], 1)
+    assert not await repos.jobs.take_slot(USER, second["id"], 1)
+    await repos.jobs.unclaim(second["id"], "worker-2")
+
+    requeued = await repos.jobs.get(second["id"], USER)
+    assert requeued["status"] == "queued"
+    assert requeued["attempts"] == 0
+    assert "worker_id" not in requeued and "lease_until" not in requeued
+    assert await slots(repos) == [first["id"]]
+
+
+@pytest.mark.anyio
+async def test_slots_are_per_user(repos):
+    await queue(repos, "a")
+    await queue(repos, "b", user_id="user-2")
+    first = await repos.jobs.claim("worker-1", 60, [])
+    second = await repos.jobs.claim("worker-1", 60, [])
+
+    assert await repos.jobs.take_slot(first["user_id"], first["id"], 1)
+    assert await repos.jobs.take_slot(second["user_id"], second["id"], 1)
+
+
+@pytest.mark.anyio
+async def test_finish_frees_the_slot(repos):
+    await queue(repos, "a")
+    await queue(repos, "b")
+    first = await repos.jobs.claim("worker-1", 60, [])
+    assert await repos.jobs.take_slot(USER, first["id"], 1)
+
+    assert await repos.jobs.finish(first["id"], "worker-1", "succeeded", {})
+    second = await repos.jobs.claim("worker-1", 60, [])
+    assert await repos.jobs.take_slot(USER, second["id"], 1)
+    assert await slots(repos) == [second["id"]]
+
+
+@pytest.mark.anyio
+async def test_finish_by_a_worker_that_lost_the_job_keeps_the_slot(repos):
+    await queue(repos, "a")
+    job = await repos.jobs.claim("worker-1", 60, [])
+    assert await repos.jobs.take_slot(USER, job["id"], 1)
+    await repos.jobs.collection.update_one({"id": job["id"]}, {"$set": {"worker_id": "worker-2"}})
+
+    assert not await repos.jobs.finish(job["id"], "worker-1", "failed")
+    assert await status(repos, job["id"]) == "running"
+    assert await slots(repos) == [job["id"]]
+
+
+@pytest.mark.anyio
+async def test_slot_of_a_dead_worker_is_reclaimed(repos):
+    await queue(repos, "a")
+    await queue(repos, "b")
+    dead = await repos.jobs.claim("worker-1", 60, [])
+    assert await repos.jobs.take_slot(USER, dead["id"], 1)
+    await repos.jobs.collection.update_one(
+        {"id": dead["id"]}, {"$set": {"lease_until": datetime.utcnow() - timedelta(seconds=1)}}
+    )
+    await repos.jobs.requeue_expired(jobs.MAX_ATTEMPTS)
+    assert await status(repos, dead["id"]) == "queued"
+
+    # The oldest job comes first, so the requeued one is claimed again
+    job = await repos.jobs.claim("worker-2", 60, [])
+    assert job["id"] == dead["id"]
+    assert await repos.jobs.take_slot(USER, job["id"], 1)
+    assert await slots(repos) == [dead["id"]]
+
+
+@pytest.mark.anyio
+async def test_stale_slot_is_cleared_when_full(repos):
+    await queue(repos, "a")
+    await queue(repos, "b", created_at=datetime.utcnow() + timedelta(seconds=1))
+    dead = await repos.jobs.claim("worker-1", 60, [])
+    assert await repos.jobs.take_slot(USER, dead["id"], 1)
+    await repos.jobs.collection.update_one(
+        {"id": dead["id"]}, {"$set": {"lease_until": datetime.utcnow() - timedelta(seconds=1)}}
+    )
+    await repos.jobs.requeue_expired(1)
+    assert await status(repos, dead["id"]) == "failed"
+
+    job = await repos.jobs.claim("worker-2", 60, [])
+    assert job["id"] == "b"
+    assert await repos.jobs.take_slot(USER, job["id"], 1)
+    assert await slots(repos) == ["b"]
+
+
+@pytest.mark.anyio
+async def test_leases(repos):
+    await queue(repos, "a")
+    job = await repos.jobs.claim("worker-1", 60, [])
+    assert job["status"] == "running" and job["attempts"] == 1
+    assert await repos.jobs.claim("worker-2", 60, []) is None
+
+    await repos.jobs.cancel(job["id"], USER)
+    assert await repos.jobs.renew("worker-1", [job["id"]], 60) == [job["id"]]
+    # Renewing leaves jobs another worker took over alone
+    assert await repos.jobs.renew("worker-2", [job["id"]], 60) == []
+
+    await repos.jobs.requeue_expired(jobs.MAX_ATTEMPTS)
+    assert await status(repos, job["id"]) == "running"
@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+USER = "user-1"
+
+
+def note(note_id: str, **fields) -> dict:
+    now = datetime.utcnow().replace(microsecond=0)
+    return dict({"id": note_id, "user_id": USER, "title": note_id, "created_at": now, "updated_at": now}, **fields)
+
+
+@pytest.mark.anyio
+async def test_mixed_batch(repos):
+    notes = repos.notes
+    await notes.create(note("keep"))
+    await notes.create(note("drop"))
+
+    outcomes = await notes.apply_batch(USER, [
+        {"op": "create", "doc": note("new")},
+        {"op": "update", "id": "keep", "fields": {"title": "renamed"}},
+        {"op": "delete", "id": "drop"},
+        {"op": "update", "id": "missing", "fields": {"title": "x"}},
+    ])
+
+    assert [outcome for outcome, _ in outcomes] == ["applied", "applied", "applied", "not_found"]
+    assert outcomes[1][1]["title"] == "renamed"
+    assert "content" not in outcomes[1][1]
+    assert await notes.get("drop", USER) is None
+    assert (await notes.get("new", USER))["title"] == "new"
+
+
+@pytest.mark.anyio
+async def test_stale_versions_conflict(repos):
+    notes = repos.notes
+    a, b, c = note("a"), note("b"), note("c")
+    for doc in (a, b, c):
+        await notes.create(doc)
+    stale = a["updated_at"] - timedelta(seconds=1)
+
+    outcomes = await notes.apply_batch(USER, [
+        {"op": "update", "id": "a", "fields": {"title": "lost"}, "expected_updated_at": stale},
+        {"op": "delete", "id": "b", "expected_updated_at": stale},
+        {"op": "update", "id": "c", "fields": {"title": "won"}, "expected_updated_at": c["updated_at"]},
+    ])
+
+    assert [outcome for outcome, _ in outcomes] == ["conflict", "conflict", "applied"]
+    assert (await notes.get("a", USER))["title"] == "a"
+    assert await notes.get("b", USER) is not None
+    assert (await notes.get("c", USER))["title"] == "won"
+
+
+@pytest.mark.anyio
+async def test_duplicate_create(repos, db):
+    await db.notes.create_index([("id", 1)], unique=True)
+    await repos.notes.create(note("a"))
+
+    outcomes = await repos.notes.apply_batch(USER, [{"op": "create", "doc": note("a")}])
+    assert outcomes == [("duplicate", None)]
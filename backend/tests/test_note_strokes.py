@@ -0,0 +1,182 @@
+import base64
+import io
+from datetime import datetime
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import blobs
+import http_cache
+import jobs
+import note_strokes
+import strokes
+
+USER = "user-1"
+
+
+def batch(start_ts: int, n: int = 20, x: int = 1000) -> bytes:
+    return strokes.encode(strokes.StrokeColumns(
+        x=np.full(n, x, dtype=np.uint16),
+        y=np.linspace(500, 3500, n).astype(np.uint16),
+        pressure=np.full(n, 200, dtype=np.uint8),
+        timestamp=start_ts + np.arange(n, dtype=np.int64) * 5,
+        stroke_starts=np.array([0], dtype=np.uint32),
+    ))
+
+
+def png(color, size=(64, 64)) -> bytes:
+    out = io.BytesIO()
+    Image.new("RGBA", size, color).save(out, "PNG")
+    return out.getvalue()
+
+
+async def create_note(repos, **fields):
+    now = datetime.utcnow()
+    await repos.notes.create(dict(
+        {"id": "n", "user_id": USER, "title": "n", "content_hash": None, "created_at": now, "updated_at": now},
+        **fields
+    ))
+
+
+async def append(repos, store, payload: bytes):
+    return await note_strokes.append(repos.notes, store, "n", USER, payload, strokes.decode(payload))
+
+
+async def compact(repos, store):
+    async def run_cpu(func, *args):
+        return func(*args)
+    context = jobs.JobContext(repos, store, {"user_id": USER}, run_cpu)
+    return await note_strokes.compact(context, {"note_id": "n"})
+
+
+@pytest.mark.anyio
+async def test_appends_read_back_as_one_vector(repos, store):
+    await create_note(repos)
+    await append(repos, store, batch(1000))
+    await append(repos, store, batch(2000))
+
+    _, vector = await note_strokes.read_vector(repos.notes, store, "n", USER)
+    merged = strokes.decode(vector)
+    assert len(merged) == 40
+    assert merged.stroke_starts.tolist() == [0, 20]
+    assert merged.timestamp[20] == 2000
+
+
+@pytest.mark.anyio
+async def test_batch_starting_before_the_log_ends_is_refused(repos, store):
+    await create_note(repos)
+    await append(repos, store, batch(2000))
+
+    with pytest.raises(note_strokes.StrokesOutOfOrder):
+        await append(repos, store, batch(1000))
+    # The note stays readable and compactable
+    _, vector = await note_strokes.read_vector(repos.notes, store, "n", USER)
+    assert len(strokes.decode(vector)) == 20
+    assert (await compact(repos, store))["compacted"]
+
+
+@pytest.mark.anyio
+async def test_batch_before_the_snapshot_ends_is_refused(repos, store):
+    await create_note(repos)
+    await append(repos, store, batch(2000))
+    await compact(repos, store)
+
+    with pytest.raises(note_strokes.StrokesOutOfOrder):
+        await append(repos, store, batch(1000))
+    assert await append(repos, store, batch(3000)) is not None
+
+
+@pytest.mark.anyio
+async def test_end_of_older_logs_is_worked_out(repos, store):
+    await create_note(repos)
+    await append(repos, store, batch(2000))
+    await repos.notes.collection.update_one({"id": "n"}, {"$unset": {"strokes_end_ts": ""}})
+
+    with pytest.raises(note_strokes.StrokesOutOfOrder):
+        await append(repos, store, batch(1000))
+    assert await append(repos, store, batch(3000)) is not None
+
+
+@pytest.mark.anyio
+async def test_missing_note(repos, store):
+    assert await append(repos, store, batch(1000)) is None
+
+
+@pytest.mark.anyio
+async def test_compaction_gives_the_note_a_new_version(repos, store):
+    await create_note(repos)
+    log_state = await append(repos, store, batch(1000))
+    etag = http_cache.note_etag("n", log_state["updated_at"])
+    listing = await repos.notes.fingerprint(USER)
+    changes, _ = await repos.notes.changes_since(USER, 0, 10)
+
+    assert (await compact(repos, store))["compacted"]
+
+    note = await repos.notes.get("n", USER)
+    assert note["content_hash"] and note["stroke_log_length"] == 0
+    assert not http_cache.matches(etag, http_cache.note_etag("n", note["updated_at"]))
+    assert await repos.notes.fingerprint(USER) != listing
+    later, _ = await repos.notes.changes_since(USER, changes[-1]["seq"], 10)
+    assert [change["id"] for change in later] == ["n"]
+
+
+@pytest.mark.anyio
+async def test_compaction_draws_over_an_inline_canvas(repos, store):
+    red = png((255, 0, 0, 255))
+    await create_note(repos, content="data:image/png;base64," + base64.b64encode(red).decode())
+    await append(repos, store, batch(1000))
+
+    assert (await compact(repos, store))["compacted"]
+
+    note = await repos.notes.collection.find_one({"id": "n"})
+    assert "content" not in note
+    canvas = Image.open(io.BytesIO(await store.read(note["content_hash"]))).convert("RGBA")
+    assert canvas.size == (64, 64)
+    # The old drawing is still there next to the new stroke
+    assert canvas.getpixel((60, 2)) == (255, 0, 0, 255)
+
+
+@pytest.mark.anyio
+async def test_canvas_written_during_compaction_is_kept(repos, store):
+    await create_note(repos, content="data:image/png;base64," + base64.b64encode(png((255, 0, 0, 255))).decode())
+    await append(repos, store, batch(1000))
+    blue = png((0, 0, 255, 255))
+    folds = 0
+
+    async def run_cpu(func, *args):
+        nonlocal folds
+        folds += func is note_strokes.fold
+        if folds == 1 and func is note_strokes.fold:
+            # A PUT of the note lands while the first fold runs
+            fields = await blobs.offload_content(store, {"content": "data:image/png;base64," + base64.b64encode(blue).decode()})
+            await repos.notes.update("n", USER, dict(fields, updated_at=datetime.utcnow()))
+        return func(*args)
+
+    context = jobs.JobContext(repos, store, {"user_id": USER}, run_cpu)
+    assert (await note_strokes.compact(context, {"note_id": "n"}))["compacted"]
+    assert folds == 2
+
+    note = await repos.notes.get("n", USER)
+    canvas = Image.open(io.BytesIO(await store.read(note["content_hash"]))).convert("RGBA")
+    # Folded over the canvas the PUT wrote, not the one the first fold started from
+    assert canvas.getpixel((60, 2)) == (0, 0, 255, 255)
+    assert note["stroke_log_length"] == 0
+
+
+@pytest.mark.anyio
+async def test_compaction_gives_up_on_a_note_that_keeps_changing(repos, store):
+    await create_note(repos)
+    await append(repos, store, batch(1000))
+
+    colors = [(0, 255, 0, 255), (0, 0, 255, 255)]
+
+    async def run_cpu(func, *args):
+        colors.reverse()
+        fields = await blobs.offload_content(store, {"content": base64.b64encode(png(colors[0])).decode()})
+        await repos.notes.update("n", USER, fields)
+        return func(*args)
+
+    context = jobs.JobContext(repos, store, {"user_id": USER}, run_cpu)
+    assert not (await note_strokes.compact(context, {"note_id": "n"}))["compacted"]
+    assert (await repos.notes.get("n", USER))["stroke_log_length"] == 1
@@ -0,0 +1,80 @@
+import base64
+import io
+import os
+from datetime import datetime
+
+import pytest
+from PIL import Image
+from pypdf import PdfReader
+
+import pdf_export
+
+USER = "user-1"
+
+pytestmark = pytest.mark.skipif(not os.path.exists(pdf_export.FONT_PATH), reason="PDF export font not installed")
+
+
+def png(size=(200, 100)) -> bytes:
+    out = io.BytesIO()
+    Image.new("RGBA", size, (0, 0, 255, 128)).save(out, "PNG")
+    return out.getvalue()
+
+
+async def export(repos, store, notes) -> PdfReader:
+    now = datetime.utcnow()
+    for note in notes:
+        await repos.notes.create(dict({"user_id": USER, "created_at": now, "updated_at": now}, **note))
+    chunks = [chunk async for chunk in pdf_export.export_notes(repos.notes, store, USER, [n["id"] for n in notes])]
+    # Strict: a bad cross-reference table or object offset fails the parse
+    return PdfReader(io.BytesIO(b"".join(chunks)), strict=True)
+
+
+@pytest.mark.anyio
+async def test_document_parses(repos, store):
+    text = "Распознанный текст заметки. " * 400
+    pdf = await export(repos, store, [
+        {"id": "a", "title": "Первая", "content_hash": await store.put(png()), "content_type": "image/png",
+         "text_content": text},
+        {"id": "b", "title": "Second", "content": "", "text_content": None},
+    ])
+
+    assert len(pdf.pages) >= 3
+    assert "Первая" in pdf.pages[0].extract_text()
+    assert pdf.pages[0].images[0].image.size == (200, 100)
+    assert "Распознанный" in pdf.pages[1].extract_text()
+    assert "Second" in pdf.pages[-1].extract_text()
+
+
+@pytest.mark.anyio
+async def test_unreadable_canvases_are_left_out(repos, store):
+    pdf = await export(repos, store, [
+        {"id": "a", "title": "Not an image", "content": base64.b64encode(b"hello").decode()},
+        {"id": "b", "title": "Not base64", "content": "%%%"},
+        {"id": "c", "title": "Truncated", "content_hash": await store.put(png()[:60]), "content_type": "image/png"},
+        {"id": "d", "title": "Fine", "content_hash": await store.put(png()), "content_type": "image/png"},
+    ])
+
+    assert [page.extract_text().strip() for page in pdf.pages] == ["Not an image", "Not base64", "Truncated", "Fine"]
+    assert "/XObject" not in pdf.pages[0]["/Resources"]
+    assert "/XObject" in pdf.pages[3]["/Resources"]
+
+
+def test_wrap_breaks_long_words():
+    writer = pdf_export.PDFWriter(pdf_export.load_font())
+    lines = writer.wrap("short " + "x" * 500, pdf_export.TEXT_SIZE)
+
+    assert lines[0] == "short"
+    assert all(writer.text_width(line, pdf_export.TEXT_SIZE) <= pdf_export.CONTENT_WIDTH for line in lines)
+    assert "".join(lines[1:]) == "x" * 500
+
+
+@pytest.mark.anyio
+async def test_only_the_glyphs_used_are_embedded(repos, store):
+    pdf = await export(repos, store, [{"id": "a", "title": "Заметка", "text_content": "Короткий текст"}])
+
+    font = pdf.pages[0]["/Resources"]["/Font"]["/F1"]
+    descendant = font["/DescendantFonts"][0].get_object()
+    assert font["/BaseFont"].split("+")[1] == pdf_export.load_font().name.decode()
+    embedded = descendant["/FontDescriptor"]["/FontFile2"].get_data()
+    assert len(embedded) < os.path.getsize(pdf_export.FONT_PATH) / 10
+    assert "Короткий текст" in pdf.pages[0].extract_text()
@@ -0,0 +1,59 @@
+import pytest
+from prometheus_client import REGISTRY
+
+import principals
+
+
+def lookups(result: str) -> float:
+    return REGISTRY.get_sample_value("smartpen_principal_cache_lookups_total", {"result": result}) or 0.0
+
+
+def test_principal_drops_the_password_hash():
+    assert principals.principal({"id": "1", "username": "u", "password": "hash"}) == {"id": "1", "username": "u"}
+
+
+@pytest.mark.anyio
+async def test_hit_miss_and_invalidate():
+    hits, misses = lookups("hit"), lookups("miss")
+    cache = principals.MemoryPrincipalCache(max_entries=10, ttl=60)
+    assert await cache.get("u") is None
+    await cache.put("u", {"id": "1"})
+    assert REGISTRY.get_sample_value("smartpen_principal_cache_entries") == 1
+    assert await cache.get("u") == {"id": "1"}
+    await cache.invalidate("u")
+    assert await cache.get("u") is None
+    assert (lookups("hit") - hits, lookups("miss") - misses) == (1, 2)
+    assert REGISTRY.get_sample_value("smartpen_principal_cache_entries") == 0
+
+
+@pytest.mark.anyio
+async def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(principals.time, "monotonic", lambda: now[0])
+    cache = principals.MemoryPrincipalCache(max_entries=10, ttl=30)
+    await cache.put("u", {"id": "1"})
+
+    now[0] += 29
+    assert await cache.get("u") is not None
+    now[0] += 1
+    assert await cache.get("u") is None
+
+
+@pytest.mark.anyio
+async def test_least_recently_used_is_evicted():
+    cache = principals.MemoryPrincipalCache(max_entries=2, ttl=60)
+    await cache.put("a", {"id": "a"})
+    await cache.put("b", {"id": "b"})
+    await cache.get("a")
+    await cache.put("c", {"id": "c"})
+
+    assert await cache.get("b") is None
+    assert await cache.get("a") is not None
+    assert await cache.get("c") is not None
+
+
+def test_ttl_stays_below_the_token_lifetime(monkeypatch):
+    monkeypatch.setenv("PRINCIPAL_CACHE_TTL_SECONDS", "3600")
+    assert principals.create_cache(600).ttl == 300
+    monkeypatch.setenv("PRINCIPAL_CACHE", "none")
+    assert isinstance(principals.create_cache(600), principals.NullPrincipalCache)
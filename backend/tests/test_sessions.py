@@ -0,0 +1,215 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+import fast_json
+import indexes
+import repository
+import sessions
+import simplify
+import strokes
+
+USER = "user-1"
+SESSION = "session-1"
+
+
+def random_columns(n: int, stroke_count: int, seed: int = 0, start_ts: int = 1_700_000_000_000) -> strokes.StrokeColumns:
+    rng = np.random.default_rng(seed)
+    starts = np.sort(rng.choice(np.arange(1, n), size=stroke_count - 1, replace=False)) if stroke_count > 1 else []
+    return strokes.StrokeColumns(
+        x=rng.integers(0, 4096, n).astype(np.uint16),
+        y=rng.integers(0, 4096, n).astype(np.uint16),
+        pressure=rng.integers(0, 256, n).astype(np.uint8),
+        timestamp=start_ts + np.cumsum(rng.integers(0, 20, n)),
+        stroke_starts=np.concatenate([[0], starts]).astype(np.uint32),
+    )
+
+
+def assert_same(a: strokes.StrokeColumns, b: strokes.StrokeColumns) -> None:
+    for field in strokes.StrokeColumns._fields:
+        assert getattr(a, field).tolist() == getattr(b, field).tolist(), field
+
+
+@pytest.fixture
+async def chunk_index(db):
+    spec = next(spec for spec in indexes.INDEXES if spec.name == "bluetooth_chunks_session_index")
+    await indexes._create_index(db, spec)
+
+
+async def store_session(repos, columns, session_id=SESSION, user_id=USER) -> dict:
+    header = {"id": session_id, "user_id": user_id, "device_id": "pen", "point_count": len(columns)}
+    await repos.bluetooth.create(header, sessions.packed_chunks(columns))
+    return await repos.bluetooth.get_header(session_id, user_id)
+
+
+async def read_packed(repos, header) -> bytes:
+    return b"".join([piece async for piece in sessions.packed(repos.bluetooth, header)])
+
+
+def test_split_and_concat():
+    columns = random_columns(1000, 40)
+    batches = sessions.split(columns, 128)
+    assert [len(batch) for batch in batches] == [128] * 7 + [104]
+    assert_same(strokes.concat(batches), columns)
+
+
+def test_part_round_trip():
+    columns = random_columns(500, 9)
+    part, totals = sessions.pack_part(columns)
+    assert totals == {
+        "point_count": 500, "start_count": 9,
+        "start_ts": int(columns.timestamp[0]), "end_ts": int(columns.timestamp[-1]),
+    }
+    assert_same(sessions.unpack_part(part), columns)
+
+
+@pytest.mark.anyio
+async def test_stored_session_reads_back(repos, chunk_index):
+    columns = random_columns(2 * repository.SESSION_CHUNK_POINTS + 1000, 300)
+    header = await store_session(repos, columns)
+    assert sessions.is_chunked(header)
+    assert await repos.bluetooth.chunks.count_documents({"session_id": SESSION}) == 3
+
+    assert_same(await sessions.columns(repos.bluetooth, header), columns)
+    # Assembled a column at a time, the stream is what encoding the whole session gives
+    assert await read_packed(repos, header) == strokes.encode(columns)
+
+
+@pytest.mark.anyio
+async def test_json_document(repos, chunk_index):
+    columns = random_columns(300, 5)
+    header = await store_session(repos, columns)
+    document = b"".join([piece async for piece in sessions.json_document(repos.bluetooth, header)])
+    expected = fast_json.dumps(dict(
+        {key: value for key, value in header.items() if key != "storage"}, stroke_data=strokes.to_points(columns)
+    ))
+    assert document == expected
+
+
+@pytest.mark.anyio
+async def test_users_may_share_a_session_id(repos, chunk_index):
+    mine, theirs = random_columns(400, 4, seed=1), random_columns(700, 6, seed=2)
+    my_header = await store_session(repos, mine)
+    their_header = await store_session(repos, theirs, user_id="user-2")
+
+    assert_same(await sessions.columns(repos.bluetooth, my_header), mine)
+    assert_same(await sessions.columns(repos.bluetooth, their_header), theirs)
+
+
+@pytest.mark.anyio
+async def test_chunk_index_is_unique_per_user_and_session(repos, chunk_index):
+    await repos.bluetooth.chunks.insert_one({"user_id": USER, "session_id": SESSION, "index": 0})
+    with pytest.raises(DuplicateKeyError):
+        await repos.bluetooth.chunks.insert_one({"user_id": USER, "session_id": SESSION, "index": 0})
+
+
+async def append_live(repos, columns, expected_seq, user_id=USER, session_id=SESSION) -> bool:
+    part, totals = sessions.pack_part(columns)
+    stats = simplify.Simplification(np.ones(len(columns), dtype=bool), 0.0, 0.0).stats()
+    return await repos.bluetooth.append_live_chunk(
+        session_id, user_id, part, totals, expected_seq, expected_seq + 1, stats
+    )
+
+
+def live_batches(count: int, n: int = 20):
+    return [random_columns(n, 2, seed=i, start_ts=1_700_000_000_000 + i * 10_000) for i in range(count)]
+
+
+@pytest.mark.anyio
+async def test_live_session_rolls_over_to_new_chunks(repos, chunk_index, monkeypatch):
+    monkeypatch.setattr(repository, "SESSION_CHUNK_POINTS", 50)
+    header = await sessions.open_live(repos.bluetooth, SESSION, USER, "pen")
+    assert header["acked_seq"] == 0
+
+    batches = live_batches(7)
+    for seq, batch in enumerate(batches):
+        assert await append_live(repos, batch, seq)
+
+    chunks = [chunk async for chunk in repos.bluetooth.iter_chunks(SESSION, USER)]
+    # A chunk takes parts until it holds 50 samples (three batches of 20)
+    assert [len(chunk["parts"]) for chunk in chunks] == [3, 3, 1]
+    assert [chunk["sealed"] for chunk in chunks] == [True, True, False]
+    assert [chunk["last_seq"] for chunk in chunks] == [3, 6, 7]
+
+    header = await repos.bluetooth.get_header(SESSION, USER)
+    assert header["acked_seq"] == 7 and header["point_count"] == 140
+    assert_same(await sessions.columns(repos.bluetooth, header), strokes.concat(batches))
+    assert await read_packed(repos, header) == strokes.encode(strokes.concat(batches))
+    assert (await sessions.open_live(repos.bluetooth, SESSION, USER, "pen"))["acked_seq"] == 7
+
+
+@pytest.mark.anyio
+async def test_live_append_at_a_stale_seq_is_refused(repos, chunk_index, monkeypatch):
+    monkeypatch.setattr(repository, "SESSION_CHUNK_POINTS", 50)
+    await sessions.open_live(repos.bluetooth, SESSION, USER, "pen")
+    batches = live_batches(4)
+    for seq in range(3):
+        assert await append_live(repos, batches[seq], seq)
+
+    # Another connection already committed seq 1 and 2, and the next one starts a new chunk
+    assert not await append_live(repos, batches[3], 1)
+    assert not await append_live(repos, batches[3], 2)
+    assert await append_live(repos, batches[3], 3)
+    header = await repos.bluetooth.get_header(SESSION, USER)
+    assert header["point_count"] == 80
+    assert_same(await sessions.columns(repos.bluetooth, header), strokes.concat(batches))
+
+
+@pytest.mark.anyio
+async def test_live_sessions_of_two_users_with_one_id(repos, chunk_index, monkeypatch):
+    monkeypatch.setattr(repository, "SESSION_CHUNK_POINTS", 50)
+    batches = live_batches(8)
+    for user_id in (USER, "user-2"):
+        await sessions.open_live(repos.bluetooth, SESSION, user_id, "pen")
+    # Interleaved, so both start chunk 0 and then chunk 1
+    for seq in range(4):
+        assert await append_live(repos, batches[2 * seq], seq)
+        assert await append_live(repos, batches[2 * seq + 1], seq, user_id="user-2")
+
+    assert await repos.bluetooth.chunks.count_documents({"session_id": SESSION}) == 4
+    for user_id, own in ((USER, batches[0::2]), ("user-2", batches[1::2])):
+        header = await repos.bluetooth.get_header(SESSION, user_id)
+        assert_same(await sessions.columns(repos.bluetooth, header), strokes.concat(own))
+
+
+@pytest.mark.anyio
+async def test_legacy_live_session_is_adopted(repos, chunk_index):
+    batches = live_batches(2)
+    now = datetime.utcnow()
+    await repos.bluetooth.collection.insert_one({
+        "id": SESSION, "user_id": USER, "device_id": "pen", "acked_seq": 2, "point_count": 40,
+        "chunks": [strokes.encode(batch) for batch in batches], "raw_blobs": [], "timestamp": now, "created_at": now,
+    })
+    header = await sessions.open_live(repos.bluetooth, SESSION, USER, "pen")
+    assert header["acked_seq"] == 2
+
+    header = await repos.bluetooth.get_header(SESSION, USER)
+    assert sessions.is_chunked(header)
+    assert_same(await sessions.columns(repos.bluetooth, header), strokes.concat(batches))
+    assert await append_live(repos, live_batches(3)[2], 2)
+
+
+def with_earlier_base(payload: bytes, ms: int) -> bytes:
+    """The same batch with its base ``ms`` before the first sample, as a pen may send it."""
+    magic, n, m, base_ts = strokes.HEADER.unpack_from(payload)
+    dt = np.frombuffer(payload, dtype="<u4", count=n, offset=strokes.HEADER.size + 5 * n).copy()
+    dt[0] += ms
+    dt_offset = strokes.HEADER.size + 5 * n
+    return (strokes.HEADER.pack(magic, n, m, base_ts - ms) + payload[strokes.HEADER.size:dt_offset]
+            + dt.tobytes() + payload[dt_offset + 4 * n:])
+
+
+@pytest.mark.anyio
+async def test_raw_packed_joins_the_archived_batches(store):
+    batches = live_batches(4)
+    batches.insert(2, strokes.from_points([]))
+    payloads = [strokes.encode(batch) for batch in batches]
+    payloads[1] = with_earlier_base(payloads[1], 7)
+    assert_same(strokes.decode(payloads[1]), batches[1])
+    hashes = [await store.put(payload) for payload in payloads]
+
+    joined = b"".join([piece async for piece in sessions.raw_packed(store, hashes)])
+    assert joined == strokes.encode(strokes.concat(batches))
+    assert len(strokes.decode(b"".join([piece async for piece in sessions.raw_packed(store, [])]))) == 0
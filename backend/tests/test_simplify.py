@@ -0,0 +1,138 @@
+import math
+
+import numpy as np
+import pytest
+
+import simplify
+import strokes
+
+
+def walk(n: int, stroke_count: int, seed: int = 0, step: float = 6.0) -> strokes.StrokeColumns:
+    """Pen-like input: a random walk with some curvature, split into strokes."""
+    rng = np.random.default_rng(seed)
+    heading = np.cumsum(rng.normal(0, 0.2, n))
+    x = np.clip(2048 + np.cumsum(step * np.cos(heading)), 0, 4095)
+    y = np.clip(2048 + np.cumsum(step * np.sin(heading)), 0, 4095)
+    pressure = np.clip(128 + np.cumsum(rng.normal(0, 3, n)), 0, 255)
+    starts = np.sort(rng.choice(np.arange(1, n), size=stroke_count - 1, replace=False)) if stroke_count > 1 else []
+    return strokes.StrokeColumns(
+        x=x.astype(np.uint16),
+        y=y.astype(np.uint16),
+        pressure=pressure.astype(np.uint8),
+        timestamp=1_700_000_000_000 + np.arange(n, dtype=np.int64) * 5,
+        stroke_starts=np.concatenate([[0], starts]).astype(np.uint32),
+    )
+
+
+def line(x, y, pressure=None) -> strokes.StrokeColumns:
+    n = len(x)
+    return strokes.StrokeColumns(
+        x=np.array(x, dtype=np.uint16),
+        y=np.array(y, dtype=np.uint16),
+        pressure=np.array(pressure if pressure is not None else [100] * n, dtype=np.uint8),
+        timestamp=np.arange(n, dtype=np.int64),
+        stroke_starts=np.array([0], dtype=np.uint32),
+    )
+
+
+def reference(columns: strokes.StrokeColumns, tolerance: float, pressure_tolerance: float) -> np.ndarray:
+    """Textbook recursive Ramer-Douglas-Peucker over each stroke, with simplify's error measure."""
+    x, y, p = (column.astype(float).tolist() for column in (columns.x, columns.y, columns.pressure))
+    keep = np.zeros(len(columns), dtype=bool)
+
+    def error(i, left, right):
+        dx, dy = x[right] - x[left], y[right] - y[left]
+        length2 = dx * dx + dy * dy
+        t = ((x[i] - x[left]) * dx + (y[i] - y[left]) * dy) / length2 if length2 else 0.0
+        t = min(max(t, 0.0), 1.0)
+        distance = math.hypot(x[i] - (x[left] + t * dx), y[i] - (y[left] + t * dy))
+        pressure = abs(p[i] - (p[left] + t * (p[right] - p[left])))
+        result = distance / tolerance
+        if pressure_tolerance > 0:
+            result = max(result, pressure / pressure_tolerance)
+        return result
+
+    def rdp(left, right):
+        keep[left] = keep[right] = True
+        if right - left < 2:
+            return
+        errors = [error(i, left, right) for i in range(left + 1, right)]
+        worst = max(errors)
+        if worst > 1.0:
+            split = left + 1 + errors.index(worst)
+            rdp(left, split)
+            rdp(split, right)
+
+    for start, end in strokes.stroke_bounds(columns):
+        rdp(start, end - 1)
+    return keep
+
+
+def dropped_errors(columns: strokes.StrokeColumns, keep: np.ndarray):
+    """Furthest any dropped sample lies from the simplified line, and its largest pressure difference."""
+    x, y, p = (column.astype(np.float64) for column in (columns.x, columns.y, columns.pressure))
+    kept = np.flatnonzero(keep)
+    dropped = np.flatnonzero(~keep)
+    if not len(dropped):
+        return 0.0, 0.0
+    segment = np.searchsorted(kept, dropped)
+    distance, pressure = simplify._chord_errors(x, y, p, dropped, kept[segment - 1], kept[segment])
+    return float(distance.max()), float(pressure.max())
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("tolerance, pressure_tolerance", [(1.0, 8.0), (3.0, 0.0), (0.5, 2.0), (25.0, 50.0)])
+def test_matches_recursive_rdp(seed, tolerance, pressure_tolerance):
+    columns = walk(2000, 7, seed)
+    result = simplify.simplify(columns, tolerance, pressure_tolerance)
+
+    assert result.keep.tolist() == reference(columns, tolerance, pressure_tolerance).tolist()
+    assert result.keep.sum() < len(columns)
+    max_error, max_pressure_error = dropped_errors(columns, result.keep)
+    assert result.max_error == pytest.approx(max_error)
+    assert result.max_pressure_error == pytest.approx(max_pressure_error)
+    assert result.max_error <= tolerance
+    if pressure_tolerance > 0:
+        assert result.max_pressure_error <= pressure_tolerance
+
+
+def test_keeps_the_ends_of_every_stroke():
+    columns = walk(500, 12, seed=3)
+    keep = simplify.simplify(columns, 1000.0, 0.0).keep
+    ends = [index for start, end in strokes.stroke_bounds(columns) for index in (start, end - 1)]
+    assert np.flatnonzero(keep).tolist() == sorted(set(ends))
+
+
+def test_straight_line_keeps_its_ends():
+    result = simplify.simplify(line(range(0, 1000, 10), [500] * 100), 1.0, 8.0)
+    assert np.flatnonzero(result.keep).tolist() == [0, 99]
+    assert result.max_error == pytest.approx(0.0, abs=1e-9)
+
+
+def test_keeps_a_pressure_change_on_a_straight_line():
+    pressure = [100] * 50 + [200] * 50
+    keep = simplify.simplify(line(range(0, 1000, 10), [500] * 100, pressure), 1.0, 8.0).keep
+    assert keep.sum() > 2
+    assert simplify.simplify(line(range(0, 1000, 10), [500] * 100, pressure), 1.0, 0.0).keep.sum() == 2
+
+
+def test_pen_held_still():
+    columns = line([700, 700, 700, 710, 700, 700], [300, 300, 300, 300, 300, 300])
+    result = simplify.simplify(columns, 1.0, 0.0)
+    assert result.keep.tolist() == reference(columns, 1.0, 0.0).tolist()
+    assert result.keep[3]
+
+
+def test_zero_tolerance_keeps_everything():
+    columns = walk(300, 3)
+    result = simplify.simplify(columns, 0.0, 8.0)
+    assert result.keep.all()
+    assert (result.max_error, result.max_pressure_error) == (0.0, 0.0)
+
+
+def test_simplified_selects_the_kept_samples():
+    columns = walk(1000, 4, seed=1)
+    selected, result = simplify.simplified(columns)
+    assert len(selected) == int(result.keep.sum())
+    assert selected.x.tolist() == columns.x[result.keep].tolist()
+    assert result.stats()["raw_point_count"] == 1000
@@ -0,0 +1,124 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import raster
+import sessions
+import spatial
+import strokes
+
+
+def scribbles(stroke_count: int, seed: int = 0, max_length: int = 40) -> strokes.StrokeColumns:
+    """Strokes of random length and size scattered over the page, some of them past its edge."""
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, max_length, stroke_count)
+    origin_x = np.repeat(rng.integers(0, raster.PEN_SPACE, stroke_count), lengths)
+    origin_y = np.repeat(rng.integers(0, raster.PEN_SPACE, stroke_count), lengths)
+    spread = np.repeat(rng.choice([5, 50, 600], stroke_count), lengths)
+    n = int(lengths.sum())
+    return strokes.StrokeColumns(
+        x=np.clip(origin_x + rng.integers(-1, 2, n) * rng.integers(0, spread + 1), 0, 65535).astype(np.uint16),
+        y=np.clip(origin_y + rng.integers(-1, 2, n) * rng.integers(0, spread + 1), 0, 65535).astype(np.uint16),
+        pressure=rng.integers(0, 256, n).astype(np.uint8),
+        timestamp=np.arange(n, dtype=np.int64),
+        stroke_starts=(np.cumsum(lengths) - lengths).astype(np.uint32),
+    )
+
+
+def brute_force(columns: strokes.StrokeColumns, min_x, min_y, max_x, max_y) -> list:
+    hits = []
+    for stroke_id, (start, end) in enumerate(strokes.stroke_bounds(columns)):
+        x, y = columns.x[start:end].astype(int), columns.y[start:end].astype(int)
+        if x.min() <= max_x and x.max() >= min_x and y.min() <= max_y and y.max() >= min_y:
+            hits.append(stroke_id)
+    return hits
+
+
+def regions(seed: int, count: int):
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        min_x, min_y = rng.integers(0, raster.PEN_SPACE, 2)
+        width, height = rng.choice([0, 1, spatial.CELL_SIZE, 300, raster.PEN_SPACE], 2)
+        yield int(min_x), int(min_y), int(min_x + width), int(min_y + height)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_query_matches_brute_force(seed):
+    columns = scribbles(400, seed)
+    index = spatial.build(columns)
+    assert len(index) == 400
+    for region in regions(seed, 200):
+        assert spatial.query(index, *region).tolist() == brute_force(columns, *region), region
+
+
+def test_whole_page_finds_every_stroke():
+    columns = scribbles(100, seed=7)
+    index = spatial.build(columns)
+    assert spatial.query(index, 0, 0, 65535, 65535).tolist() == list(range(100))
+
+
+def test_box_edges_count_as_hits():
+    columns = strokes.StrokeColumns(
+        x=np.array([100, 200, 1000], dtype=np.uint16),
+        y=np.array([100, 300, 1000], dtype=np.uint16),
+        pressure=np.full(3, 100, dtype=np.uint8),
+        timestamp=np.arange(3, dtype=np.int64),
+        stroke_starts=np.array([0, 2], dtype=np.uint32),
+    )
+    index = spatial.build(columns)
+    assert spatial.query(index, 200, 300, 500, 500).tolist() == [0]
+    assert spatial.query(index, 0, 0, 100, 100).tolist() == [0]
+    assert spatial.query(index, 201, 0, 999, 999).tolist() == []
+    assert spatial.query(index, 1000, 1000, 1000, 1000).tolist() == [1]
+
+
+def test_points_past_the_page_edge():
+    columns = strokes.StrokeColumns(
+        x=np.array([60000, 60010], dtype=np.uint16),
+        y=np.array([100, 100], dtype=np.uint16),
+        pressure=np.full(2, 100, dtype=np.uint8),
+        timestamp=np.arange(2, dtype=np.int64),
+        stroke_starts=np.array([0], dtype=np.uint32),
+    )
+    index = spatial.build(columns)
+    assert spatial.query(index, 60005, 0, 65535, 200).tolist() == [0]
+    assert spatial.query(index, 4000, 0, 4095, 200).tolist() == []
+
+
+def test_empty_session():
+    index = spatial.build(strokes.from_points([]))
+    assert len(index) == 0
+    assert spatial.query(index, 0, 0, 4095, 4095).tolist() == []
+
+
+def test_extract_returns_the_strokes_samples():
+    columns = scribbles(50, seed=2)
+    index = spatial.build(columns)
+    stroke_ids = np.array([3, 4, 17, 49])
+    extracted = spatial.extract(columns, index, stroke_ids)
+
+    bounds = strokes.stroke_bounds(columns)
+    expected = np.concatenate([np.arange(*bounds[stroke_id]) for stroke_id in stroke_ids])
+    for field in ("x", "y", "pressure", "timestamp"):
+        assert getattr(extracted, field).tolist() == getattr(columns, field)[expected].tolist(), field
+    lengths = [end - start for start, end in (bounds[stroke_id] for stroke_id in stroke_ids)]
+    assert extracted.stroke_starts.tolist() == np.concatenate([[0], np.cumsum(lengths)[:-1]]).tolist()
+
+
+@pytest.mark.anyio
+async def test_query_session_stored_through_connect(repos):
+    # The shape backend_test.py posts to /api/bluetooth/connect, validated as that route does
+    posted = [
+        {"x": 100, "y": 150, "pressure": 0.8, "timestamp": "2024-05-01T12:00:00"},
+        {"x": 105.5, "y": 155, "pressure": 0.9, "timestamp": "2024-05-01T12:00:00.010"},
+    ]
+    points = [strokes.Point(**point).model_dump() for point in posted]
+    header = {"id": "s", "user_id": "u", "device_id": "pen", "point_count": 2, "created_at": datetime(2024, 5, 1)}
+    await repos.bluetooth.create(header, sessions.point_chunks(points))
+
+    stroke_ids, samples = await spatial.query_session(repos.bluetooth, "s", "u", (0, 0, 200, 200))
+    assert stroke_ids.tolist() == [0]
+    assert samples.x.tolist() == [100, 106]
+    assert samples.timestamp.tolist() == [1714564800000, 1714564800010]
+    assert (await spatial.query_session(repos.bluetooth, "s", "u", (1000, 1000, 2000, 2000)))[0].tolist() == []
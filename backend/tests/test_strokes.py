@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+from pydantic import ValidationError
+
+import strokes
+
+
+def random_columns(n: int, stroke_count: int, seed: int = 0) -> strokes.StrokeColumns:
+    rng = np.random.default_rng(seed)
+    starts = np.sort(rng.choice(np.arange(1, n), size=stroke_count - 1, replace=False)) if stroke_count > 1 else []
+    return strokes.StrokeColumns(
+        x=rng.integers(0, 4096, n).astype(np.uint16),
+        y=rng.integers(0, 4096, n).astype(np.uint16),
+        pressure=rng.integers(0, 256, n).astype(np.uint8),
+        timestamp=1_700_000_000_000 + np.cumsum(rng.integers(0, 20, n)),
+        stroke_starts=np.concatenate([[0], starts]).astype(np.uint32),
+    )
+
+
+def replace(columns: strokes.StrokeColumns, **fields) -> strokes.StrokeColumns:
+    # Not _replace: StrokeColumns' __len__ counts samples, which namedtuple's _make trips over
+    return strokes.StrokeColumns(**dict(zip(strokes.StrokeColumns._fields, columns), **fields))
+
+
+def assert_same(a: strokes.StrokeColumns, b: strokes.StrokeColumns) -> None:
+    for field in strokes.StrokeColumns._fields:
+        assert getattr(a, field).tolist() == getattr(b, field).tolist(), field
+
+
+def test_round_trip():
+    columns = random_columns(1000, 17)
+    payload = strokes.encode(columns)
+
+    assert len(payload) == strokes.HEADER.size + 1000 * strokes.BYTES_PER_POINT + 17 * 4
+    assert_same(strokes.decode(payload), columns)
+
+
+def test_empty_round_trip():
+    assert len(strokes.decode(strokes.encode(strokes.from_points([])))) == 0
+
+
+@pytest.mark.parametrize("payload, message", [
+    (b"SPS1", "shorter than the header"),
+    (strokes.HEADER.pack(b"XXXX", 0, 0, 0), "Unknown stroke encoding"),
+    (strokes.HEADER.pack(strokes.MAGIC, 2, 0, 0), "Expected"),
+])
+def test_malformed_payloads(payload, message):
+    with pytest.raises(strokes.StrokeFormatError, match=message):
+        strokes.decode(payload)
+
+
+def test_stroke_starts_must_increase():
+    columns = replace(random_columns(10, 1), stroke_starts=np.array([3, 3], dtype=np.uint32))
+    with pytest.raises(strokes.StrokeFormatError):
+        strokes.decode(strokes.encode(columns))
+
+
+def test_timestamps_must_not_go_back():
+    columns = random_columns(10, 1)
+    backwards = replace(columns, timestamp=columns.timestamp[::-1].copy())
+    with pytest.raises(strokes.StrokeFormatError):
+        strokes.encode(backwards)
+
+
+def test_concat_and_tail():
+    columns = random_columns(500, 9)
+    head = replace(columns, **{field: getattr(columns, field)[:120] for field in ("x", "y", "pressure", "timestamp")},
+                   stroke_starts=columns.stroke_starts[columns.stroke_starts < 120])
+
+    assert_same(strokes.concat([head, strokes.tail(columns, 120)]), columns)
+
+
+def test_select_keeps_stroke_starts():
+    columns = random_columns(100, 5)
+    keep = np.ones(100, dtype=bool)
+    keep[1::2] = False
+    keep[columns.stroke_starts] = True
+    selected = strokes.select(columns, keep)
+
+    assert selected.x.tolist() == columns.x[keep].tolist()
+    assert selected.x[selected.stroke_starts].tolist() == columns.x[columns.stroke_starts].tolist()
+
+
+def test_stroke_bounds_of_a_continued_batch():
+    columns = replace(random_columns(10, 1), stroke_starts=np.array([4], dtype=np.uint32))
+    assert strokes.stroke_bounds(columns) == [(0, 4), (4, 10)]
+
+
+def test_points_round_trip():
+    columns = random_columns(50, 1)
+    assert_same(strokes.from_points(strokes.to_points(columns)), columns)
+
+
+def test_point_takes_what_clients_send():
+    # backend_test.py sends ISO timestamps and a normalized pressure
+    point = strokes.Point(x=100.4, y=150, pressure=0.8, timestamp="2024-05-01T12:00:00.250")
+    assert point.model_dump() == {"x": 100, "y": 150, "pressure": 204, "timestamp": 1714564800250}
+    assert strokes.Point(timestamp="2024-05-01T12:00:00Z").timestamp == 1714564800000
+    assert strokes.Point(pressure=128, timestamp="1714564800250").model_dump()["timestamp"] == 1714564800250
+
+    columns = strokes.from_points([point.model_dump()])
+    assert columns.timestamp.tolist() == [1714564800250]
+
+
+@pytest.mark.parametrize("fields", [
+    {"timestamp": "yesterday"}, {"timestamp": None}, {"x": "left"}, {"x": -1}, {"y": 70000}, {"pressure": 300},
+])
+def test_point_rejects_what_the_columns_cannot_hold(fields):
+    with pytest.raises(ValidationError):
+        strokes.Point(**fields)
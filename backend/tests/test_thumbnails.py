@@ -0,0 +1,83 @@
+import base64
+import io
+from datetime import datetime
+
+import pytest
+from PIL import Image
+
+import blobs
+import jobs
+import thumbnails
+
+USER = "user-1"
+CREATED = datetime(2024, 1, 1)
+
+
+def png(color=(200, 30, 30, 255), size=(640, 480)) -> bytes:
+    out = io.BytesIO()
+    Image.new("RGBA", size, color).save(out, "PNG")
+    return out.getvalue()
+
+
+def data_url(data: bytes) -> str:
+    return "data:image/png;base64," + base64.b64encode(data).decode()
+
+
+async def create_note(repos, note_id, **fields):
+    await repos.notes.create(dict(
+        {"id": note_id, "user_id": USER, "title": note_id, "content_hash": None, "created_at": CREATED, "updated_at": CREATED},
+        **fields
+    ))
+
+
+async def backfill(repos, store):
+    async def run_cpu(func, *args):
+        return func(*args)
+    return await thumbnails.backfill_job(jobs.JobContext(repos, store, {"user_id": USER}, run_cpu), {})
+
+
+async def thumbnail_size(store, note):
+    with Image.open(io.BytesIO(await store.read(note["thumbnail_hash"]))) as image:
+        return image.size
+
+
+@pytest.mark.anyio
+async def test_backfill_covers_inline_canvases(repos, store):
+    canvas = png()
+    await create_note(repos, "inline", content=data_url(canvas))
+    await create_note(repos, "stored", **await blobs.offload_content(store, {"content": data_url(png((0, 0, 255, 255)))}))
+    await create_note(repos, "empty", content="")
+
+    assert await backfill(repos, store) == {"rendered": 2, "failed": 0}
+
+    note = await repos.notes.get_content("inline", USER)
+    assert "content" not in note
+    assert await store.read(note["content_hash"]) == canvas
+    # Same canvas, so the note keeps its version
+    assert note["updated_at"] == CREATED
+    assert (await blobs.hydrate_content(store, dict(note)))["content"] == data_url(canvas)
+
+    for note_id in ("inline", "stored"):
+        note = await repos.notes.get_thumbnail(note_id, USER)
+        assert note["thumbnail_source"] == thumbnails.source(note["content_hash"])
+        assert max(await thumbnail_size(store, note)) == thumbnails.THUMBNAIL_SIZE
+    assert "thumbnail_hash" not in await repos.notes.get_thumbnail("empty", USER)
+
+    # Nothing left to do
+    assert await backfill(repos, store) == {"rendered": 0, "failed": 0}
+
+
+@pytest.mark.anyio
+async def test_backfill_counts_unreadable_inline_canvases(repos, store):
+    await create_note(repos, "broken", content="data:image/png;base64,@@not base64@@")
+    assert await backfill(repos, store) == {"rendered": 0, "failed": 1}
+    assert (await repos.notes.get_content("broken", USER))["content"].endswith("@@")
+
+
+@pytest.mark.anyio
+async def test_inline_canvas_replaced_meanwhile_is_kept(repos, store):
+    await create_note(repos, "n", content=data_url(png()))
+    fields = await blobs.offload_content(store, {"content": data_url(png((0, 255, 0, 255)))})
+    assert not await repos.notes.move_inline_content("n", USER, "data:image/png;base64,AAAA", fields)
+    assert await repos.notes.move_inline_content("n", USER, data_url(png()), fields)
+    assert (await repos.notes.get_content("n", USER))["content_hash"] == fields["content_hash"]
@@ -0,0 +1,147 @@
+"""
+Small previews of note canvases for the dashboard grid.
+
+A thumbnail is the canvas scaled down to fit THUMBNAIL_SIZE pixels and encoded as WebP
+(or PNG with THUMBNAIL_FORMAT=png). It is stored in the blob store like the canvas
+itself, and the note records what it shows:
+
+    thumbnail_hash    blob store key of the thumbnail
+    thumbnail_type    its content type
+    thumbnail_source  "<content_hash>:<format>-<size>", the canvas and settings it was made from
+
+A thumbnail is current when thumbnail_source matches the note's canvas and the current
+settings. Every content change queues a "note_thumbnail" job, the thumbnail route
+renders a stale one on demand, and the "backfill_thumbnails" job brings all of a
+user's existing notes up to date. A canvas still kept inline in the note (written
+before the blob store) is moved to the blob store first.
+"""
+
+import io
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+
+from PIL import Image
+
+import blobs
+import jobs
+from repository import NoteRepository
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "320"))
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "webp").lower()
+WEBP_QUALITY = int(os.getenv("THUMBNAIL_WEBP_QUALITY", "80"))
+CONTENT_TYPES = {"webp": "image/webp", "png": "image/png"}
+if THUMBNAIL_FORMAT not in CONTENT_TYPES:
+    raise RuntimeError(f"Unknown THUMBNAIL_FORMAT: {THUMBNAIL_FORMAT}")
+SETTINGS = f"{THUMBNAIL_FORMAT}-{THUMBNAIL_SIZE}"
+BACKFILL_BATCH = 50
+
+
+class ThumbnailError(ValueError):
+    pass
+
+
+def source(content_hash: str) -> str:
+    return f"{content_hash}:{SETTINGS}"
+
+
+def render(data: bytes) -> bytes:
+    """Scale a canvas image down to fit THUMBNAIL_SIZE. Runs on the job process pool."""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = image.convert("RGBA")
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ThumbnailError("Canvas is not a readable image") from e
+    image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+    buffer = io.BytesIO()
+    if THUMBNAIL_FORMAT == "webp":
+        image.save(buffer, "WEBP", quality=WEBP_QUALITY, method=4)
+    else:
+        image.save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
+
+
+async def store_inline_canvas(repo: NoteRepository, store: blobs.BlobStore,
+                              note_id: str, user_id: str) -> Optional[dict]:
+    """
+    Move the note's canvas to the blob store if it is still kept inline, and return the
+    note's thumbnail fields. None if the note does not exist or has no canvas.
+    """
+    doc = await repo.get_content(note_id, user_id)
+    if doc is None:
+        return None
+    if not doc.get("content_hash") and doc.get("content"):
+        try:
+            fields = await blobs.offload_content(store, {"content": doc["content"]})
+        except ValueError as e:
+            raise ThumbnailError("Canvas is not a readable image") from e
+        # If the note was written to in the meantime, it has a canvas in the blob store anyway
+        await repo.move_inline_content(note_id, user_id, doc["content"], fields)
+    note = await repo.get_thumbnail(note_id, user_id)
+    return note if note is not None and note.get("content_hash") else None
+
+
+async def refresh(repo: NoteRepository, store: blobs.BlobStore, run_cpu: Callable[..., Awaitable],
+                  note_id: str, user_id: str, note: Optional[dict] = None) -> Optional[dict]:
+    """
+    Make the note's thumbnail current and return the note's thumbnail fields. None if the
+    note does not exist or has no canvas. ``note`` saves the lookup if the caller has it.
+    """
+    if note is None:
+        note = await repo.get_thumbnail(note_id, user_id)
+    if note is not None and not note.get("content_hash"):
+        note = await store_inline_canvas(repo, store, note_id, user_id)
+    if note is None:
+        return None
+    wanted = source(note["content_hash"])
+    if note.get("thumbnail_source") == wanted:
+        return note
+
+    thumbnail = await run_cpu(render, await store.read(note["content_hash"]))
+    content_type = CONTENT_TYPES[THUMBNAIL_FORMAT]
+    fields = {
+        "thumbnail_hash": await store.put(thumbnail, content_type),
+        "thumbnail_type": content_type,
+        "thumbnail_source": wanted,
+    }
+    # Only recorded if the canvas is still the one rendered; a newer canvas gets its own job
+    await repo.set_thumbnail(note_id, user_id, note["content_hash"], fields)
+    return dict(note, **fields)
+
+
+async def thumbnail_job(context: jobs.JobContext, params: dict) -> dict:
+    """Job handler: render the thumbnail of one note after its canvas changed."""
+    note = await refresh(context.repos.notes, context.store, context.run_cpu, params["note_id"], context.job["user_id"])
+    return {"thumbnail_hash": note["thumbnail_hash"] if note else None}
+
+
+async def backfill_job(context: jobs.JobContext, params: dict) -> dict:
+    """Job handler: bring the thumbnails of every note of the job's owner up to date."""
+    repo, user_id = context.repos.notes, context.job["user_id"]
+    rendered, failed, after_id = 0, 0, None
+    while True:
+        notes = await repo.stale_thumbnails(user_id, SETTINGS, after_id, BACKFILL_BATCH)
+        if not notes:
+            return {"rendered": rendered, "failed": failed}
+        for note in notes:
+            try:
+                await refresh(repo, context.store, context.run_cpu, note["id"], user_id, note)
+                rendered += 1
+            except ThumbnailError:
+                logger.warning("Note %s has an unreadable canvas, no thumbnail", note["id"])
+                failed += 1
+        after_id = notes[-1]["id"]
+
+
+jobs.register("note_thumbnail", thumbnail_job, submittable=False)
+jobs.register("backfill_thumbnails", backfill_job)
+
+
+async def request_thumbnail(scheduler: jobs.JobScheduler, note_id: str, user_id: str) -> None:
+    """Queue a thumbnail render for the note, unless one is already queued or running."""
+    await scheduler.submit(
+        user_id, "note_thumbnail", {"note_id": note_id},
+        dedupe_key=f"note_thumbnail:{note_id}",
+    )
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Concurrency benchmark for the Smart Pen backend.
+Hammers authenticated read endpoints with an increasing number of concurrent
+clients and reports throughput per level, so we can confirm that throughput
+keeps growing with concurrency instead of flattening out on a blocked event loop.
+"""
+
+import json
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Configuration
+BASE_URL = "http://localhost:8001/api"
+TEST_USER_DATA = {
+    "username": "smartpen_bench_user",
+    "email": "smartpen.bench.user@example.com",
+    "password": "SecurePassword123!"
+}
+CONCURRENCY_LEVELS = [1, 2, 4, 8, 16, 32]
+DURATION_SECONDS = 10
+# Throughput at the highest level must be at least this multiple of the single-client throughput
+MIN_SCALING_FACTOR = 2.0
+
+
+class ConcurrencyBenchmark:
+    def __init__(self, base_url=BASE_URL, duration=DURATION_SECONDS):
+        self.base_url = base_url
+        self.duration = duration
+        self.auth_token = None
+        self.results = []
+
+    def authenticate(self):
+        """Register the benchmark user (or log in if it already exists)"""
+        response = requests.post(f"{self.base_url}/auth/register", json=TEST_USER_DATA, timeout=10)
+        if response.status_code == 400:
+            response = requests.post(
+                f"{self.base_url}/auth/login",
+                json={"username": TEST_USER_DATA["username"], "password": TEST_USER_DATA["password"]},
+                timeout=10
+            )
+        response.raise_for_status()
+        self.auth_token = response.json()["access_token"]
+
+    def seed_notes(self, count=20):
+        """Make sure the notes listing has something to return"""
+        headers = {"Authorization": f"Bearer {self.auth_token}"}
+        for i in range(count):
+            requests.post(
+                f"{self.base_url}/notes",
+                json={"title": f"Benchmark note {i}", "content": "YmVuY2htYXJr", "text_content": "benchmark"},
+                headers=headers,
+                timeout=10
+            )
+
+    def _client_loop(self, deadline, latencies, errors, lock):
+        session = requests.Session()
+        session.headers["Authorization"] = f"Bearer {self.auth_token}"
+        local_latencies = []
+        local_errors = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = session.get(f"{self.base_url}/notes", timeout=30)
+                if response.status_code != 200:
+                    local_errors += 1
+            except requests.RequestException:
+                local_errors += 1
+            local_latencies.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    def run_level(self, concurrency):
+        """Run `concurrency` clients for the configured duration and return the measured stats"""
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        started = time.perf_counter()
+        deadline = started + self.duration
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in range(concurrency):
+                executor.submit(self._client_loop, deadline, latencies, errors, lock)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        result = {
+            "concurrency": concurrency,
+            "requests": len(latencies),
+            "errors": sum(errors),
+            "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+            "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000 if latencies else 0.0,
+        }
+        self.results.append(result)
+        print(f"👥 {concurrency:>3} clients: {result['throughput_rps']:8.1f} req/s, "
+              f"p50 {result['p50_ms']:7.1f} ms, p95 {result['p95_ms']:7.1f} ms, errors {result['errors']}")
+        return result
+
+    def run(self, levels=CONCURRENCY_LEVELS):
+        print("🚀 Starting Smart Pen concurrency benchmark...")
+        print("=" * 60)
+        self.authenticate()
+        self.seed_notes()
+        for level in levels:
+            self.run_level(level)
+
+        baseline = self.results[0]["throughput_rps"]
+        peak = max(r["throughput_rps"] for r in self.results)
+        scaling = peak / baseline if baseline else 0.0
+        print("\n" + "=" * 60)
+        print(f"📈 Scaling factor (peak / single client): {scaling:.2f}x")
+        return scaling
+
+
+def main():
+    benchmark = ConcurrencyBenchmark()
+    scaling = benchmark.run()
+
+    with open('concurrency_benchmark_results.json', 'w') as f:
+        json.dump({"scaling_factor": scaling, "levels": benchmark.results}, f, indent=2)
+
+    if scaling < MIN_SCALING_FACTOR:
+        print(f"⚠️  Throughput flattened out (expected at least {MIN_SCALING_FACTOR:.1f}x).")
+        return False
+    print("🎉 Throughput grows with concurrent clients.")
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
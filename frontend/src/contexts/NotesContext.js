@@ -4,6 +4,12 @@ import { useAuth } from './AuthContext';
 
 const NotesContext = createContext();
 
+// Notes per page of the dashboard grid
+const NOTES_PAGE_SIZE = 50;
+
+// The grid lists summaries, which name the canvas (content_hash) rather than carry it
+const toSummary = ({ content, ...summary }) => summary;
+
 export const useNotes = () => {
   const context = useContext(NotesContext);
   if (!context) {
@@ -14,6 +20,7 @@ export const useNotes = () => {
 
 export const NotesProvider = ({ children }) => {
   const [notes, setNotes] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [currentNote, setCurrentNote] = useState(null);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
@@ -21,6 +28,15 @@ export const NotesProvider = ({ children }) => {
 
   const API_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
 
+  const fetchSummaries = useCallback(async (cursor) => {
+    const response = await axios.get(`${API_URL}/api/notes/summary`, {
+      headers: { Authorization: `Bearer ${token}` },
+      params: { limit: NOTES_PAGE_SIZE, ...(cursor ? { cursor } : {}) }
+    });
+    return response.data;
+  }, [token, API_URL]);
+
+  // The first page of the grid; fetchMoreNotes appends the ones after it
   const fetchNotes = useCallback(async () => {
     if (!token) return;
 
@@ -28,16 +44,48 @@ export const NotesProvider = ({ children }) => {
     setError(null);
 
     try {
-      const response = await axios.get(`${API_URL}/api/notes`, {
-        headers: { Authorization: `Bearer ${token}` }
-      });
-      setNotes(response.data);
+      const page = await fetchSummaries(null);
+      setNotes(page.items);
+      setNextCursor(page.next_cursor);
     } catch (err) {
       setError(err.response?.data?.detail || 'Ошибка загрузки заметок');
       console.error('Error fetching notes:', err);
     } finally {
       setLoading(false);
     }
+  }, [token, fetchSummaries]);
+
+  const fetchMoreNotes = useCallback(async () => {
+    if (!token || !nextCursor) return;
+
+    try {
+      const page = await fetchSummaries(nextCursor);
+      // A note edited since the first page moved to the top; keep the copy already listed
+      setNotes(prev => [...prev, ...page.items.filter(item => !prev.some(note => note.id === item.id))]);
+      setNextCursor(page.next_cursor);
+    } catch (err) {
+      setError(err.response?.data?.detail || 'Ошибка загрузки заметок');
+      console.error('Error fetching notes:', err);
+    }
+  }, [token, nextCursor, fetchSummaries]);
+
+  // The full note, canvas included, for the note page
+  const fetchNote = useCallback(async (noteId) => {
+    if (!token) return null;
+
+    setError(null);
+
+    try {
+      const response = await axios.get(`${API_URL}/api/notes/${noteId}`, {
+        headers: { Authorization: `Bearer ${token}` }
+      });
+      setCurrentNote(response.data);
+      return response.data;
+    } catch (err) {
+      setError(err.response?.data?.detail || 'Ошибка загрузки заметки');
+      console.error('Error fetching note:', err);
+      return null;
+    }
   }, [token, API_URL]);
 
   const createNote = useCallback(async (noteData) => {
@@ -52,7 +100,7 @@ export const NotesProvider = ({ children }) => {
       });
       
       const newNote = response.data;
-      setNotes(prev => [newNote, ...prev]);
+      setNotes(prev => [toSummary(newNote), ...prev]);
       setCurrentNote(newNote);
       
       return newNote;
@@ -78,7 +126,7 @@ export const NotesProvider = ({ children }) => {
       
       const updatedNote = response.data;
       setNotes(prev => prev.map(note => 
-        note.id === noteId ? updatedNote : note
+        note.id === noteId ? toSummary(updatedNote) : note
       ));
       
       if (currentNote?.id === noteId) {
@@ -126,31 +174,68 @@ export const NotesProvider = ({ children }) => {
     if (!token || !query) return [];
 
     try {
-      const response = await axios.get(`${API_URL}/api/notes`, {
+      const response = await axios.get(`${API_URL}/api/notes/search`, {
         headers: { Authorization: `Bearer ${token}` },
-        params: { search: query }
+        params: { q: query }
       });
       
-      return response.data.filter(note => 
-        note.title.toLowerCase().includes(query.toLowerCase()) ||
-        note.text_content?.toLowerCase().includes(query.toLowerCase())
-      );
+      return response.data.items;
     } catch (err) {
       console.error('Error searching notes:', err);
       return [];
     }
   }, [token, API_URL]);
 
+  const exportNotesToPDF = useCallback(async (noteIds) => {
+    if (!token || !noteIds.length) return null;
+
+    try {
+      const response = await axios.post(`${API_URL}/api/notes/export`, { note_ids: noteIds }, {
+        headers: { Authorization: `Bearer ${token}` },
+        responseType: 'blob'
+      });
+
+      return response.data;
+    } catch (err) {
+      setError('Ошибка экспорта в PDF');
+      console.error('Error exporting notes:', err);
+      throw err;
+    }
+  }, [token, API_URL]);
+
+  const fetchThumbnail = useCallback(async (note) => {
+    if (!token || !note.content_hash) return null;
+
+    try {
+      // Naming the canvas in the URL lets the browser cache the thumbnail for good
+      const response = await axios.get(`${API_URL}/api/notes/${note.id}/thumbnail`, {
+        params: { v: note.content_hash },
+        headers: { Authorization: `Bearer ${token}` },
+        responseType: 'blob'
+      });
+
+      return response.data;
+    } catch (err) {
+      console.error('Error fetching thumbnail:', err);
+      return null;
+    }
+  }, [token, API_URL]);
+
   const value = {
     notes,
     currentNote,
     loading,
     error,
     fetchNotes,
+    fetchMoreNotes,
+    hasMoreNotes: nextCursor !== null,
+    fetchNote,
     createNote,
     updateNote,
     deleteNote,
     searchNotes,
+    exportNotesToPDF,
+    fetchThumbnail,
     setCurrentNote
   };
 
@@ -4,11 +4,46 @@ import { useAuth } from '../contexts/AuthContext';
 import { useNotes } from '../contexts/NotesContext';
 import BluetoothConnection from '../components/BluetoothConnection';
 
+const NoteThumbnail = ({ note }) => {
+  const { fetchThumbnail } = useNotes();
+  const [url, setUrl] = useState(null);
+  const { id, content_hash: contentHash } = note;
+
+  useEffect(() => {
+    let objectUrl = null;
+    let cancelled = false;
+    fetchThumbnail({ id, content_hash: contentHash }).then((blob) => {
+      if (blob && !cancelled) {
+        objectUrl = URL.createObjectURL(blob);
+        setUrl(objectUrl);
+      }
+    });
+    return () => {
+      cancelled = true;
+      if (objectUrl) URL.revokeObjectURL(objectUrl);
+    };
+  }, [id, contentHash, fetchThumbnail]);
+
+  if (!url) return null;
+  return (
+    <img
+      src={url}
+      alt={note.title}
+      className="w-full h-32 object-contain bg-white border border-gray-100 rounded mb-3"
+    />
+  );
+};
+
+// Wait for the user to stop typing before asking the server
+const SEARCH_DEBOUNCE_MS = 300;
+
 const Dashboard = () => {
   const { user, logout } = useAuth();
-  const { notes, fetchNotes, loading, createNote, deleteNote } = useNotes();
+  const {
+    notes, fetchNotes, fetchMoreNotes, hasMoreNotes, loading, createNote, deleteNote, searchNotes
+  } = useNotes();
   const [searchQuery, setSearchQuery] = useState('');
-  const [filteredNotes, setFilteredNotes] = useState([]);
+  const [searchResults, setSearchResults] = useState(null);
   const navigate = useNavigate();
 
   useEffect(() => {
@@ -16,16 +51,27 @@ const Dashboard = () => {
   }, [fetchNotes]);
 
   useEffect(() => {
-    if (searchQuery) {
-      const filtered = notes.filter(note =>
-        note.title.toLowerCase().includes(searchQuery.toLowerCase()) ||
-        note.text_content?.toLowerCase().includes(searchQuery.toLowerCase())
-      );
-      setFilteredNotes(filtered);
-    } else {
-      setFilteredNotes(notes);
+    const query = searchQuery.trim();
+    if (!query) {
+      setSearchResults(null);
+      return undefined;
     }
-  }, [notes, searchQuery]);
+
+    let cancelled = false;
+    const timer = setTimeout(() => {
+      searchNotes(query).then((items) => {
+        // A slower answer to an older query must not replace the current one
+        if (!cancelled) setSearchResults(items);
+      });
+    }, SEARCH_DEBOUNCE_MS);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [searchQuery, searchNotes]);
+
+  // Search results are ranked by the server and may include notes on pages not loaded yet
+  const filteredNotes = searchResults || notes;
 
   const handleCreateNote = async () => {
     const newNote = {
@@ -46,6 +92,7 @@ const Dashboard = () => {
     if (window.confirm('Вы уверены, что хотите удалить эту заметку?')) {
       try {
         await deleteNote(noteId);
+        setSearchResults(prev => prev && prev.filter(result => result.id !== noteId));
       } catch (error) {
         console.error('Error deleting note:', error);
       }
@@ -64,6 +111,7 @@ const Dashboard = () => {
     });
   };
 
+  // Grid notes and search results are summaries: they name the canvas (content_hash) rather than carry it
   const getPreviewText = (content) => {
     if (!content) return 'Пустая заметка';
     // Extract text from base64 image or show placeholder
@@ -169,8 +217,10 @@ const Dashboard = () => {
                   </button>
                 </div>
                 
+                <NoteThumbnail note={note} />
+
                 <p className="text-gray-600 text-sm mb-3">
-                  {getPreviewText(note.content)}
+                  {getPreviewText(note.content_hash)}
                 </p>
                 
                 <div className="flex justify-between items-center text-xs text-gray-500">
@@ -197,6 +247,18 @@ const Dashboard = () => {
             </div>
           )}
         </div>
+
+        {/* Next page of the grid; search results come ranked in one page */}
+        {!loading && !searchResults && hasMoreNotes && (
+          <div className="text-center mt-8">
+            <button
+              onClick={fetchMoreNotes}
+              className="px-4 py-2 text-primary-600 border border-primary-600 rounded-lg hover:bg-primary-50"
+            >
+              Показать ещё
+            </button>
+          </div>
+        )}
       </div>
 
       {/* Floating Action Button */}
@@ -4,13 +4,12 @@ import { useNotes } from '../contexts/NotesContext';
 import { useBluetooth } from '../contexts/BluetoothContext';
 import DrawingCanvas from '../components/DrawingCanvas';
 import Tesseract from 'tesseract.js';
-import jsPDF from 'jspdf';
 import { saveAs } from 'file-saver';
 
 const NotePage = () => {
   const { id } = useParams();
   const navigate = useNavigate();
-  const { notes, updateNote, loading } = useNotes();
+  const { fetchNote, updateNote, exportNotesToPDF, loading } = useNotes();
   const { isConnected } = useBluetooth();
   
   const [note, setNote] = useState(null);
@@ -21,15 +20,21 @@ const NotePage = () => {
   const [isSaving, setIsSaving] = useState(false);
   const [showExportMenu, setShowExportMenu] = useState(false);
 
+  // The dashboard only holds summaries; the canvas comes with the full note
   useEffect(() => {
-    const currentNote = notes.find(n => n.id === id);
-    if (currentNote) {
-      setNote(currentNote);
-      setTitle(currentNote.title);
-      setCanvasData(currentNote.content || '');
-      setExtractedText(currentNote.text_content || '');
-    }
-  }, [id, notes]);
+    let cancelled = false;
+    fetchNote(id).then((currentNote) => {
+      if (currentNote && !cancelled) {
+        setNote(currentNote);
+        setTitle(currentNote.title);
+        setCanvasData(currentNote.content || '');
+        setExtractedText(currentNote.text_content || '');
+      }
+    });
+    return () => {
+      cancelled = true;
+    };
+  }, [id, fetchNote]);
 
   const handleSave = async () => {
     if (!note) return;
@@ -69,27 +74,16 @@ const NotePage = () => {
   };
 
   const exportToPDF = async () => {
-    if (!canvasData) return;
+    if (!note) return;
 
-    const pdf = new jsPDF();
-    const imgData = canvasData;
-    
-    // Add title
-    pdf.setFontSize(16);
-    pdf.text(title, 20, 20);
-    
-    // Add image
-    pdf.addImage(imgData, 'PNG', 20, 30, 170, 120);
-    
-    // Add extracted text if available
-    if (extractedText) {
-      pdf.setFontSize(12);
-      pdf.text('Распознанный текст:', 20, 160);
-      const splitText = pdf.splitTextToSize(extractedText, 170);
-      pdf.text(splitText, 20, 170);
+    // The PDF is built on the server from the saved note, so save pending edits first
+    await handleSave();
+    try {
+      const pdf = await exportNotesToPDF([note.id]);
+      if (pdf) saveAs(pdf, `${title}.pdf`);
+    } catch (error) {
+      console.error('Error exporting PDF:', error);
     }
-    
-    pdf.save(`${title}.pdf`);
   };
 
   const exportToPNG = () => {
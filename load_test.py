@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Load test and latency benchmark for the Smart Pen backend.
+Runs the scenarios of backend_test.py (register/login, notes CRUD, Bluetooth ingest) from
+many concurrent virtual users, reports p50/p95/p99 latency and throughput per route, and
+fails when a route regressed past the saved baseline.
+
+Needs httpx. With --in-memory the app runs in this process on mongomock-motor
+(pip install mongomock-motor) instead of being reached over HTTP, so neither a mongod
+nor the network is needed.
+
+    python load_test.py --users 32 --duration 30        # against BASE_URL
+    python load_test.py --in-memory --save-baseline     # record a baseline
+    python load_test.py --in-memory                     # compare with it
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+
+from backend_test import BASE_URL, TEST_USER_DATA
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+BASELINE_PATH = "load_test_baseline.json"
+RESULTS_PATH = "load_test_results.json"
+SCENARIO_WEIGHTS = {"notes": 6, "bluetooth": 3, "auth": 1}
+# A route regresses when its p95 grows by more than this fraction (and SLACK_MS), or its throughput drops by more
+DEFAULT_TOLERANCE = 0.25
+SLACK_MS = 5.0
+MAX_ERROR_RATE = 0.01
+
+
+def make_canvas(size_bytes):
+    """A PNG data URL of roughly size_bytes (noise does not compress, so the size is predictable)"""
+    from PIL import Image
+    side = max(8, int((size_bytes / 3) ** 0.5))
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", compress_level=1)
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def make_stroke_batch(points):
+    """A packed stroke batch (see backend/strokes.py) of a wobbly line, split into strokes of 100 points"""
+    import numpy as np
+    import strokes
+    t = np.arange(points)
+    return strokes.encode(strokes.StrokeColumns(
+        x=(2048 + 1500 * np.sin(t / 50)).astype(np.uint16),
+        y=(2048 + 1500 * np.cos(t / 70)).astype(np.uint16),
+        pressure=(128 + 100 * np.sin(t / 10)).astype(np.uint8),
+        timestamp=int(time.time() * 1000) + t * 5,
+        stroke_starts=np.arange(0, points, 100, dtype=np.uint32),
+    ))
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class LoadTester:
+    def __init__(self, client, users, duration, canvas_bytes, stroke_points, scenarios):
+        self.client = client
+        self.users = users
+        self.duration = duration
+        self.scenarios = scenarios
+        self.canvas = make_canvas(canvas_bytes)
+        self.stroke_batch = make_stroke_batch(stroke_points)
+        self.run_id = uuid.uuid4().hex[:8]
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        # 503s: the server shedding load on purpose (e.g. too many logins hashing at once), not failures
+        self.shed = defaultdict(int)
+
+    async def request(self, route, method, url, expected=200, **kwargs):
+        """Time one request under its route name; returns the response, or None if it failed"""
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            response = None
+        self.latencies[route].append(time.perf_counter() - start)
+        if response is not None and response.status_code == 503:
+            self.shed[route] += 1
+            return response
+        if response is None or response.status_code != expected:
+            self.errors[route] += 1
+            return None
+        return response
+
+    async def scenario_auth(self, user, headers):
+        await self.request("POST /auth/login", "POST", "auth/login",
+                           json={"username": user["username"], "password": user["password"]})
+
+    async def scenario_notes(self, user, headers):
+        note_data = {
+            "title": "Load Test Note",
+            "content": self.canvas,
+            "text_content": "This note was created by the Smart Pen load test",
+        }
+        response = await self.request("POST /notes", "POST", "notes", json=note_data, headers=headers)
+        if response is None or response.status_code != 200:
+            return
+        note_id = response.json()["id"]
+        await self.request("GET /notes", "GET", "notes", headers=headers)
+        await self.request("GET /notes/summary", "GET", "notes/summary", headers=headers)
+        await self.request("GET /notes/{id}", "GET", f"notes/{note_id}", headers=headers)
+        await self.request("PUT /notes/{id}", "PUT", f"notes/{note_id}",
+                           json={"title": "Updated Load Test Note", "text_content": "updated"}, headers=headers)
+        # Deleting keeps every user's listing the same size for the whole run
+        await self.request("DELETE /notes/{id}", "DELETE", f"notes/{note_id}", expected=204, headers=headers)
+
+    async def scenario_bluetooth(self, user, headers):
+        bluetooth_data = {
+            "device_id": "neo_smartpen_dimo_load",
+            "stroke_data": [
+                {"x": 100 + i, "y": 150 + i, "pressure": 0.8, "timestamp": datetime.now().isoformat()}
+                for i in range(20)
+            ],
+            "timestamp": datetime.now().isoformat(),
+        }
+        await self.request("POST /bluetooth/connect", "POST", "bluetooth/connect", json=bluetooth_data, headers=headers)
+        response = await self.request(
+            "POST /bluetooth/strokes", "POST", "bluetooth/strokes",
+            params={"device_id": "neo_smartpen_dimo_load"}, content=self.stroke_batch,
+            headers=dict(headers, **{"Content-Type": "application/octet-stream"}),
+        )
+        if response is not None and response.status_code == 200:
+            await self.request("GET /bluetooth/data/{id}/packed", "GET",
+                               f"bluetooth/data/{response.json()['id']}/packed", headers=headers)
+
+    async def virtual_user(self, index, deadline):
+        user = {
+            "username": f"{TEST_USER_DATA['username']}_load_{self.run_id}_{index}",
+            "email": f"load.{self.run_id}.{index}@example.com",
+            "password": TEST_USER_DATA["password"],
+        }
+        response = await self.request("POST /auth/register", "POST", "auth/register", json=user)
+        while response is not None and response.status_code == 503 and time.perf_counter() < deadline:
+            await asyncio.sleep(float(response.headers.get("Retry-After", "1")))
+            response = await self.request("POST /auth/register", "POST", "auth/register", json=user)
+        if response is None or response.status_code != 200:
+            return
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        names = list(self.scenarios)
+        weights = [SCENARIO_WEIGHTS[name] for name in names]
+        while time.perf_counter() < deadline:
+            scenario = random.choices(names, weights)[0]
+            await getattr(self, f"scenario_{scenario}")(user, headers)
+
+    async def run(self):
+        print(f"👥 {self.users} virtual users for {self.duration:.0f}s, scenarios: {', '.join(self.scenarios)}")
+        started = time.perf_counter()
+        deadline = started + self.duration
+        await asyncio.gather(*(self.virtual_user(i, deadline) for i in range(self.users)))
+        return self.summarize(time.perf_counter() - started)
+
+    def summarize(self, elapsed):
+        routes = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            routes[route] = {
+                "requests": len(latencies),
+                "errors": self.errors[route],
+                "shed": self.shed[route],
+                "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+            }
+        return routes
+
+
+def print_routes(routes):
+    print(f"{'route':<34}{'req':>7}{'err':>5}{'shed':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for route, stats in routes.items():
+        print(f"{route:<34}{stats['requests']:>7}{stats['errors']:>5}{stats['shed']:>6}{stats['throughput_rps']:>9.1f}"
+              f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}")
+
+
+def find_regressions(routes, baseline_routes, tolerance):
+    """Describe every route that got slower, lost throughput or failed more than allowed"""
+    regressions = []
+    for route, stats in routes.items():
+        if stats["errors"] > stats["requests"] * MAX_ERROR_RATE:
+            regressions.append(f"{route}: {stats['errors']} of {stats['requests']} requests failed")
+        base = baseline_routes.get(route)
+        if base is None:
+            continue
+        allowed_p95 = base["p95_ms"] * (1 + tolerance) + SLACK_MS
+        if stats["p95_ms"] > allowed_p95:
+            regressions.append(f"{route}: p95 {stats['p95_ms']:.1f} ms, baseline {base['p95_ms']:.1f} ms")
+        if stats["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{route}: {stats['throughput_rps']:.1f} req/s, "
+                               f"baseline {base['throughput_rps']:.1f} req/s")
+    return regressions
+
+
+def in_memory_app():
+    """The backend app on an in-memory Mongo stand-in, with blobs in a temporary directory"""
+    os.environ.setdefault("MONGO_URL", "mongodb://in-memory")
+    os.environ.setdefault("JWT_SECRET_KEY", "load-test")
+    # GridFS needs a real server
+    os.environ["BLOB_STORE"] = "filesystem"
+    os.environ.setdefault("BLOB_STORE_PATH", tempfile.mkdtemp(prefix="smartpen-load-test-"))
+    from mongomock_motor import AsyncMongoMockClient
+    import repository
+    repository.create_client = lambda mongo_url, **kwargs: AsyncMongoMockClient()
+    import server
+    return server.app
+
+
+async def run(args, scenarios):
+    if args.in_memory:
+        app = in_memory_app()
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://in-memory/api/", timeout=60) as client:
+                tester = LoadTester(client, args.users, args.duration, args.canvas_kb * 1024, args.stroke_points, scenarios)
+                return await tester.run()
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    async with httpx.AsyncClient(base_url=args.base_url.rstrip("/") + "/", timeout=60, limits=limits) as client:
+        tester = LoadTester(client, args.users, args.duration, args.canvas_kb * 1024, args.stroke_points, scenarios)
+        return await tester.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--in-memory", action="store_true", help="run the app in-process on mongomock-motor")
+    parser.add_argument("--users", type=int, default=16, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds to run for")
+    parser.add_argument("--canvas-kb", type=int, default=64, help="size of each note canvas")
+    parser.add_argument("--stroke-points", type=int, default=2000, help="points per packed stroke batch")
+    parser.add_argument("--scenarios", default=",".join(SCENARIO_WEIGHTS), help="comma-separated subset of %(default)s")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIO_WEIGHTS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    config = {
+        "target": "in-memory" if args.in_memory else args.base_url,
+        "users": args.users,
+        "duration": args.duration,
+        "canvas_kb": args.canvas_kb,
+        "stroke_points": args.stroke_points,
+        "scenarios": scenarios,
+    }
+
+    print("🚀 Starting Smart Pen load test...")
+    print("=" * 60)
+    routes = asyncio.run(run(args, scenarios))
+    print_routes(routes)
+
+    with open(RESULTS_PATH, 'w') as f:
+        json.dump({"config": config, "routes": routes}, f, indent=2)
+
+    print("\n" + "=" * 60)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({"config": config, "routes": routes}, f, indent=2)
+        print(f"📄 Baseline saved to: {args.baseline}")
+        baseline_routes = {}
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("⚠️  Baseline was recorded with different settings; the comparison may not mean much.")
+        baseline_routes = baseline.get("routes", {})
+    else:
+        print(f"ℹ️  No baseline at {args.baseline}; run with --save-baseline to record one.")
+        baseline_routes = {}
+
+    regressions = find_regressions(routes, baseline_routes, args.tolerance)
+    if regressions:
+        print("⚠️  Regressions:")
+        for regression in regressions:
+            print(f"   ❌ {regression}")
+        return False
+    print("🎉 No route regressed.")
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Login storm benchmark for the Smart Pen backend.
+Measures note API latency while idle, then again while a crowd of clients hammers
+/auth/login, so we can confirm that bcrypt work no longer stalls unrelated requests.
+Logins shed with 503 under overload are counted, not treated as failures.
+"""
+
+import json
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Configuration
+BASE_URL = "http://localhost:8001/api"
+TEST_USER_DATA = {
+    "username": "smartpen_storm_user",
+    "email": "smartpen.storm.user@example.com",
+    "password": "SecurePassword123!"
+}
+PHASE_SECONDS = 10
+STORM_CLIENTS = 32
+# p95 note latency during the storm may be at most this multiple of the idle p95 (plus a little slack)
+MAX_LATENCY_GROWTH = 2.0
+LATENCY_SLACK_MS = 20.0
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, int(len(sorted_values) * fraction) - 1)]
+
+
+class LoginStormBenchmark:
+    def __init__(self, base_url=BASE_URL, duration=PHASE_SECONDS, storm_clients=STORM_CLIENTS):
+        self.base_url = base_url
+        self.duration = duration
+        self.storm_clients = storm_clients
+        self.auth_token = None
+        self.results = {}
+
+    def authenticate(self):
+        """Register the benchmark user (or log in if it already exists)"""
+        response = requests.post(f"{self.base_url}/auth/register", json=TEST_USER_DATA, timeout=30)
+        if response.status_code == 400:
+            response = requests.post(f"{self.base_url}/auth/login", json=self._credentials(), timeout=30)
+        response.raise_for_status()
+        self.auth_token = response.json()["access_token"]
+
+    def _credentials(self):
+        return {"username": TEST_USER_DATA["username"], "password": TEST_USER_DATA["password"]}
+
+    def _probe_notes(self, deadline):
+        """Fetch the note listing back to back until the deadline and return sorted latencies in ms"""
+        session = requests.Session()
+        session.headers["Authorization"] = f"Bearer {self.auth_token}"
+        latencies = []
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            session.get(f"{self.base_url}/notes/summary", timeout=30).raise_for_status()
+            latencies.append((time.perf_counter() - start) * 1000)
+        return sorted(latencies)
+
+    def _storm_loop(self, deadline, counts, lock):
+        session = requests.Session()
+        local = {"ok": 0, "shed": 0, "errors": 0}
+        while time.perf_counter() < deadline:
+            try:
+                response = session.post(f"{self.base_url}/auth/login", json=self._credentials(), timeout=30)
+                if response.status_code == 200:
+                    local["ok"] += 1
+                elif response.status_code == 503:
+                    local["shed"] += 1
+                else:
+                    local["errors"] += 1
+            except requests.RequestException:
+                local["errors"] += 1
+        with lock:
+            for key, value in local.items():
+                counts[key] += value
+
+    def run_phase(self, name, storm):
+        counts = {"ok": 0, "shed": 0, "errors": 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + self.duration
+        with ThreadPoolExecutor(max_workers=self.storm_clients + 1) as executor:
+            if storm:
+                for _ in range(self.storm_clients):
+                    executor.submit(self._storm_loop, deadline, counts, lock)
+            latencies = executor.submit(self._probe_notes, deadline).result()
+
+        result = {
+            "note_requests": len(latencies),
+            "p50_ms": statistics.median(latencies) if latencies else 0.0,
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+        }
+        if storm:
+            result.update(logins=counts["ok"], logins_shed=counts["shed"], login_errors=counts["errors"])
+        self.results[name] = result
+        print(f"⏱️  {name:>5}: notes p50 {result['p50_ms']:7.1f} ms, p95 {result['p95_ms']:7.1f} ms, "
+              f"p99 {result['p99_ms']:7.1f} ms" +
+              (f" | logins {counts['ok']} ok, {counts['shed']} shed (503), {counts['errors']} errors" if storm else ""))
+        return result
+
+    def run(self):
+        print("🚀 Starting Smart Pen login storm benchmark...")
+        print("=" * 60)
+        self.authenticate()
+        idle = self.run_phase("idle", storm=False)
+        storm = self.run_phase("storm", storm=True)
+        limit = idle["p95_ms"] * MAX_LATENCY_GROWTH + LATENCY_SLACK_MS
+        print("\n" + "=" * 60)
+        print(f"📈 Note p95 during storm: {storm['p95_ms']:.1f} ms (limit {limit:.1f} ms)")
+        return storm["p95_ms"] <= limit and storm["login_errors"] == 0
+
+
+def main():
+    benchmark = LoginStormBenchmark()
+    flat = benchmark.run()
+
+    with open('login_storm_benchmark_results.json', 'w') as f:
+        json.dump(benchmark.results, f, indent=2)
+
+    if not flat:
+        print("⚠️  Note latency degraded (or logins failed) during the login storm.")
+        return False
+    print("🎉 Note latency stays flat during the login storm.")
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Serialization micro-benchmark for the Smart Pen backend.
+Compares the CPU cost per note of turning a note listing into a response body:
+the response_model=List[Note] path FastAPI takes by default, against the fast path
+(fast_json: shape the trusted documents, encode with orjson, optionally compress).
+Runs in-process against synthetic documents; no server or database needed.
+"""
+
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+# server.py refuses to import without these; nothing here connects to anything
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("JWT_SECRET_KEY", "serialization-benchmark")
+
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_response_field  # noqa: E402
+
+import fast_json  # noqa: E402
+from server import Note  # noqa: E402
+
+NOTE_COUNTS = [10, 100, 1000]
+# Base64 canvas size per note; real canvases are larger, which only favours the fast path more
+CANVAS_BYTES = 4 * 1024
+REPEAT_SECONDS = 2.0
+# The fast path must be at least this many times cheaper per note (before compression)
+MIN_SPEEDUP = 3.0
+
+
+def make_notes(count: int) -> List[dict]:
+    now = datetime.utcnow()
+    canvas = "data:image/png;base64," + base64.b64encode(os.urandom(CANVAS_BYTES)).decode()
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "title": f"Лекция {i}: benchmark",
+            "content": canvas,
+            "content_hash": uuid.uuid4().hex * 2,
+            "content_type": "image/png",
+            "content_size": CANVAS_BYTES,
+            "text_content": "Распознанный текст benchmark " * 20,
+            "created_at": now - timedelta(days=i),
+            "updated_at": now - timedelta(hours=i),
+            "user_id": "benchmark-user",
+            "google_drive_id": None,
+            "change_seq": i,
+        }
+        for i in range(count)
+    ]
+
+
+async def default_path(field, docs: List[dict]) -> bytes:
+    """What get_notes did before: validate into Note, then let FastAPI serialize response_model=List[Note]"""
+    content = await serialize_response(
+        field=field, response_content=[Note.model_validate(doc) for doc in docs], is_coroutine=True
+    )
+    return JSONResponse(content).body
+
+
+async def fast_path(docs: List[dict], accept_encoding=None) -> bytes:
+    response = await fast_json.json_response(fast_json.shape_all(docs, Note), accept_encoding)
+    return response.body
+
+
+async def time_per_note(make_body, docs: List[dict]):
+    """Repeat make_body() for REPEAT_SECONDS; return (microseconds per note, body size)"""
+    body = await make_body()
+    runs = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < REPEAT_SECONDS:
+        await make_body()
+        runs += 1
+    elapsed = time.perf_counter() - started
+    return elapsed / runs / len(docs) * 1e6, len(body)
+
+
+async def run():
+    print("🚀 Starting Smart Pen serialization benchmark...")
+    print(f"   orjson: {'yes' if fast_json.orjson else 'no (stdlib json)'}, "
+          f"brotli: {'yes' if fast_json.brotli else 'no'}")
+    print("=" * 60)
+    field = create_response_field(name="notes", type_=List[Note])
+    results = []
+    for count in NOTE_COUNTS:
+        docs = make_notes(count)
+        # Same output, or the comparison means nothing
+        assert json.loads(await default_path(field, docs)) == json.loads(await fast_path(docs))
+
+        default_us, default_size = await time_per_note(lambda: default_path(field, docs), docs)
+        fast_us, fast_size = await time_per_note(lambda: fast_path(docs), docs)
+        gzip_us, gzip_size = await time_per_note(lambda: fast_path(docs, "gzip"), docs)
+        result = {
+            "notes": count,
+            "default_us_per_note": default_us,
+            "fast_us_per_note": fast_us,
+            "fast_gzip_us_per_note": gzip_us,
+            "speedup": default_us / fast_us if fast_us else 0.0,
+            "body_bytes": default_size,
+            "fast_body_bytes": fast_size,
+            "gzip_body_bytes": gzip_size,
+        }
+        if fast_json.brotli:
+            br_us, br_size = await time_per_note(lambda: fast_path(docs, "br"), docs)
+            result.update(fast_br_us_per_note=br_us, br_body_bytes=br_size)
+        results.append(result)
+        print(f"📝 {count:>5} notes: default {default_us:8.1f} µs/note, fast {fast_us:7.1f} µs/note "
+              f"({result['speedup']:.1f}x), +gzip {gzip_us:7.1f} µs/note "
+              f"({gzip_size / fast_size:.0%} of {fast_size} bytes)"
+              + (f", +br {result['fast_br_us_per_note']:7.1f} µs/note ({result['br_body_bytes'] / fast_size:.0%})"
+                 if fast_json.brotli else ""))
+    return results
+
+
+def main():
+    results = asyncio.run(run())
+
+    with open('serialization_benchmark_results.json', 'w') as f:
+        json.dump(results, f, indent=2)
+
+    slowest = min(r["speedup"] for r in results)
+    print("\n" + "=" * 60)
+    if slowest < MIN_SPEEDUP:
+        print(f"⚠️  Fast path is only {slowest:.1f}x cheaper per note (expected at least {MIN_SPEEDUP:.1f}x).")
+        return False
+    print(f"🎉 Fast path is at least {slowest:.1f}x cheaper per note.")
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)